@@ -0,0 +1,280 @@
+import pandas as pd
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import time
+import tracemalloc
+
+from benchmarks.synthetic_data import SyntheticWyscoutData
+from wyscout_etl.create_base import CreateWyscoutBase
+from wyscout_etl.create_extra_variables import GetExtraFeatures
+from wyscout_etl.make_padj import PadjMaker
+from wyscout_etl.make_comparison_stats import ComparePlayers
+from wyscout_etl.calculate_totals import CalculateKPI
+from wyscout_etl.wyscout_db import WyscoutDatabase
+from visualizers.scouting_file import ScoutingExcel
+
+
+class StageBenchmark:
+    """
+    A class for timing the stages of the ETL and the scouting file on synthetic Wyscout data.
+
+    For every scale a synthetic archive is generated with SyntheticWyscoutData, after which the
+    stages of ETLPipelines.create_general_db run in the same order as in the pipeline (without the
+    base cache, so the exports are parsed every time), followed by the output database load and
+    ScoutingExcel._create_scouting_excel. Every stage is timed separately.
+
+    By default the peak memory of every stage is measured with tracemalloc, which follows the numpy
+    and pandas allocations (not the resident memory of the process, which also holds the freed
+    memory the allocator keeps; the peak RSS per stage is in the StageMetrics records). The peak is
+    reported as a multiple of the frame the stage works on (the larger of its input and output
+    frame; for create_base the base frame), because the frame grows several times over the stages.
+    A stage holds its input and output at the same time, so its peak is about 2, every defensive
+    full-frame copy adds about 1. The stages run with pandas copy-on-write, like in the pipeline.
+    A stage whose peak exceeds its expected ratio (expected_memory_ratios) plus memory_headroom fails
+    the benchmark. The headroom of 0.75 covers the variation with the scale and the pandas version, while
+    a new full-frame copy still exceeds it. Below memory_check_rows the fixed allocations (parsers, Arrow
+    buffers) outweigh the frame, so the ratios of smaller scales are only reported.
+
+    Attributes:
+        work_dir (str): The directory in which the synthetic archives and outputs are stored.
+        kpi_method (str): The KPI method in config/kpi_methods.
+        n_workers (int): The number of workers used to parse the exports.
+        include_excel (bool): Whether to time the scouting file.
+        quiet (bool): Whether to suppress the progress output of the stages.
+        track_memory (bool): Whether to measure the peak memory of every stage.
+        memory_headroom (float): How far the peak memory of a stage may exceed its expected ratio, None for no check.
+        peak_memory (pd.DataFrame): The peak memory per stage (rows) and scale (columns) as a multiple of the
+                                    frame of the stage, after a run with track_memory.
+
+    Methods:
+        __init__(work_dir, kpi_method, n_workers, include_excel, quiet, track_memory, memory_headroom): Initializes the StageBenchmark class.
+        run(scales): Times every stage for every scale.
+        run_scale(n_rows): Generates an archive of n_rows player seasons and times every stage on it.
+        _time_stage(timings, stage, function): Runs and times one stage.
+        _check_memory(n_rows, memory, frame_bytes): Converts the peak memory per stage to multiples of its frame and checks them.
+    """
+
+    # The expected peak memory of every stage as a multiple of its frame, measured at 10,000 to 30,000 rows. Besides
+    # its input and output, create_base holds the parsed exports and the comparisons hold the blocks of compared values.
+    expected_memory_ratios = {
+        "create_base": 2.5,
+        "extra_metrics": 1.5,
+        "padj": 2.25,
+        "comparisons": 2.75,
+        "kpis": 1.5,
+        "save_database": 1.25,
+    }
+
+    # The smallest scale whose ratios are checked, at 3,000 rows every stage peaks at least 0.7 below its bound
+    memory_check_rows = 3_000
+
+    def __init__(
+        self,
+        work_dir: str = os.path.join("storage", "benchmark"),
+        kpi_method: str = "general.py",
+        n_workers: int = 1,
+        include_excel: bool = True,
+        quiet: bool = True,
+        track_memory: bool = True,
+        memory_headroom: float = 0.75,
+    ) -> None:
+        """
+        Initialize the StageBenchmark class.
+
+        Args:
+            work_dir (str): The directory for the synthetic archives and outputs. Defaults to 'storage/benchmark'.
+            kpi_method (str): The KPI method in config/kpi_methods. Defaults to 'general.py'.
+            n_workers (int): The number of workers used to parse the exports. Defaults to 1.
+            include_excel (bool): Whether to time the scouting file. Defaults to True.
+            quiet (bool): Whether to suppress the progress output of the stages. Defaults to True.
+            track_memory (bool): Whether to measure the peak memory of every stage. Defaults to True,
+                                 tracemalloc slows the stages down.
+            memory_headroom (float): How far the peak memory of a stage may exceed its expected ratio.
+                                     Defaults to 0.75, None for no check. A headroom turns on track_memory.
+        """
+        self.work_dir = work_dir
+        self.kpi_method = kpi_method
+        self.n_workers = n_workers
+        self.include_excel = include_excel
+        self.quiet = quiet
+        self.track_memory = track_memory or memory_headroom is not None
+        self.memory_headroom = memory_headroom
+        self.peak_memory = None
+        self._memory = None
+
+    def run(self, scales: list[int] = (10_000, 100_000, 1_000_000)) -> pd.DataFrame:
+        """
+        Time every stage for every scale.
+
+        Args:
+            scales (list[int]): The numbers of player seasons to benchmark. Defaults to 10k, 100k and 1M.
+
+        Returns:
+            pd.DataFrame: The seconds per stage (rows) and scale (columns).
+        """
+        timings = []
+        peak_memory = []
+
+        # The stages run with copy-on-write, like in ETLPipelines.create_general_db
+        with pd.option_context("mode.copy_on_write", True):
+            for n_rows in scales:
+                print(f"Benchmarking {n_rows} rows")
+                timings += self.run_scale(n_rows)
+
+                if self.track_memory:
+                    peak_memory.append(self.peak_memory)
+
+        if self.track_memory:
+            self.peak_memory = pd.concat(peak_memory, axis=1)
+
+        results = pd.DataFrame(timings, columns=["rows", "stage", "seconds"])
+
+        return results.pivot(index="stage", columns="rows", values="seconds").loc[results["stage"].unique()]
+
+    def run_scale(self, n_rows: int) -> list[tuple]:
+        """
+        Generate an archive of `n_rows` player seasons and time every stage on it. With track_memory the
+        peak memory per stage is stored in peak_memory.
+
+        Args:
+            n_rows (int): The number of player seasons.
+
+        Returns:
+            list[tuple]: The (rows, stage, seconds) per stage.
+        """
+        scale_dir = os.path.join(self.work_dir, f"rows_{n_rows}")
+        shutil.rmtree(scale_dir, ignore_errors=True)
+
+        timings = {}
+
+        generator = SyntheticWyscoutData.from_rows(n_rows)
+        source_path, league_info_path = self._time_stage(timings, "generate_data", lambda: generator.write(scale_dir))
+
+        base_creator = CreateWyscoutBase(
+            n_workers=self.n_workers,
+            league_info_path=league_info_path,
+            cache_dir=os.path.join(scale_dir, "cache"),
+            kpi_method=self.kpi_method,
+        )
+        db_path = os.path.join(scale_dir, "db")
+
+        if self.track_memory:
+            self._memory = {}
+            tracemalloc.start()
+
+        # The memory of the frame every stage works on, the larger of its input and output frame
+        frame_bytes = {}
+
+        try:
+            df = self._time_stage(timings, "create_base", lambda: base_creator.get_base(source_path, use_cache=False))
+            frame_bytes["create_base"] = df.memory_usage(deep=True).sum()
+
+            stages = [
+                ("extra_metrics", lambda df: GetExtraFeatures()._create_extra_metrics(df)),
+                ("padj", lambda df: PadjMaker()._make_df_padj(df)),
+                ("comparisons", lambda df: ComparePlayers()._calculate_statistical_comparisons(df)),
+                ("kpis", lambda df: CalculateKPI().store_kpi_and_total(df, self.kpi_method)),
+            ]
+            for stage, function in stages:
+                input_bytes = df.memory_usage(deep=True).sum()
+                df = self._time_stage(timings, stage, lambda: function(df))
+                frame_bytes[stage] = max(input_bytes, df.memory_usage(deep=True).sum())
+
+            self._time_stage(timings, "save_database", lambda: WyscoutDatabase().write(df, db_path))
+            frame_bytes["save_database"] = df.memory_usage(deep=True).sum()
+
+            if self.include_excel:
+                sink_path = os.path.join(scale_dir, "scouting_file.xlsx")
+                scouting_excel = ScoutingExcel()
+                self._time_stage(timings, "scouting_excel", lambda: scouting_excel.create_scouting_excel_from_db(db_path, sink_path, kpi_method=self.kpi_method))
+        finally:
+            if self.track_memory:
+                tracemalloc.stop()
+
+        if self.track_memory:
+            self._check_memory(n_rows, self._memory, frame_bytes)
+
+        return [(n_rows, stage, seconds) for stage, seconds in timings.items()]
+
+    def _time_stage(self, timings: dict, stage: str, function):
+        """
+        Run and time one stage.
+
+        Args:
+            timings (dict): The seconds per stage, the timing of this stage is added to it.
+            stage (str): The name of the stage.
+            function (callable): The stage, called without arguments.
+
+        Returns:
+            The result of the stage.
+        """
+        output = io.StringIO() if self.quiet else None
+
+        # The generation of the data isn't part of the pipeline and isn't traced
+        track_memory = self.track_memory and tracemalloc.is_tracing()
+        if track_memory:
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output) if self.quiet else contextlib.nullcontext():
+            result = function()
+        timings[stage] = time.perf_counter() - start
+
+        if track_memory:
+            self._memory[stage] = tracemalloc.get_traced_memory()[1]
+            print(f"{stage}: {timings[stage]:.2f}s, peak {self._memory[stage] / 1024**2:.1f} MB")
+        else:
+            print(f"{stage}: {timings[stage]:.2f}s")
+
+        return result
+
+    def _check_memory(self, n_rows: int, memory: dict, frame_bytes: dict) -> None:
+        """
+        Convert the peak memory per stage to multiples of the frame of the stage, store them in
+        peak_memory and check them against the expected ratios plus memory_headroom. The scouting file
+        doesn't work on a frame of the pipeline and isn't checked, nor are scales below memory_check_rows.
+
+        Args:
+            n_rows (int): The number of player seasons.
+            memory (dict): The peak traced bytes per stage.
+            frame_bytes (dict): The memory of the frame of every stage.
+
+        Raises:
+            RuntimeError: When the peak of a stage exceeds its expected ratio plus memory_headroom.
+        """
+        self.peak_memory = pd.Series({stage: memory[stage] / frame_bytes[stage] for stage in frame_bytes}, name=n_rows)
+        print(f"Peak memory per stage as a multiple of the frame of the stage:\n{self.peak_memory.round(2).to_string()}")
+
+        if self.memory_headroom is None or n_rows < self.memory_check_rows:
+            return
+
+        bounds = pd.Series(self.expected_memory_ratios) + self.memory_headroom
+        exceeded = self.peak_memory[self.peak_memory > bounds[self.peak_memory.index]]
+        if not exceeded.empty:
+            raise RuntimeError(
+                f"The peak memory of {list(exceeded.index)} exceeds the expected multiple of the frame of the stage "
+                f"plus {self.memory_headroom} at {n_rows} rows:\n{pd.concat([exceeded, bounds[exceeded.index]], axis=1, keys=['peak', 'bound']).round(2)}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the ETL stages and the scouting file on synthetic Wyscout data.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="The numbers of player seasons.")
+    parser.add_argument("--work-dir", default=os.path.join("storage", "benchmark"), help="The directory for the archives and outputs.")
+    parser.add_argument("--n-workers", type=int, default=1, help="The number of workers used to parse the exports.")
+    parser.add_argument("--skip-excel", action="store_true", help="Don't time the scouting file.")
+    parser.add_argument("--memory-headroom", type=float, default=0.75, help="Fail when a stage peaks this far above its expected multiple of its frame.")
+    parser.add_argument("--skip-memory", action="store_true", help="Don't measure the peak memory of the stages, for timings without tracemalloc.")
+    args = parser.parse_args()
+
+    benchmark = StageBenchmark(
+        work_dir=args.work_dir,
+        n_workers=args.n_workers,
+        include_excel=not args.skip_excel,
+        track_memory=not args.skip_memory,
+        memory_headroom=None if args.skip_memory else args.memory_headroom,
+    )
+    print(benchmark.run(args.scales).round(2).to_string())
@@ -0,0 +1,252 @@
+import pandas as pd
+import numpy as np
+import os
+
+from config.wyscout_column_info import wyscout_score_columns, wyscout_team_season_columns, wyscout_personal_columns, wyscout_pilot_columns
+from config.pos_translation import pos_translation_dict
+
+
+class SyntheticWyscoutData:
+    """
+    A class for generating synthetic Wyscout player season exports and a matching league id workbook.
+
+    The exports follow the layout in config/wyscout_column_info.py, so they can be processed by the
+    ETL without the licence-restricted Wyscout data. Every league-season gets its own export with
+    `n_players` players. The values are drawn from plausible distributions (per 90 averages, percentages
+    between 0 and 100, counts, dates and positions), they are not meant to resemble real players.
+
+    Attributes:
+        n_players (int): The number of players per league-season.
+        n_leagues (int): The number of leagues.
+        n_seasons (int): The number of seasons per league.
+        first_year (int): The first season year.
+        seed (int): The seed of the random generator.
+
+    Methods:
+        __init__(n_players, n_leagues, n_seasons, first_year, seed): Initializes the SyntheticWyscoutData class.
+        from_rows(n_rows, n_seasons, seed): Creates a generator with about n_rows player seasons in total.
+        write(target_dir): Writes the exports and the league id workbook.
+        create_league_info(): Creates the league id workbook as a DataFrame.
+        create_export(league, year, league_id, rng): Creates the export of one league-season.
+        _get_export_columns(): Determines the columns of an export.
+        _create_score_column(column, n, rng): Draws the values of a score column.
+    """
+
+    # These columns come from the league id workbook and are not part of the exports
+    league_info_columns = ["league_country", "league_competition", "division", "start_moment", "year"]
+
+    # Positions used by Wyscout, the empty position of pos_translation_dict is left out
+    positions = [i for i in pos_translation_dict if i]
+
+    countries = ["England", "Spain", "Italy", "Germany", "France", "Netherlands", "Belgium", "Portugal", "Denmark", "Sweden",
+                 "Norway", "Austria", "Switzerland", "Scotland", "Poland", "Czech Republic", "Croatia", "Serbia", "Greece", "Turkey"]
+
+    first_names = ["Luca", "Jonas", "Mateo", "Noah", "Émile", "Joško", "Søren", "Tomás", "Ilir", "Kacper", "Bruno", "Thijs", "Yusuf", "Anders"]
+    last_names = ["Jansen", "García", "Rossi", "Müller", "Dubois", "Kovačić", "Nielsen", "Silva", "Novak", "Öztürk", "Peeters", "Berg"]
+
+    def __init__(self, n_players: int = 500, n_leagues: int = 10, n_seasons: int = 3, first_year: int = 2021, seed: int = 0) -> None:
+        """
+        Initialize the SyntheticWyscoutData class.
+
+        Args:
+            n_players (int): The number of players per league-season. Defaults to 500.
+            n_leagues (int): The number of leagues. Defaults to 10.
+            n_seasons (int): The number of seasons per league. Defaults to 3.
+            first_year (int): The first season year. Defaults to 2021.
+            seed (int): The seed of the random generator. Defaults to 0.
+        """
+        self.n_players = n_players
+        self.n_leagues = n_leagues
+        self.n_seasons = n_seasons
+        self.first_year = first_year
+        self.seed = seed
+
+    @classmethod
+    def from_rows(cls, n_rows: int, n_seasons: int = 3, seed: int = 0) -> "SyntheticWyscoutData":
+        """
+        Create a generator with about `n_rows` player seasons in total, spread over a number of leagues
+        that grows with the number of rows (around 500 players per league-season, at most 100 leagues).
+
+        Args:
+            n_rows (int): The total number of player seasons.
+            n_seasons (int): The number of seasons per league. Defaults to 3.
+            seed (int): The seed of the random generator. Defaults to 0.
+
+        Returns:
+            SyntheticWyscoutData: The configured generator.
+        """
+        n_leagues = int(np.clip(n_rows // (n_seasons * 500), 1, 100))
+        n_players = max(1, int(np.ceil(n_rows / (n_leagues * n_seasons))))
+
+        return cls(n_players=n_players, n_leagues=n_leagues, n_seasons=n_seasons, seed=seed)
+
+    def write(self, target_dir: str) -> tuple[str, str]:
+        """
+        Write one export per league-season and the league id workbook.
+
+        Args:
+            target_dir (str): The directory to write to.
+
+        Returns:
+            tuple[str, str]: The directory containing the exports and the path of the league id workbook.
+        """
+        source_path = os.path.join(target_dir, "player_season_stats")
+        league_info_path = os.path.join(target_dir, "league_id_main_competitions.xlsx")
+        os.makedirs(source_path, exist_ok=True)
+
+        league_info = self.create_league_info()
+        league_info.to_excel(league_info_path, index=False)
+
+        rng = np.random.default_rng(self.seed)
+
+        for _, league in league_info.iterrows():
+            for year in range(self.first_year, self.first_year + self.n_seasons):
+                league_id = league[f"league_id_{year}"]
+                df = self.create_export(league, year, league_id, rng)
+
+                df.to_csv(os.path.join(source_path, f"players_{league_id}.csv"), index=False, float_format="%.2f")
+
+        return source_path, league_info_path
+
+    def create_league_info(self) -> pd.DataFrame:
+        """
+        Create the league id workbook: one row per league with a league_id_<year> column per season.
+
+        Returns:
+            pd.DataFrame: The league information.
+        """
+        rows = []
+        for i in range(self.n_leagues):
+            row = {
+                "league_country": self.countries[i % len(self.countries)],
+                "league_competition": f"League {i // len(self.countries) + 1}",
+                "division": i // len(self.countries) + 1,
+                "start_moment": "August" if i % 3 else "January",
+            }
+
+            for j, year in enumerate(range(self.first_year, self.first_year + self.n_seasons)):
+                row[f"league_id_{year}"] = 100000 + i * 100 + j
+
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def create_export(self, league: pd.Series, year: int, league_id: int, rng: np.random.Generator) -> pd.DataFrame:
+        """
+        Create the export of one league-season.
+
+        Args:
+            league (pd.Series): The row of the league in the league id workbook.
+            year (int): The season year.
+            league_id (int): The Wyscout id of the league-season.
+            rng (np.random.Generator): The random generator.
+
+        Returns:
+            pd.DataFrame: The export, with the columns in the Wyscout layout.
+        """
+        n = self.n_players
+        columns = {}
+
+        # Team and season information, 20 teams per league
+        team_numbers = rng.integers(1, 21, n)
+        columns["domestic_competition_name"] = np.full(n, f"{league['league_country']} {league['league_competition']}")
+        columns["current_team_name"] = [f"{league['league_country']} FC {i}" for i in team_numbers]
+        columns["current_team_color"] = rng.choice(["red", "blue", "white", "black", "green"], n)
+        columns["current_team_logo"] = [f"https://example.com/logos/{league_id}_{i}.png" for i in team_numbers]
+        columns["last_club_name"] = np.where(rng.random(n) < 0.02, None, columns["current_team_name"])
+        columns["league_id"] = np.full(n, league_id)
+
+        # Personal information
+        birth_dates = pd.to_datetime("1985-01-01") + pd.to_timedelta(rng.integers(0, 365 * 22, n), unit="D")
+        first_names = rng.choice(self.first_names, n)
+        last_names = rng.choice(self.last_names, n)
+        positions = rng.choice(self.positions, (n, 3))
+        birth_countries = rng.choice(self.countries, n)
+
+        columns["id"] = league_id * 10000 + np.arange(n)
+        columns["full_name"] = [f"{i} {j}" for i, j in zip(first_names, last_names)]
+        columns["name"] = [f"{i[0]}. {j}" for i, j in zip(first_names, last_names)]
+        columns["birth_date"] = birth_dates.strftime("%Y-%m-%d")
+        columns["birth_day"] = columns["birth_date"]
+        columns["age"] = year - birth_dates.year
+        columns["image"] = [f"https://example.com/players/{i}.png" for i in columns["id"]]
+        columns["birth_country_name"] = birth_countries
+        columns["birth_country_code"] = [i[:3].upper() for i in birth_countries]
+        columns["passport_country_codes1"] = columns["birth_country_code"]
+        columns["passport_country_codes2"] = np.where(rng.random(n) < 0.2, rng.choice(["NLD", "ESP", "FRA"], n), None)
+        columns["passport_country_codes"] = columns["birth_country_code"]
+        columns["passport_country_names"] = birth_countries
+        columns["passport_country_names1"] = birth_countries
+        columns["passport_country_names2"] = np.where(pd.isna(columns["passport_country_codes2"]), None, "Netherlands")
+        columns["positions"] = [", ".join(i) for i in positions]
+        columns["positions1"] = positions[:, 0]
+        columns["positions2"] = positions[:, 1]
+        columns["positions3"] = positions[:, 2]
+        columns["primary_position"] = positions[:, 0]
+        columns["primary_position_percent"] = rng.integers(40, 101, n)
+        columns["secondary_position"] = positions[:, 1]
+        columns["secondary_position_percent"] = rng.integers(0, 40, n)
+        columns["third_position"] = positions[:, 2]
+        columns["third_position_percent"] = rng.integers(0, 20, n)
+        columns["contract_expires"] = [f"{i}-06-30" for i in rng.integers(year + 1, year + 5, n)]
+        columns["market_value"] = rng.integers(1, 400, n) * 50000
+        columns["total_matches"] = rng.integers(1, 39, n)
+        columns["minutes_on_field"] = columns["total_matches"] * rng.integers(10, 91, n)
+        columns["foot"] = rng.choice(["right", "left", "both"], n, p=[0.7, 0.25, 0.05])
+        columns["height"] = rng.integers(165, 200, n)
+        columns["weight"] = rng.integers(60, 95, n)
+        columns["on_loan"] = rng.random(n) < 0.1
+
+        # Score columns
+        for column in wyscout_score_columns:
+            columns[column] = self._create_score_column(column, n, rng)
+
+        # The possession adjusted values are the averages scaled by the possession of the team
+        possession = rng.uniform(0.35, 0.65, n)
+        columns["possession_adjusted_interceptions"] = np.round(columns["interceptions_avg"] * 1.5 / (2 * (1 - possession)), 2)
+        columns["possession_adjusted_tackle"] = np.round(columns["tackle_avg"] * 1.5 / (2 * (1 - possession)), 2)
+
+        # The pilot columns are only measured in some leagues, 0 means not measured
+        measured = league_id % 3 == 0
+        for column in wyscout_pilot_columns:
+            columns[column] = np.round(rng.gamma(4, 2, n), 2) if measured else np.zeros(n)
+
+        return pd.DataFrame(columns)[self._get_export_columns()]
+
+    def _get_export_columns(self) -> list[str]:
+        """
+        Determine the columns of an export: the Wyscout layout without the columns of the league id workbook.
+
+        Returns:
+            list[str]: The export columns.
+        """
+        layout_columns = wyscout_team_season_columns + wyscout_personal_columns + wyscout_score_columns + wyscout_pilot_columns
+
+        return [i for i in layout_columns if i not in self.league_info_columns]
+
+    def _create_score_column(self, column: str, n: int, rng: np.random.Generator) -> np.ndarray:
+        """
+        Draw the values of a score column, based on the kind of statistic its name indicates.
+
+        Args:
+            column (str): The name of the score column.
+            n (int): The number of values.
+            rng (np.random.Generator): The random generator.
+
+        Returns:
+            np.ndarray: The values, with about 2% missing values for percentages.
+        """
+        if column.endswith(("_percent", "_won")):
+            values = np.round(rng.uniform(0, 100, n), 2)
+            return np.where(rng.random(n) < 0.02, np.nan, values)
+
+        if column in ("average_pass_length", "average_long_pass_length"):
+            return np.round(rng.normal(18 if column == "average_pass_length" else 35, 3, n), 2)
+
+        if column.startswith("prevented_goals"):
+            return np.round(rng.normal(0, 1, n), 2)
+
+        if column.endswith("_avg") or column.startswith("xg_"):
+            return np.round(rng.gamma(1.5, 1.0, n), 2)
+
+        return rng.poisson(2, n).astype("float64")
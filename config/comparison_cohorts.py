@@ -0,0 +1,16 @@
+# The cohorts players are compared within, by name, as the columns defining the cohort. The players are
+# always compared within the default cohort, which gives the zscore_ and quantile_ columns the KPIs are
+# calculated from. Every other cohort selected with create_general_db(cohorts=[...]) adds columns
+# prefixed with its name, e.g. position_zscore_passes_avg.
+default_comparison_cohort = "competition"
+
+comparison_cohorts = {
+    # The players of the same competition and main position, over all seasons
+    "competition": ["division", "league_country", "league_competition", "main_position"],
+    # The players of the same competition and main position in the same season
+    "season": ["division", "league_country", "league_competition", "year", "main_position"],
+    # The players of the same division tier and main position, over all leagues
+    "division": ["division", "main_position"],
+    # The players of the same main position, over all leagues
+    "position": ["main_position"],
+}
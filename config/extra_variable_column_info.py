@@ -25,6 +25,54 @@ succeed_actions_variables = [
     ['offensive_physical_duels', 'offensive_physical_duels_won']
 ]
 
+# Derived metrics calculated by GetExtraFeatures. Every metric is a pandas expression over base columns or
+# other derived metrics, the metrics are evaluated in dependency order. Optional settings per metric:
+# - fill_inputs: the value per input column that missing values are filled with before evaluating
+# - clip: the (lower, upper) bounds of the result, None for no bound
+# - round: the number of decimals the result is rounded to
+# - fill: the value missing results are filled with
+# - anchor: the column the metric is placed next to, metrics without an anchor are placed at the end
+derived_metric_definitions = {
+    # Successful actions, e.g. the number of accurate crosses from the crosses and the cross accuracy
+    **{
+        "succeed_" + numerical_variable: {
+            "expression": f"{numerical_variable} * ({percentage_variable} / 100)",
+            "round": 2,
+            "anchor": numerical_variable,
+        }
+        for numerical_variable, percentage_variable in succeed_actions_variables
+    },
+
+    # Differences between x and expected x
+    "xg_assists-assists": {"expression": "xg_assist_avg - assists_avg", "anchor": "xg_assist_avg"},
+    "goals-xg_goals_avg": {"expression": "goals_avg - xg_shot_avg", "anchor": "goals_avg"},
+    "non_pen_goals-xg_goals_avg": {
+        "expression": "non_penalty_goal_avg - (xg_shot_avg - ((goals_avg - non_penalty_goal_avg) * 0.76))",
+        "anchor": "non_penalty_goal_avg",
+    },
+
+    # Eagerness to perform an action when receiving the ball
+    "run_eagerness": {
+        "expression": "(accelerations_avg + progressive_run_avg) / received_pass_avg",
+        "fill_inputs": {"accelerations_avg": 0, "progressive_run_avg": 0},
+        "anchor": "progressive_run_avg",
+    },
+    "dribble_eagerness": {"expression": "dribbles_avg / received_pass_avg", "fill_inputs": {"dribbles_avg": 0}, "anchor": "dribbles_avg"},
+    "forward_pass_eagerness": {"expression": "forward_passes_avg / received_pass_avg", "fill_inputs": {"forward_passes_avg": 0}, "anchor": "forward_passes_avg"},
+    "shot_eagerness": {"expression": "shots_avg / received_pass_avg", "fill_inputs": {"shots_avg": 0}, "anchor": "shots_avg"},
+    "cross_eagerness": {"expression": "crosses_avg / received_pass_avg", "fill_inputs": {"crosses_avg": 0}, "anchor": "crosses_avg"},
+
+    # Expected goals per shot
+    "shot_location_quality": {"expression": "xg_shot_avg / shots_avg", "fill_inputs": {"xg_shot_avg": 0, "shots_avg": 0}, "anchor": "xg_shot_avg"},
+
+    # Share of the passes that is progressive
+    "forward_passes_ratio": {"expression": "forward_passes_avg / passes_avg"},
+    "key_passes_ratio": {"expression": "key_passes_avg / passes_avg"},
+    "through_passes_ratio": {"expression": "through_passes_avg / passes_avg"},
+    "passes_to_final_third_ratio": {"expression": "passes_to_final_third_avg / passes_avg"},
+    "pass_to_penalty_area_ratio": {"expression": "pass_to_penalty_area_avg / passes_avg"},
+}
+
 in_possession_variables =  ["successful_attacking_actions_avg", "goals_avg", "non_penalty_goal_avg", "xg_shot_avg", "head_goals_avg", "shots_avg", "assists_avg", "crosses_avg",
                             "cross_from_left_avg", "cross_from_right_avg", "cross_to_goalie_box_avg", "dribbles_avg", "offensive_duels_avg", 'offensive_physical_duels', 'succeed_offensive_physical_duels',"touch_in_box_avg", "progressive_run_avg",
                             "accelerations_avg", "received_pass_avg", "received_long_pass_avg", "passes_avg", "forward_passes_avg", "back_passes_avg", "vertical_passes_avg", 
@@ -67,4 +67,16 @@ pos_translation_dict = {
     'RCB3': "CB",
     'GK': "GK",
     ''  : 'UNKNOWN'
-}
\ No newline at end of file
+}
+
+# Columns that are not used by any of the pipeline steps or reports, these are not read unless all columns are kept
+wyscout_unused_columns = ['image', 'current_team_logo', 'current_team_color']
+
+# Columns with a small number of repeated values, these are stored as categoricals
+wyscout_categorical_columns = ['domestic_competition_name', 'current_team_name', 'current_team_color', 'current_team_logo', 'last_club_name', 'division',
+                       'league_country', 'year', 'start_moment', 'league_competition', 'birth_country_name', 'birth_country_code', 'passport_country_codes1',
+                       'passport_country_codes2', 'passport_country_codes', 'passport_country_names', 'passport_country_names1', 'passport_country_names2',
+                       'positions', 'positions1', 'positions2', 'positions3', 'primary_position', 'secondary_position', 'third_position', 'foot']
+
+# Columns containing counts, these are stored as nullable integers
+wyscout_count_columns = ['age', 'total_matches', 'minutes_on_field', 'height', 'weight']
@@ -8,38 +8,83 @@ from datetime import datetime
 from openpyxl.styles import Font, PatternFill
 
 from wyscout_etl.calculate_totals import CalculateKPI
+from wyscout_etl.wyscout_db import WyscoutDatabase
 
 
 class ScoutingExcel:
 
+    # The player information shown in front of the scores on every sheet
+    general_variables = [
+        "full_name",
+        "birth_date",
+        "birth_country_name",
+        "foot",
+        "passport_country_names1",
+        "height",
+        "last_club_name",
+        "division",
+        "league_country",
+        "league_competition",
+        "total_matches",
+        "minutes_on_field",
+        "main_position",
+        "primary_position",
+    ]
+
     def __init__(self):
         pass
 
+    def create_scouting_excel_from_db(self, db_path, sink_path, kpi_method = "general.py", general_variables = None, filters = None):
+
+        if general_variables is None:
+            general_variables = self.general_variables
+
+        database = WyscoutDatabase()
+        kpi_scoring_values = CalculateKPI()._import_variables_from_script(kpi_method)[1]
+
+        # Only load the columns the sheets use and the partitions matching the filters,
+        # e.g. filters={"league_country": ["Spain", "Italy"], "year": 2024}
+        columns = self._get_required_columns(database.get_columns(db_path), kpi_scoring_values, general_variables)
+        df = database.load(db_path, columns=columns, filters=filters)
+
+        # Excel cells need plain floats, not single precision or nullable integers
+        to_float_columns = [i for i in df.columns if df[i].dtype == "float32" or isinstance(df[i].dtype, pd.Int64Dtype)]
+        df[to_float_columns] = df[to_float_columns].astype("float64")
+
+        self._create_scouting_excel(df, sink_path, kpi_method=kpi_method, general_variables=general_variables)
+
+    def _get_required_columns(self, available_columns, kpi_scoring_values, general_variables):
+
+        columns = list(general_variables)
+
+        for metric in ["zscore", "quantile"]:
+            columns += [f"avg_{metric}_{i}" for i in kpi_scoring_values]
+            columns += [f"avg_{metric}_{i}_padj" for i in kpi_scoring_values]
+            columns += [f"weighted_{metric}_total", f"weighted_{metric}_total_padj"]
+
+            for variables in kpi_scoring_values.values():
+                for variable in variables:
+                    columns.append(f"{metric}_{variable}")
+
+                    if f"{metric}_{variable}_padj" in available_columns:
+                        columns.append(f"{metric}_{variable}_padj")
+
+        # Remove duplicates while keeping the order
+        return list(dict.fromkeys(columns))
+
     def _create_scouting_excel(
         self,
         df, 
         sink_path, 
         kpi_method = "general.py",
-        general_variables=[
-            "full_name",
-            "birth_date",
-            "birth_country_name",
-            "foot",
-            "passport_country_names1",
-            "height",
-            "last_club_name",
-            "division",
-            "league_country",
-            "league_competition",
-            "total_matches",
-            "minutes_on_field",
-            "main_position",
-            "primary_position",
-        ],
+        general_variables = None,
     ):
         
-        
-        df = df[df["minutes_on_field"] > 46]
+        if general_variables is None:
+            general_variables = self.general_variables
+
+        # Players without registered minutes are dropped as well
+        df = df[(df["minutes_on_field"] > 46).fillna(False)]
 
         # Clean name and age 
         df["full_name"] = df["full_name"].apply(self._clean_name)
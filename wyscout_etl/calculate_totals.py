@@ -15,13 +15,15 @@ class CalculateKPI():
                             df, 
                             kpi_method, 
                             standardize = True,
-                            quantilize = True
+                            quantilize = True,
+                            fill_values = None
                             ):
 
 
+        # Contract: the KPI columns are added to df in place
         importance_values, kpi_scoring_values, total_score_values = self._import_variables_from_script(kpi_method)
 
-        df = self._calculate_kpi_scores(df, kpi_scoring_values, standardize, quantilize)
+        df = self._calculate_kpi_scores(df, kpi_scoring_values, standardize, quantilize, fill_values)
 
         df = self._weighted_totals_calculation(df, total_score_values, importance_values)
 
@@ -29,9 +31,9 @@ class CalculateKPI():
         return df
 
     def _import_variables_from_script(self, kpi_method):
-        script_base_path = "config\kpi_methods\\" 
+        script_base_path = os.path.join("config", "kpi_methods")
 
-        script_path = script_base_path + kpi_method
+        script_path = os.path.join(script_base_path, kpi_method)
 
         # Get the absolute path of the script
         script_path = os.path.abspath(script_path)
@@ -61,7 +63,7 @@ class CalculateKPI():
             
 
         
-    def _calculate_kpi_scores(self, df, score_dict, standardize, quantile):
+    def _calculate_kpi_scores(self, df, score_dict, standardize, quantile, fill_values=None):
         """
         Calculates KPI scores based on z-scores and quantiles, with options to standardize and adjust quantiles.
         
@@ -70,6 +72,8 @@ class CalculateKPI():
         score_dict (dict): Dictionary containing the weights for each KPI in different subcategories.
         standardize (bool): Flag to indicate whether z-scores should be calculated.
         quantile (bool): Flag to indicate whether quantiles should be calculated.
+        fill_values (dict): Value per column to fill missing scores with. When None, the minimum of the
+                            column in `df` is used. Needed when `df` is only a part of the dataset.
         
         Returns:
         pd.DataFrame: DataFrame with added KPI score columns.
@@ -78,13 +82,16 @@ class CalculateKPI():
 
         df_orig_columns = df.columns.tolist()
 
+        def fill_value(column):
+            return df[column].min() if fill_values is None else fill_values[column]
+
         def calculate_scores(metric, prefix, sub_cat, temp_score_dict):
             for column, weight in temp_score_dict.items():
-                df[f'{prefix}_{sub_cat}'] += weight * df[f'{metric}_{column}'].fillna(df[f'{metric}_{column}'].min())
+                df[f'{prefix}_{sub_cat}'] += weight * df[f'{metric}_{column}'].fillna(fill_value(f'{metric}_{column}'))
                 df[f'{prefix}_{sub_cat}'] = np.round(df[f'{prefix}_{sub_cat}'], 2)
 
                 adj_column = f'{column}_padj' if f'{column}_padj' in df.columns else column
-                df[f'{prefix}_{sub_cat}_padj'] += weight * df[f'{metric}_{adj_column}'].fillna(df[f'{metric}_{adj_column}'].min())
+                df[f'{prefix}_{sub_cat}_padj'] += weight * df[f'{metric}_{adj_column}'].fillna(fill_value(f'{metric}_{adj_column}'))
                 df[f'{prefix}_{sub_cat}_padj'] = np.round(df[f'{prefix}_{sub_cat}_padj'], 2)
 
         if standardize:
@@ -103,65 +110,72 @@ class CalculateKPI():
     
 
     def _weighted_totals_calculation(self, df, scoring_dict, importance_values):
+        """
+        Calculates the weighted total scores per player, from the KPIs of the position the player's
+        primary position maps to. The players are handled per mapped position with column operations.
+        Players without a (mapped) primary position get no total score.
 
-        def calculate_total_scores(row, columns, weight):
-            """
-            Calculate weighted scores for given columns in a row.
-            """
-            return weight * row[columns].sum()
-
+        Parameters:
+        df (pd.DataFrame): The DataFrame containing the KPI score columns.
+        scoring_dict (dict): The KPIs per importance level per position.
+        importance_values (dict): The weight per importance level.
 
-        zscore_scores = []
-        quantile_scores = []
-        zscore_scores_padj = []
-        quantile_scores_padj = []
+        Returns:
+        pd.DataFrame: DataFrame with the weighted total columns added.
+        """
 
-        for index, row in df.iterrows():
-            if pd.isna(row['primary_position']):
-                zscore_scores.append(np.nan)
-                quantile_scores.append(np.nan)
-                zscore_scores_padj.append(np.nan)
-                quantile_scores_padj.append(np.nan)
-                continue
+        mapped_positions = df['primary_position'].astype(object).map(pos_translation_dict)
 
-            input_position = row['primary_position']
-            mapped_value = pos_translation_dict.get(input_position)
+        totals = {
+            'weighted_zscore_total': ('avg_zscore_', ''),
+            'weighted_zscore_total_padj': ('avg_zscore_', '_padj'),
+            'weighted_quantile_total': ('avg_quantile_', ''),
+            'weighted_quantile_total_padj': ('avg_quantile_', '_padj'),
+        }
+        total_scores = {name: np.full(len(df), np.nan) for name in totals}
 
-            total_zscore = 0
-            total_quantile_score = 0
-            total_zscore_padj = 0
-            total_quantile_score_padj = 0
-            total_weight = 0
+        for mapped_value in mapped_positions.dropna().unique():
+            rows = (mapped_positions == mapped_value).to_numpy()
+            position_df = df[rows]
+            temp_scoring_dict = scoring_dict[mapped_value]
 
-            if mapped_value is not None:
-                temp_scoring_dict = scoring_dict[mapped_value]
+            for name, (prefix, suffix) in totals.items():
+                total_score = 0
+                total_weight = 0
 
                 for importance_level, columns in temp_scoring_dict.items():
-                    zscore_columns = [f'avg_zscore_{col}' for col in columns]
-                    quantile_columns = [f'avg_quantile_{col}' for col in columns]
-                    zscore_columns_padj = [f'avg_zscore_{col}_padj' for col in columns]
-                    quantile_columns_padj = [f'avg_quantile_{col}_padj' for col in columns]
-
                     weight = importance_values.get(importance_level, 0)
 
+                    total_score = total_score + weight * self._sum_columns(position_df, [f'{prefix}{col}{suffix}' for col in columns])
+                    total_weight += weight * len(columns)
 
-                    total_zscore += calculate_total_scores(row, zscore_columns, weight)
-                    total_zscore_padj += calculate_total_scores(row, zscore_columns_padj, weight)
+                if total_weight:
+                    total_scores[name][rows] = np.round(total_score / total_weight, 2)
 
-                    total_quantile_score += calculate_total_scores(row, quantile_columns, weight)
-                    total_quantile_score_padj += calculate_total_scores(row, quantile_columns_padj, weight)
+        df['weighted_zscore_total'] = total_scores['weighted_zscore_total']
+        df['weighted_zscore_total_padj'] = total_scores['weighted_zscore_total_padj']
 
-                    total_weight += weight * len(columns)
+        df['weighted_quantile_total'] = total_scores['weighted_quantile_total']
+        df['weighted_quantile_total_padj'] = total_scores['weighted_quantile_total_padj']
 
-            zscore_scores.append(np.round((total_zscore / total_weight if total_weight else np.nan), 2))
-            quantile_scores.append(np.round((total_quantile_score / total_weight if total_weight else np.nan), 2))
-            zscore_scores_padj.append(np.round((total_zscore_padj / total_weight if total_weight else np.nan), 2))
-            quantile_scores_padj.append(np.round((total_quantile_score_padj / total_weight if total_weight else np.nan), 2))
+        return df
 
-        df['weighted_zscore_total'] = zscore_scores
-        df['weighted_zscore_total_padj'] = zscore_scores_padj
+    def _sum_columns(self, df, columns):
+        """
+        Sums columns per row, skipping missing values. The columns are added one by one, from left to
+        right, so the result is exactly the same as summing the values of one row.
 
-        df['weighted_quantile_total'] = quantile_scores
-        df['weighted_quantile_total_padj'] = quantile_scores_padj
+        Parameters:
+        df (pd.DataFrame): The DataFrame containing the columns.
+        columns (list): The columns to sum.
 
-        return df
+        Returns:
+        np.ndarray: The sum per row.
+        """
+
+        total = np.zeros(len(df))
+        for i, column in enumerate(columns):
+            values = df[column].fillna(0).to_numpy(dtype='float64')
+            total = values if i == 0 else total + values
+
+        return total
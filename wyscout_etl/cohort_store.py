@@ -0,0 +1,313 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+import re
+import shutil
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from wyscout_etl.frame_cache import FrameCache
+from wyscout_etl.group_statistics import GroupStatistics
+
+
+class CohortStatisticsStore:
+    """
+    A class for persisting the statistics of the comparison cohorts, so the player comparisons can be
+    updated incrementally.
+
+    A cohort is a comparison group: the players of one competition and main position, over all
+    seasons. Per cohort and compared column the store keeps the mean and standard deviation, the
+    percentile ranks of the rows of the cohort and a fingerprint of the values of those rows. Every
+    run fingerprints all values and reads the stored percentile ranks. When new exports arrive, only
+    the cohorts whose fingerprints changed are aggregated and ranked again, from all their rows, e.g.
+    the cohorts of the league of a new season. The percentile ranks of the other cohorts are taken from
+    the store and the z-scores of all rows follow from the stored mean and standard deviation. The
+    results are the same as those of comparing all rows from scratch.
+
+    A changed cohort isn't updated with only its new rows: the ranks of its existing rows change as
+    well, and the mean and standard deviation are the two-pass values of pandas, which can't be
+    updated exactly from running sums.
+
+    Every cohort is stored in its own Parquet file, so an update only rewrites the files of the
+    changed cohorts. A store is kept per name (e.g. per comparison stage) and configuration, changing
+    the configuration starts a new store.
+
+    The fingerprints are 64-bit hashes of the values and their order within the cohort, a collision
+    would keep the statistics of a cohort that changed.
+
+    Attributes:
+        name (str): The name of the store.
+        cache_dir (str): The directory in which the stores are kept.
+        config_objects (list): The configuration objects (lists, dicts, strings) the cohorts depend on.
+
+    Methods:
+        __init__(name, cache_dir, config_objects): Initializes the CohortStatisticsStore class.
+        compare(df, columns, statistics): Calculates the z-scores and percentile ranks, updating the store.
+        get_statistics(): Loads the mean and standard deviation per cohort and column.
+        _get_store_dir(): Gets the directory of the store for the configuration.
+        _get_cohort_ids(df, statistics): Creates the identifier of every cohort.
+        _get_fingerprints(df, columns, statistics): Creates the fingerprint of every cohort and column.
+        _get_cohort_table(cohort_id, group, columns, dtypes, fingerprints, moments, quantiles, statistics): Creates the statistics of one cohort.
+        _load(store_dir): Loads the stored cohorts.
+        _write(store_dir, cohort_id, table): Writes the file of one cohort.
+    """
+
+    # The moments the z-scores follow from, the moments kept per cohort and column
+    stored_moments = ["mean", "std"]
+
+    def __init__(self, name: str, cache_dir: str = os.path.join("storage", "cache", "cohorts"), config_objects: list = ()) -> None:
+        """
+        Initialize the CohortStatisticsStore class.
+
+        Args:
+            name (str): The name of the store.
+            cache_dir (str): The directory in which the stores are kept. Defaults to 'storage/cache/cohorts'.
+            config_objects (list): The configuration objects the cohorts depend on. Defaults to none.
+        """
+        self.name = name
+        self.cache_dir = cache_dir
+        self.config_objects = list(config_objects)
+
+
+    def compare(self, df: pd.DataFrame, columns: list[str], statistics: GroupStatistics) -> tuple[dict, dict]:
+        """
+        Calculate the z-scores and percentile ranks of float columns within the cohorts. The changed
+        cohorts are aggregated again and stored, the removed cohorts are removed from the store.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the group columns and the columns to compare.
+            columns (list[str]): The float32 or float64 columns to compare.
+            statistics (GroupStatistics): The groups of the rows of df.
+
+        Returns:
+            tuple[dict, dict]: The z-scores and the percentile ranks per column, as arrays.
+        """
+        store_dir = self._get_store_dir()
+        cohort_ids = self._get_cohort_ids(df, statistics)
+        fingerprints = self._get_fingerprints(df, columns, statistics)
+        dtypes = np.array([str(df[i].dtype) for i in columns])
+        sizes = np.diff(statistics.bounds)
+
+        # A stored cohort and column is kept when its dtype, number of rows and fingerprint are unchanged
+        stored = self._load(store_dir)
+        stored_df = stored.select(["cohort_id", "column", "dtype", "fingerprint"] + self.stored_moments).to_pandas()
+        stored_quantiles = stored.column("quantiles").combine_chunks()
+        stored_sizes = stored_quantiles.value_lengths().to_numpy(zero_copy_only=False)
+        stored_groups = pd.Index(cohort_ids).get_indexer(stored_df["cohort_id"])
+        stored_columns = pd.Index(columns).get_indexer(stored_df["column"])
+
+        kept = (stored_groups >= 0) & (stored_columns >= 0)
+        kept[kept] = (
+            (stored_df["dtype"].to_numpy()[kept] == dtypes[stored_columns[kept]])
+            & (stored_df["fingerprint"].to_numpy()[kept] == fingerprints[stored_groups[kept], stored_columns[kept]])
+            & (stored_sizes[kept] == sizes[stored_groups[kept]])
+        )
+
+        # A cohort is aggregated again when any of its columns changed
+        unchanged = np.zeros(fingerprints.shape, dtype=bool)
+        unchanged[stored_groups[kept], stored_columns[kept]] = True
+        changed_groups = np.flatnonzero(~unchanged.all(axis=1))
+        kept &= np.isin(stored_groups, changed_groups, invert=True)
+        print(f"Aggregating {len(changed_groups)} of {statistics.n_groups} cohorts again")
+
+        moments = {name: np.full(fingerprints.shape, np.nan) for name in self.stored_moments}
+        for name in self.stored_moments:
+            moments[name][stored_groups[kept], stored_columns[kept]] = stored_df[name].to_numpy()[kept]
+
+        # The percentile ranks of the rows of the kept cohorts, in the order of statistics.order
+        quantiles = np.full((len(statistics.order), len(columns)), np.nan)
+        offsets = np.concatenate([[0], np.cumsum(stored_sizes)])
+        kept_rows = np.repeat(kept, stored_sizes)
+        row_positions = np.arange(offsets[-1]) + np.repeat(statistics.bounds[np.maximum(stored_groups, 0)] - offsets[:-1], stored_sizes)
+        quantiles[row_positions[kept_rows], np.repeat(stored_columns, stored_sizes)[kept_rows]] = (
+            stored_quantiles.flatten().to_numpy(zero_copy_only=False)[kept_rows]
+        )
+
+        # The changed cohorts are aggregated and ranked again per dtype, the z-scores of all rows follow from the moments
+        zscores = {}
+
+        for dtype in ["float64", "float32"]:
+            positions = np.flatnonzero(dtypes == dtype)
+            if not len(positions):
+                continue
+
+            values = df[[columns[j] for j in positions]].to_numpy(dtype=dtype)
+
+            block_moments = statistics.get_moments(values, changed_groups)
+            for name in self.stored_moments:
+                moments[name][np.ix_(changed_groups, positions)] = block_moments[name][changed_groups]
+
+            changed_rows = np.isin(statistics.codes[statistics.order], changed_groups)
+            block_quantiles = statistics.get_quantiles(values, changed_groups)[statistics.order]
+            quantiles[np.ix_(changed_rows, positions)] = block_quantiles[changed_rows]
+
+            block_zscores = statistics.get_zscores(values, {name: moments[name][:, positions] for name in self.stored_moments})
+            for k, j in enumerate(positions):
+                zscores[columns[j]] = block_zscores[:, k]
+
+        # The files of the changed cohorts are written again, the files of cohorts without players are removed
+        for group in changed_groups:
+            table = self._get_cohort_table(cohort_ids[group], group, columns, dtypes, fingerprints, moments, quantiles, statistics)
+            self._write(store_dir, cohort_ids[group], table)
+
+        current_files = {f"{i}.parquet" for i in cohort_ids}
+        for file_name in os.listdir(store_dir):
+            if file_name.endswith(".parquet") and file_name not in current_files:
+                os.remove(os.path.join(store_dir, file_name))
+
+        # Back to the order of the rows of df, rows without a cohort have no percentile rank
+        row_quantiles = np.full((len(df), len(columns)), np.nan)
+        row_quantiles[statistics.order] = quantiles
+
+        return zscores, {column: row_quantiles[:, j] for j, column in enumerate(columns)}
+
+    def get_statistics(self) -> pd.DataFrame:
+        """
+        Load the mean and standard deviation per cohort and column.
+
+        Returns:
+            pd.DataFrame: The cohort, column, dtype, fingerprint, mean and standard deviation per cohort and column.
+        """
+        return self._load(self._get_store_dir()).select(["cohort_id", "column", "dtype", "fingerprint"] + self.stored_moments).to_pandas()
+
+    def _get_store_dir(self) -> str:
+        """
+        Get the directory of the store for the configuration, the stores of other configurations with
+        the same name are removed.
+
+        Returns:
+            str: The directory of the store.
+        """
+        fingerprint = FrameCache().fingerprint(config_objects=self.config_objects)
+        store_dir = os.path.join(self.cache_dir, f"{self.name}_{fingerprint}")
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+            old_version = re.compile(rf"{re.escape(self.name)}_[0-9a-f]+")
+            for dir_name in os.listdir(self.cache_dir):
+                if old_version.fullmatch(dir_name) and os.path.join(self.cache_dir, dir_name) != store_dir:
+                    shutil.rmtree(os.path.join(self.cache_dir, dir_name), ignore_errors=True)
+
+        return store_dir
+
+    def _get_cohort_ids(self, df: pd.DataFrame, statistics: GroupStatistics) -> list[str]:
+        """
+        Create a file system safe identifier for every cohort from the values of its group columns.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the group columns.
+            statistics (GroupStatistics): The groups of the rows of df.
+
+        Returns:
+            list[str]: The identifier per group.
+        """
+        first_rows = df[statistics.group_columns].iloc[statistics.order[statistics.bounds[:-1]]].astype(object)
+
+        return [hashlib.sha1("|".join(str(i) for i in key).encode("utf-8")).hexdigest()[:16] for key in first_rows.itertuples(index=False)]
+
+    def _get_fingerprints(self, df: pd.DataFrame, columns: list[str], statistics: GroupStatistics) -> np.ndarray:
+        """
+        Create the fingerprint of every cohort and column: the sum of the hashes of the values, each
+        multiplied by a hash of its position within the cohort.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the columns.
+            columns (list[str]): The columns to fingerprint.
+            statistics (GroupStatistics): The groups of the rows of df.
+
+        Returns:
+            np.ndarray: The fingerprints (groups x columns) as unsigned 64-bit integers.
+        """
+        fingerprints = np.zeros((statistics.n_groups, len(columns)), dtype=np.uint64)
+        if statistics.n_groups == 0:
+            return fingerprints
+
+        # The position of every grouped row within its cohort, hashed to an odd multiplier
+        positions = np.arange(len(statistics.order)) - np.repeat(statistics.bounds[:-1], np.diff(statistics.bounds))
+        weights = pd.util.hash_array(positions.astype(np.uint64)) | np.uint64(1)
+
+        for j, column in enumerate(columns):
+            hashes = pd.util.hash_array(df[column].to_numpy()[statistics.order]) * weights
+            fingerprints[:, j] = np.add.reduceat(hashes, statistics.bounds[:-1])
+
+        return fingerprints
+
+    def _get_cohort_table(
+        self,
+        cohort_id: str,
+        group: int,
+        columns: list[str],
+        dtypes: np.ndarray,
+        fingerprints: np.ndarray,
+        moments: dict,
+        quantiles: np.ndarray,
+        statistics: GroupStatistics,
+    ) -> pa.Table:
+        """
+        Create the statistics of one cohort: a row per column with its mean, standard deviation and the
+        percentile ranks of the rows of the cohort.
+
+        Args:
+            cohort_id (str): The identifier of the cohort.
+            group (int): The group of the cohort.
+            columns (list[str]): The compared columns.
+            dtypes (np.ndarray): The dtype of every column.
+            fingerprints (np.ndarray): The fingerprint per group and column.
+            moments (dict): The mean and standard deviation per group and column.
+            quantiles (np.ndarray): The percentile ranks (rows in the order of statistics.order x columns).
+            statistics (GroupStatistics): The groups of the rows.
+
+        Returns:
+            pa.Table: The statistics of the cohort.
+        """
+        start, end = statistics.bounds[group], statistics.bounds[group + 1]
+
+        return pa.table({
+            "cohort_id": pa.array([cohort_id] * len(columns), type=pa.string()),
+            "column": pa.array(columns, type=pa.string()),
+            "dtype": pa.array(dtypes, type=pa.string()),
+            "fingerprint": pa.array(fingerprints[group], type=pa.uint64()),
+            **{name: pa.array(moments[name][group], type=pa.float64()) for name in self.stored_moments},
+            "quantiles": pa.ListArray.from_arrays(
+                pa.array(np.arange(len(columns) + 1) * (end - start), type=pa.int32()), pa.array(quantiles[start:end].T.ravel(), type=pa.float64())
+            ),
+        })
+
+    def _load(self, store_dir: str) -> pa.Table:
+        """
+        Load the stored cohorts.
+
+        Args:
+            store_dir (str): The directory of the store.
+
+        Returns:
+            pa.Table: The rows of all cohort files, an empty table when nothing is stored.
+        """
+        paths = sorted(os.path.join(store_dir, i) for i in os.listdir(store_dir) if i.endswith(".parquet"))
+        if paths:
+            return ds.dataset(paths, format="parquet").to_table()
+
+        return pa.table({
+            "cohort_id": pa.array([], type=pa.string()),
+            "column": pa.array([], type=pa.string()),
+            "dtype": pa.array([], type=pa.string()),
+            "fingerprint": pa.array([], type=pa.uint64()),
+            **{name: pa.array([], type=pa.float64()) for name in self.stored_moments},
+            "quantiles": pa.array([], type=pa.list_(pa.float64())),
+        })
+
+    def _write(self, store_dir: str, cohort_id: str, table: pa.Table) -> None:
+        """
+        Write the file of one cohort, the file is only replaced once it is completely written.
+
+        Args:
+            store_dir (str): The directory of the store.
+            cohort_id (str): The identifier of the cohort.
+            table (pa.Table): The statistics of the cohort.
+        """
+        path = os.path.join(store_dir, f"{cohort_id}.parquet")
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,103 @@
+import pandas as pd
+
+
+class ColumnPlacementPlan:
+    """
+    A class for placing derived columns next to the column they are derived from.
+
+    Instead of rebuilding the DataFrame for every derived column, the stages add their new
+    columns at the end of the frame and record next to which "brother" column they belong.
+    The recorded placements are applied at the end with a single reindex. The placements are
+    applied in the order they were added, so a column that is placed later next to the same
+    brother column ends up closer to it.
+
+    Attributes:
+        placements (list[tuple[str, str]]): The (brother column, new column) pairs, in order.
+
+    Methods:
+        __init__(): Initializes the ColumnPlacementPlan class.
+        add(brother_column, new_column): Records that a new column belongs next to a brother column.
+        get_column_order(columns): Determines the column order after all placements.
+        apply(df): Reorders the columns of a DataFrame with a single reindex.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize the ColumnPlacementPlan class.
+        """
+        self.placements = []
+
+    def add(self, brother_column: str, new_column: str) -> None:
+        """
+        Record that `new_column` should be placed immediately after `brother_column`.
+
+        Args:
+            brother_column (str): The name of the column next to which the new column will be placed.
+            new_column (str): The name of the column that needs to be repositioned.
+        """
+        self.placements.append((brother_column, new_column))
+
+    def get_column_order(self, columns: list[str]) -> list[str]:
+        """
+        Determine the column order after all placements. Only the column names are moved around.
+
+        The order is kept as a linked list of the (unique) column names, so every placement moves its
+        new column in constant time and the order is read back in one pass over the columns.
+
+        Args:
+            columns (list[str]): The current column order.
+
+        Returns:
+            list[str]: The column order with every new column next to its brother column.
+
+        Raises:
+            ValueError: When a brother or new column is not in the columns.
+        """
+        column_order = list(columns)
+        next_columns = dict(zip(column_order, column_order[1:] + [None]))
+        previous_columns = dict(zip(column_order, [None] + column_order[:-1]))
+        first_column = column_order[0] if column_order else None
+
+        for brother_column, new_column in self.placements:
+            for column in (brother_column, new_column):
+                if column not in next_columns:
+                    raise ValueError(f"'{column}' is not in the columns")
+            if brother_column == new_column:
+                raise ValueError(f"'{new_column}' can't be placed next to itself")
+
+            # Take the new column out of the order
+            previous_column, next_column = previous_columns[new_column], next_columns[new_column]
+            if previous_column is None:
+                first_column = next_column
+            else:
+                next_columns[previous_column] = next_column
+            if next_column is not None:
+                previous_columns[next_column] = previous_column
+
+            # And put it back immediately after the brother column
+            next_column = next_columns[brother_column]
+            next_columns[brother_column] = new_column
+            previous_columns[new_column] = brother_column
+            next_columns[new_column] = next_column
+            if next_column is not None:
+                previous_columns[next_column] = new_column
+
+        column_order = []
+        column = first_column
+        while column is not None:
+            column_order.append(column)
+            column = next_columns[column]
+
+        return column_order
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Reorder the columns of a DataFrame with a single reindex.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the brother and new columns.
+
+        Returns:
+            pd.DataFrame: The DataFrame with every new column next to its brother column.
+        """
+        return df[self.get_column_order(df.columns)]
@@ -1,7 +1,16 @@
 import pandas as pd
 import numpy as np
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from config.wyscout_column_info import wyscout_pilot_columns, wyscout_score_columns, wyscout_team_season_columns, wyscout_personal_columns
+from config.wyscout_column_info import wyscout_categorical_columns, wyscout_count_columns, wyscout_unused_columns
+from config.extra_variable_column_info import succeed_actions_variables, in_possession_variables, out_possession_variables
+from wyscout_etl.calculate_totals import CalculateKPI
+from wyscout_etl.derived_metrics import DerivedMetricEngine
+from wyscout_etl.frame_cache import FrameCache
+from wyscout_etl.ingestion_manifest import IngestionManifest
 
 
 class CreateWyscoutBase:
@@ -18,33 +27,95 @@ class CreateWyscoutBase:
     - Cleaning up data by handling missing values and unnecessary columns.
     - Merging additional league information to enhance the dataset.
     - Providing a final DataFrame in a logical column order for further analysis.
+    - Caching the final DataFrame as Parquet, keyed by a fingerprint of the input files and
+      the column configuration, so unchanged inputs are not parsed again.
+    - Keeping a manifest of ingested exports, so only new or modified exports are parsed
+      when the inputs did change.
+    - Applying an explicit dtype schema while parsing: categoricals for team, season and
+      position columns, float32 for the score columns and nullable integers for counts.
+      The ETL widens the score columns back to their decimal float64 values (FloatPrecision.widen)
+      before calculating with them.
+    - Only reading the columns that are used by the configured pipeline and KPI method.
 
     Attributes:
-        None: The class does not maintain state between method calls.
+        n_workers (int): Number of workers used to parse the CSV files. A value of 1 parses
+                         the files sequentially in the calling process.
+        executor (str): Either "thread" or "process", the type of pool used when n_workers > 1.
+        league_info_path (str): The Excel file containing the league ids per year.
+        cache (FrameCache): The cache in which the base DataFrame is stored.
+        ingested_dir (str): The directory containing the manifest and parsed parts of the exports.
+        kpi_method (str): The KPI method in config/kpi_methods whose variables need to be read.
+        keep_all_columns (bool): Whether to read all columns instead of only the needed columns.
+        score_dtype (str): The dtype the score columns are parsed in, "float32" or "float64".
+        needed_columns (list[str] | None): The columns read from the exports, None when all columns are kept.
     
     Methods:
-        __init__(): Initializes the CreateWyscoutBase class.
-        get_base(source_path): Processes CSV files to create the base DataFrame.
+        __init__(n_workers, executor, league_info_path, cache_dir, kpi_method, keep_all_columns, score_dtype): Initializes the CreateWyscoutBase class.
+        get_base(source_path, use_cache): Processes CSV files to create the base DataFrame.
+        iter_base_chunks(source_path, chunk_bytes): Processes CSV files to create the base DataFrame in chunks.
+        _finish_base_frame(full_df, melted_df): Attaches league info, cleans and orders the concatenated exports.
+        _get_bytes_per_row(path): Estimates the number of bytes per row of a CSV file.
+        _get_fingerprint(file_paths): Creates the cache fingerprint of the input files and column configuration.
         _get_file_names(source_path): Retrieves a list of CSV filenames from the directory.
-        _create_base_frame(file_names, base_path): Concatenates data from multiple CSV files into a single DataFrame.
-        _get_melted_league_id_info(): Retrieves and transforms league ID information from an Excel file.
+        _create_base_frame(file_names, base_path, manifest): Concatenates data from multiple CSV files into a single DataFrame.
+        _read_exports(paths): Parses CSV files, using a pool of workers if configured.
+        _get_parse_settings(): Creates a fingerprint of the settings the exports are parsed with.
+        _get_read_dtypes(): Creates the dtype schema that is applied while parsing the exports.
+        _apply_schema(df): Applies the dtype schema to columns that were not parsed with it.
+        _get_needed_columns(): Determines the columns used by the pipeline, the extra variables and the KPI method.
+        _get_output_columns(df): Determines the final column order of the base DataFrame.
+        _get_melted_league_id_info(): Retrieves the league ID lookup, from the cache or from the Excel file.
+        _melt_league_id_info(): Transforms league ID information from the Excel file into a lookup.
         clean_pilot_columns(df): Cleans pilot columns by replacing zeros with NaN.
         clean_wyscout_variables(df): Additional data cleaning for specific variables.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        n_workers: int = 1,
+        executor: str = "thread",
+        league_info_path: str = r"storage/league_id_main_competitions.xlsx",
+        cache_dir: str = os.path.join("storage", "cache"),
+        kpi_method: str = "general.py",
+        keep_all_columns: bool = False,
+        score_dtype: str = "float32",
+    ) -> None:
         """
         Initialize the CreateWyscoutBase class.
-        """
-        pass
 
-    def get_base(self, source_path: str = r"storage\wyscout_data\player_season_stats") -> pd.DataFrame:
+        Args:
+            n_workers (int): Number of workers used to parse the CSV files. Defaults to 1 (sequential).
+            executor (str): "thread" or "process", the pool used when n_workers > 1. Defaults to "thread".
+            league_info_path (str): The Excel file containing the league ids per year.
+            cache_dir (str): The directory in which the base DataFrame is cached. Defaults to 'storage/cache'.
+            kpi_method (str): The KPI method in config/kpi_methods whose variables need to be read. Defaults to 'general.py'.
+            keep_all_columns (bool): Whether to read all columns of the exports. Defaults to False.
+            score_dtype (str): The dtype the score columns are parsed in, "float32" or "float64". Defaults to "float32".
+        """
+        if executor not in ("thread", "process"):
+            raise ValueError(f"executor should be 'thread' or 'process', got '{executor}'")
+
+        self.n_workers = max(1, n_workers)
+        self.executor = executor
+        self.league_info_path = league_info_path
+        self.cache = FrameCache(cache_dir)
+        self.ingested_dir = os.path.join(cache_dir, "ingested")
+        self.kpi_method = kpi_method
+        self.keep_all_columns = keep_all_columns
+        self.score_dtype = score_dtype
+
+        # The KPI method is imported once, the needed columns are used by the fingerprints and every parse
+        self.needed_columns = self._get_needed_columns()
+
+    def get_base(self, source_path: str = r"storage\wyscout_data\player_season_stats", use_cache: bool = True) -> pd.DataFrame:
         """
         Create the base Wyscout dataframe by processing multiple CSV files and merging with league ID data.
 
         Args:
             source_path (str): The path to the directory containing Wyscout player season stats files.
                               Defaults to 'storage\\wyscout_data\\player_season_stats'.
+            use_cache (bool): Whether to load the base from (and store it in) the Parquet cache.
+                              Defaults to True.
 
         Returns:
             pd.DataFrame: The final cleaned and ordered dataframe containing Wyscout data.
@@ -52,29 +123,147 @@ class CreateWyscoutBase:
         # Get list of all files in the source directory
         file_names = self._get_file_names(source_path)
 
-        # Create dataframe from all the paths
-        full_df = self._create_base_frame(file_names, base_path=source_path)
+        # Load the base from the cache when none of the inputs changed since the last run
+        if use_cache:
+            fingerprint = self._get_fingerprint([os.path.join(source_path, i) for i in file_names])
+            cached_df = self.cache.load("wyscout_base", fingerprint)
+
+            if cached_df is not None:
+                print("Loaded the base data from the cache")
+                return cached_df
+
+        # Create dataframe from all the paths, only parsing the exports that are new or changed
+        manifest = IngestionManifest(self.ingested_dir, self._get_parse_settings()) if use_cache else None
+        full_df = self._create_base_frame(file_names, base_path=source_path, manifest=manifest)
+
+        full_df = self._finish_base_frame(full_df, self._get_melted_league_id_info())
+
+        if use_cache:
+            self.cache.store("wyscout_base", fingerprint, full_df)
+
+        return full_df
 
+    def iter_base_chunks(self, source_path: str = r"storage\wyscout_data\player_season_stats", chunk_bytes: int = 256 * 1024**2):
+        """
+        Create the base Wyscout dataframe in chunks, so it never has to be held in memory at once.
+
+        Small exports are combined until their total file size reaches `chunk_bytes`, exports
+        that are larger than `chunk_bytes` are read in row chunks. Every chunk is cleaned and
+        ordered in the same way as the result of `get_base`.
+
+        Args:
+            source_path (str): The path to the directory containing Wyscout player season stats files.
+                              Defaults to 'storage\\wyscout_data\\player_season_stats'.
+            chunk_bytes (int): The maximum number of CSV bytes per chunk. Defaults to 256 MB.
+
+        Yields:
+            pd.DataFrame: A cleaned and ordered chunk of the base dataframe.
+        """
+        melted_df = self._get_melted_league_id_info()
+
+        batch_files = []
+        batch_bytes = 0
+
+        for filename in self._get_file_names(source_path):
+            path = os.path.join(source_path, filename)
+            file_bytes = os.path.getsize(path)
+
+            # Flush the batch when the next export doesn't fit in it anymore
+            if batch_files and batch_bytes + file_bytes > chunk_bytes:
+                yield self._finish_base_frame(self._create_base_frame(batch_files, source_path), melted_df)
+                batch_files = []
+                batch_bytes = 0
+
+            if file_bytes <= chunk_bytes:
+                batch_files.append(filename)
+                batch_bytes += file_bytes
+                continue
+
+            # Read exports that are larger than a chunk in parts
+            chunk_rows = max(1, int(chunk_bytes / self._get_bytes_per_row(path)))
+            reader = _read_wyscout_export(path, dtype=self._get_read_dtypes(), usecols=self.needed_columns, chunksize=chunk_rows)
+            with reader:
+                for df in reader:
+                    yield self._finish_base_frame(df, melted_df)
+
+        if batch_files:
+            yield self._finish_base_frame(self._create_base_frame(batch_files, source_path), melted_df)
+
+    def _finish_base_frame(self, full_df: pd.DataFrame, melted_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Turn the concatenated exports into the base dataframe: attach the league info, clean
+        the data and create the logical column order.
+
+        Args:
+            full_df (pd.DataFrame): The concatenated Wyscout exports.
+            melted_df (pd.DataFrame): The league ID lookup, indexed on league_id.
+
+        Returns:
+            pd.DataFrame: The cleaned and ordered dataframe containing Wyscout data.
+        """
         # Sometimes there are empty columns in the Wyscout data, resulting in unnamed columns
         if "Unnamed: 0" in full_df:
             full_df = full_df.drop("Unnamed: 0", axis=1)
 
-        # Get the league_id info but in a melted format
-        melted_df = self._get_melted_league_id_info()
+        # Join the league info to the players, keeping only players of known leagues
+        full_df = full_df.join(melted_df, on="league_id", how="inner").reset_index(drop=True)
 
-        # Merge dataframes together
-        full_df = full_df.merge(melted_df, how="inner", left_on=["league_id"], right_on=["league_id"])
+        # The league info columns come from the Excel file and still need their dtypes
+        full_df = self._apply_schema(full_df)
 
         # Clean the pilot columns
         full_df = self.clean_pilot_columns(full_df)
 
         full_df = self.clean_wyscout_variables(full_df)
 
-        # Create a logical column order
-        full_df = full_df[wyscout_team_season_columns + wyscout_personal_columns + wyscout_score_columns]
+        # Create a logical column order. With copy-on-write the selection is a view of many small blocks,
+        # the copy consolidates the base once so the stages don't work on a fragmented frame
+        full_df = full_df[self._get_output_columns(full_df)].copy()
 
         return full_df
 
+    def _get_bytes_per_row(self, path: str) -> float:
+        """
+        Estimate the average number of bytes per row of a CSV file from its first megabyte.
+
+        Args:
+            path (str): The path to the CSV file.
+
+        Returns:
+            float: The estimated number of bytes per row.
+        """
+        with open(path, "rb") as file:
+            sample = file.read(1024**2)
+
+        return len(sample) / max(1, sample.count(b"\n"))
+
+    def _get_fingerprint(self, file_paths: list[str]) -> str:
+        """
+        Create the cache fingerprint of the base DataFrame.
+
+        The fingerprint changes when an export or the league id file is added, removed or
+        modified, or when the column configuration or the dtype schema changes.
+
+        Args:
+            file_paths (list[str]): The paths of the Wyscout exports.
+
+        Returns:
+            str: The fingerprint of the base DataFrame.
+        """
+        return self.cache.fingerprint(
+            file_paths=sorted(file_paths) + [self.league_info_path],
+            config_objects=[
+                wyscout_team_season_columns,
+                wyscout_personal_columns,
+                wyscout_score_columns,
+                wyscout_pilot_columns,
+                wyscout_categorical_columns,
+                wyscout_count_columns,
+                self.needed_columns,
+                self._get_read_dtypes(),
+            ],
+        )
+
     def _get_file_names(self, source_path: str) -> list[str]:
         """
         Retrieve all CSV filenames from the source directory.
@@ -93,61 +282,223 @@ class CreateWyscoutBase:
 
         return file_names_csv
 
-    def _create_base_frame(self, file_names: list[str], base_path: str) -> pd.DataFrame:
+    def _create_base_frame(self, file_names: list[str], base_path: str, manifest: IngestionManifest = None) -> pd.DataFrame:
         """
         Create a single DataFrame by concatenating data from multiple CSV files.
 
+        The files are parsed sequentially or by a pool of `n_workers` workers. All parsed
+        frames are concatenated once at the end in the order of `file_names`, so the result
+        does not depend on the number of workers.
+
+        When a manifest is given, the stored parts of unchanged files are reused, only new or
+        modified files are parsed and the parts of deleted files are evicted.
+
         Args:
             file_names (list[str]): A list of filenames to be processed.
             base_path (str): The directory where the files are located.
+            manifest (IngestionManifest): The manifest of already ingested files. Defaults to None.
 
         Returns:
             pd.DataFrame: A concatenated DataFrame containing all the data from the CSV files.
         """
-        # Create an empty DataFrame to store the final data
-        full_df = pd.DataFrame()
+        if manifest is None:
+            frames = self._read_exports([os.path.join(base_path, filename) for filename in file_names])
+        else:
+            manifest.evict_missing(file_names)
+            unchanged_files, to_parse_files = manifest.split_files(file_names, base_path)
+            print(f"Reusing {len(unchanged_files)} ingested files, parsing {len(to_parse_files)} new or modified files")
 
-        # Loop through each file in the source directory
-        for filename in file_names:
-            print(f"Importing: {filename}")
-            temp_path = os.path.join(base_path, filename)
-            df = pd.read_csv(temp_path)
+            parsed_frames = self._read_exports([os.path.join(base_path, filename) for filename in to_parse_files])
 
-            # Concatenate the current DataFrame with the full DataFrame
-            full_df = pd.concat([full_df, df])
+            frames_by_file = {}
+            for filename, df in zip(to_parse_files, parsed_frames):
+                manifest.store_part(filename, base_path, df)
+                frames_by_file[filename] = df
 
-            print(f"Finished importing: {filename}\n")
+            for filename in unchanged_files:
+                frames_by_file[filename] = manifest.load_part(filename)
 
-        return full_df
+            manifest.save()
+
+            frames = [frames_by_file[filename] for filename in file_names]
+
+        if not frames:
+            return pd.DataFrame()
+
+        # Concatenating categoricals with different categories results in object columns,
+        # so every file gets the categories of all files first
+        for column in wyscout_categorical_columns:
+            if all(column in df and isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames):
+                categories = pd.api.types.union_categoricals([df[column] for df in frames]).categories
+                for df in frames:
+                    df[column] = df[column].cat.set_categories(categories)
+
+        return pd.concat(frames)
+
+    def _read_exports(self, paths: list[str]) -> list[pd.DataFrame]:
+        """
+        Parse Wyscout exports, sequentially or with a pool of `n_workers` workers.
+
+        Args:
+            paths (list[str]): The paths of the CSV files.
+
+        Returns:
+            list[pd.DataFrame]: The parsed files, in the order of `paths`.
+        """
+        read_export = partial(_read_wyscout_export, dtype=self._get_read_dtypes(), usecols=self.needed_columns)
+
+        if self.n_workers == 1 or len(paths) <= 1:
+            return [read_export(path) for path in paths]
+
+        pool_class = ThreadPoolExecutor if self.executor == "thread" else ProcessPoolExecutor
+
+        # map returns the results in the order of the input paths
+        with pool_class(max_workers=self.n_workers) as pool:
+            return list(pool.map(read_export, paths))
+
+    def _get_parse_settings(self) -> str:
+        """
+        Create a fingerprint of the settings the exports are parsed with. Ingested parts
+        that were parsed with other settings are not reused.
+
+        Returns:
+            str: The fingerprint of the parse settings.
+        """
+        return self.cache.fingerprint(
+            config_objects=[{"reader": "read_csv", "dtype": self._get_read_dtypes(), "usecols": self.needed_columns}]
+        )
+
+    def _get_read_dtypes(self) -> dict:
+        """
+        Create the dtype schema that is applied while parsing the exports. Columns of the
+        schema that are missing in an export are ignored by the parser.
+
+        Returns:
+            dict: The dtype per column.
+        """
+        dtypes = {column: self.score_dtype for column in wyscout_score_columns}
+        dtypes.update({column: "Int64" for column in wyscout_count_columns})
+        dtypes.update({column: "category" for column in wyscout_categorical_columns})
+
+        return dtypes
+
+    def _apply_schema(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Apply the dtype schema to columns that were not parsed with it, such as the columns
+        merged from the league id file.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing Wyscout data.
+
+        Returns:
+            pd.DataFrame: The DataFrame with the schema applied.
+        """
+        for column, dtype in self._get_read_dtypes().items():
+            if column in df and str(df[column].dtype) != dtype:
+                df[column] = df[column].astype(dtype)
+
+        return df
 
     def _get_melted_league_id_info(self) -> pd.DataFrame:
+        """
+        Retrieve the league ID lookup. The melted lookup is cached and only rebuilt from the
+        Excel file when the workbook changed.
+
+        Returns:
+            pd.DataFrame: A melted DataFrame containing league information per year, indexed on league_id.
+        """
+        fingerprint = self.cache.fingerprint(file_paths=[self.league_info_path])
+
+        df_melted = self.cache.load("league_lookup", fingerprint)
+        if df_melted is None:
+            df_melted = self._melt_league_id_info()
+            self.cache.store("league_lookup", fingerprint, df_melted)
+
+        return df_melted
+
+    def _melt_league_id_info(self) -> pd.DataFrame:
         """
         Retrieve and transform league ID information by melting league ID columns for different years.
+        Every column named 'league_id_<year>' in the Excel file is treated as a year column.
 
         Returns:
-            pd.DataFrame: A melted DataFrame containing league information with columns for each year.
+            pd.DataFrame: A melted DataFrame containing league information per year, indexed on league_id.
         """
         # Import DataFrame
-        df = pd.read_excel(r"storage/league_id_main_competitions.xlsx")
+        df = pd.read_excel(self.league_info_path)
+
+        # Detect the year columns, so new seasons only need a new column in the Excel file
+        year_columns = [i for i in df.columns if re.fullmatch(r"league_id_\d{4}", str(i))]
 
         # Melt the DataFrame to unpivot the league_id columns
         df_melted = df.melt(
             id_vars=['league_country', 'league_competition', 'division', 'start_moment'],
-            value_vars=[
-                'league_id_2018', 'league_id_2019', 'league_id_2020',
-                'league_id_2021', 'league_id_2022', 'league_id_2023', 'league_id_2024'
-            ],
+            value_vars=year_columns,
             var_name='year',
             value_name='league_id'
         )
 
         # Extract the year from the 'year' column (e.g., from 'league_id_2018' to just '2018')
-        df_melted['year'] = df_melted['year'].str.extract(r'(\d{4})')
+        df_melted['year'] = df_melted['year'].str.extract(r'(\d{4})', expand=False)
 
         # Drop rows where 'league_id' is NaN
         df_melted = df_melted.dropna(subset=['league_id'])
 
-        return df_melted
+        # The ids are floats in Excel because of the empty cells, the exports contain integers
+        df_melted['league_id'] = df_melted['league_id'].astype("int64")
+
+        return df_melted.set_index('league_id')
+
+    def _get_needed_columns(self) -> list[str] | None:
+        """
+        Determine the columns that need to be read from the exports: the columns of the base
+        layout in config/wyscout_column_info.py that are used downstream, and the columns
+        referenced by config/extra_variable_column_info.py (including the expressions of the
+        derived metrics) and the selected KPI method.
+        Referenced names that are not in an export (e.g. derived variables) are ignored.
+
+        Returns:
+            list[str] | None: The needed columns, or None when all columns are kept.
+        """
+        if self.keep_all_columns:
+            return None
+
+        layout_columns = wyscout_team_season_columns + wyscout_personal_columns + wyscout_score_columns
+        needed_columns = [i for i in layout_columns if i not in wyscout_unused_columns]
+
+        # Columns used by the extra variables and the KPI method, e.g. pilot columns in a KPI
+        kpi_scoring_values = CalculateKPI()._import_variables_from_script(self.kpi_method)[1]
+        referenced_columns = [column for pair in succeed_actions_variables for column in pair]
+        referenced_columns += in_possession_variables + out_possession_variables
+        referenced_columns += DerivedMetricEngine().get_input_columns()
+        referenced_columns += [variable for variables in kpi_scoring_values.values() for variable in variables]
+
+        for column in referenced_columns:
+            if column not in needed_columns:
+                needed_columns.append(column)
+
+        return needed_columns
+
+    def _get_output_columns(self, df: pd.DataFrame) -> list[str]:
+        """
+        Determine the final, logical column order of the base DataFrame. When only the needed
+        columns are read, referenced columns outside the base layout are kept at the end.
+
+        Args:
+            df (pd.DataFrame): The merged DataFrame containing Wyscout data.
+
+        Returns:
+            list[str]: The column order.
+        """
+        layout_columns = wyscout_team_season_columns + wyscout_personal_columns + wyscout_score_columns
+
+        if self.needed_columns is None:
+            return layout_columns
+
+        output_columns = [i for i in layout_columns if i in self.needed_columns]
+        output_columns += [i for i in self.needed_columns if i not in layout_columns and i in df]
+
+        return output_columns
 
     def clean_pilot_columns(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -160,7 +511,9 @@ class CreateWyscoutBase:
             pd.DataFrame: The DataFrame with cleaned pilot columns.
         """
         # 0 entails that it isn't measured, not that the occurrence of the activity is 0
-        df[wyscout_pilot_columns] = df[wyscout_pilot_columns].replace(0, np.nan)
+        # Pilot columns are only present when they are read
+        pilot_columns = [i for i in wyscout_pilot_columns if i in df]
+        df[pilot_columns] = df[pilot_columns].replace(0, np.nan)
 
         return df
     
@@ -170,7 +523,36 @@ class CreateWyscoutBase:
         place all other cleaning in this function
         """
 
+        if isinstance(df["last_club_name"].dtype, pd.CategoricalDtype) and "National Team" not in df["last_club_name"].cat.categories:
+            df["last_club_name"] = df["last_club_name"].cat.add_categories("National Team")
+
         df["last_club_name"] = df["last_club_name"].fillna("National Team")
 
         return df
 
+
+def _read_wyscout_export(path: str, dtype: dict = None, usecols: list[str] = None, chunksize: int = None) -> pd.DataFrame:
+    """
+    Read a single Wyscout export. Defined on module level so it can be sent to a process pool.
+
+    Args:
+        path (str): The path to the CSV file.
+        dtype (dict): The dtype per column. Defaults to None (inferred by pandas).
+        usecols (list[str]): The columns to read, columns missing in the file are skipped. Defaults to None (all columns).
+        chunksize (int): The number of rows per chunk. Defaults to None (the whole file at once).
+
+    Returns:
+        pd.DataFrame: The contents of the CSV file, or a reader yielding chunks when chunksize is given.
+    """
+    print(f"Importing: {os.path.basename(path)}")
+    if usecols is not None:
+        usecols_set = set(usecols)
+        usecols = lambda column: column in usecols_set
+
+    if chunksize is not None:
+        return pd.read_csv(path, dtype=dtype, usecols=usecols, chunksize=chunksize)
+
+    df = pd.read_csv(path, dtype=dtype, usecols=usecols)
+    print(f"Finished importing: {os.path.basename(path)}\n")
+
+    return df
@@ -0,0 +1,174 @@
+import pandas as pd
+import numpy as np
+import keyword
+import re
+
+from config.extra_variable_column_info import derived_metric_definitions
+from wyscout_etl.column_placement import ColumnPlacementPlan
+
+
+class DerivedMetricEngine:
+    """
+    A class for evaluating the derived metrics declared in config/extra_variable_column_info.py.
+
+    Every derived metric is a pandas expression over base columns or other derived metrics. The
+    definitions are compiled into a dependency order once, after which all metrics are evaluated
+    in a single pass on Series of the input columns. The results are collected in a block that is
+    added to the DataFrame with one concat, so adding a metric doesn't add a full-frame copy.
+
+    Attributes:
+        definitions (dict): The definition per derived metric.
+        engine (str): The pandas.eval engine: "python", or "numexpr" when installed. The numexpr
+                      engine is faster on large frames, but calculates float32 inputs in double precision.
+        metrics (list[str]): The derived metrics to evaluate, None for all. The metrics they are
+                             calculated from are evaluated as well.
+        evaluation_order (list[str]): The derived metrics to evaluate, in dependency order.
+
+    Methods:
+        __init__(definitions, engine, metrics): Initializes the DerivedMetricEngine class.
+        evaluate(df, column_plan): Evaluates all derived metrics and adds them to the DataFrame.
+        get_input_columns(): Determines the base columns the derived metrics are calculated from.
+        _evaluate_metric(name, inputs): Evaluates one derived metric.
+        _get_evaluation_order(): Sorts the derived metrics so every metric comes after its dependencies.
+        _get_references(name): Determines the columns referenced by the expression of a metric.
+    """
+
+    def __init__(self, definitions: dict = derived_metric_definitions, engine: str = "python", metrics: list[str] = None) -> None:
+        """
+        Initialize the DerivedMetricEngine class.
+
+        Args:
+            definitions (dict): The definition per derived metric. Defaults to derived_metric_definitions.
+            engine (str): The pandas.eval engine. Defaults to "python".
+            metrics (list[str]): The derived metrics to evaluate. Defaults to None (all metrics).
+        """
+        unknown_metrics = [i for i in metrics or [] if i not in definitions]
+        if unknown_metrics:
+            raise ValueError(f"Unknown derived metrics: {unknown_metrics}")
+
+        self.definitions = definitions
+        self.engine = engine
+        self.metrics = metrics
+        self.evaluation_order = self._get_evaluation_order()
+
+    def evaluate(self, df: pd.DataFrame, column_plan: ColumnPlacementPlan = None) -> pd.DataFrame:
+        """
+        Evaluate all derived metrics and add them to the DataFrame as one block. The placements next
+        to the anchor columns are recorded in `column_plan`, the new columns are added at the end.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the input columns.
+            column_plan (ColumnPlacementPlan): The plan in which the placements are recorded. Defaults to None.
+
+        Returns:
+            pd.DataFrame: A new DataFrame with the derived metrics added, the input DataFrame is not modified.
+        """
+        new_columns = {}
+
+        for name in self.evaluation_order:
+            inputs = {i: new_columns[i] if i in new_columns else df[i] for i in self._get_references(name)}
+            new_columns[name] = self._evaluate_metric(name, inputs)
+
+        # The metrics are added in the order of the definitions
+        names = [i for i in self.definitions if i in new_columns]
+
+        # Record the placements in the order of the definitions, a later metric next to the same anchor ends up closer to it
+        if column_plan is not None:
+            for name in names:
+                if self.definitions[name].get("anchor") is not None:
+                    column_plan.add(brother_column=self.definitions[name]["anchor"], new_column=name)
+
+        new_df = pd.DataFrame({name: new_columns[name] for name in names}, index=df.index)
+
+        return pd.concat([df.drop(columns=[i for i in names if i in df]), new_df], axis=1)
+
+    def get_input_columns(self) -> list[str]:
+        """
+        Determine the base columns the derived metrics are calculated from.
+
+        Returns:
+            list[str]: The referenced columns that are not derived metrics themselves.
+        """
+        input_columns = []
+        for name in self.definitions:
+            input_columns += [i for i in self._get_references(name) if i not in self.definitions and i not in input_columns]
+
+        return input_columns
+
+    def _evaluate_metric(self, name: str, inputs: dict) -> pd.Series:
+        """
+        Evaluate one derived metric: fill the inputs, evaluate the expression, then clip, round and fill the result.
+
+        Args:
+            name (str): The name of the derived metric.
+            inputs (dict): The Series per referenced column.
+
+        Returns:
+            pd.Series: The values of the derived metric.
+        """
+        definition = self.definitions[name]
+
+        for column, value in definition.get("fill_inputs", {}).items():
+            inputs[column] = inputs[column].fillna(value)
+
+        values = pd.eval(definition["expression"], local_dict=inputs, engine=self.engine)
+
+        if "clip" in definition:
+            lower, upper = definition["clip"]
+            values = values.clip(lower=lower, upper=upper)
+
+        if "round" in definition:
+            values = np.round(values, definition["round"])
+
+        if "fill" in definition:
+            values = values.fillna(definition["fill"])
+
+        return values
+
+    def _get_evaluation_order(self) -> list[str]:
+        """
+        Sort the derived metrics so every metric is evaluated after the metrics it references, keeping
+        the order of the definitions where possible. Only the selected metrics and the metrics they
+        reference are included.
+
+        Returns:
+            list[str]: The derived metrics to evaluate, in dependency order.
+        """
+        evaluation_order = []
+        visiting = set()
+
+        def visit(name):
+            if name in evaluation_order:
+                return
+            if name in visiting:
+                raise ValueError(f"The derived metric '{name}' depends on itself")
+
+            visiting.add(name)
+            for reference in self._get_references(name):
+                if reference in self.definitions:
+                    visit(reference)
+            visiting.remove(name)
+
+            evaluation_order.append(name)
+
+        for name in self.definitions if self.metrics is None else self.metrics:
+            visit(name)
+
+        return evaluation_order
+
+    def _get_references(self, name: str) -> list[str]:
+        """
+        Determine the columns referenced by the expression of a metric. Names followed by a parenthesis
+        are functions (e.g. abs) and keywords (e.g. and) are no columns.
+
+        Args:
+            name (str): The name of the derived metric.
+
+        Returns:
+            list[str]: The referenced columns, in order of appearance.
+        """
+        definition = self.definitions[name]
+        references = re.findall(r"\b([A-Za-z_]\w*)\b(?!\s*\()", definition["expression"])
+        references += list(definition.get("fill_inputs", {}))
+
+        return list(dict.fromkeys(i for i in references if not keyword.iskeyword(i) and i not in ("True", "False")))
@@ -3,7 +3,24 @@ from wyscout_etl.create_extra_variables import GetExtraFeatures
 from wyscout_etl.make_padj import PadjMaker
 from wyscout_etl.make_comparison_stats import ComparePlayers
 from wyscout_etl.calculate_totals import CalculateKPI
+from wyscout_etl.streaming_etl import StreamingETL
+from wyscout_etl.wyscout_db import WyscoutDatabase
+from wyscout_etl.stage_graph import PipelineStage, StageGraph
+from wyscout_etl.feature_demand import FeatureDemand
+from wyscout_etl.team_possession import TeamPossession
+from wyscout_etl.precision import FloatPrecision
+from wyscout_etl.stage_metrics import StageMetrics
+from wyscout_etl.cohort_store import CohortStatisticsStore
+from wyscout_etl.group_statistics import GroupStatistics
+from wyscout_etl.quantile_sketch import CohortSketches
+from config.extra_variable_column_info import derived_metric_definitions, in_possession_variables, out_possession_variables
+from config.wyscout_column_info import wyscout_personal_columns, wyscout_team_season_columns
+from config.pos_translation import pos_translation_dict
+from config.comparison_cohorts import comparison_cohorts, default_comparison_cohort
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import pandas as pd
+import numpy as np
 import os
 
 class ETLPipelines():
@@ -11,39 +28,449 @@ class ETLPipelines():
     def __init__(self): 
         pass 
 
-    def create_general_db(self, test = False): 
+    def create_general_db(self, test = False, n_workers = 1, executor = "thread", kpi_method = "general.py", keep_all_columns = False,
+                          streaming = False, memory_budget_mb = 2048, export_csv = False, incremental = False, stage_workers = 2,
+                          demand_driven = False, report_columns = None, team_possession = False, float32 = False, accuracy_report = False,
+                          metrics_sink = None, profile_dir = None, partitioned = False, partition_workers = None, cohorts = None,
+                          quantile_error = None): 
         print("ETL Pipeline started...")
 
-        # Start creating the base
-        print("Step 1: Creating the base data")
-        df = CreateWyscoutBase().get_base()
+        # With copy-on-write, selections and shallow copies share their data until they are modified,
+        # so the stages don't need defensive copies of the wide frames. The option is restored after the run.
+        with pd.option_context("mode.copy_on_write", True):
+            # In float32 mode the calculated columns are kept in single precision between the stages, the
+            # accuracy report compares the result with a float64 run
+            precision = FloatPrecision("float32" if float32 else "float64")
+
+            # With team_possession the players are possession adjusted by the possession of their team-season,
+            # from a table that is cached between runs, instead of by their own estimate
+            team_possession = TeamPossession() if team_possession else None
+
+            # In demand-driven mode only the derived metrics, possession adjusted columns and comparisons
+            # needed for the KPI method and the report columns are calculated
+            demand = FeatureDemand(kpi_method, report_columns) if demand_driven else None
+
+            # The players are also compared within the selected cohorts of config/comparison_cohorts (e.g. "position"),
+            # in columns prefixed with the name of the cohort
+            cohorts = self._get_cohorts(cohorts, within_competition=(streaming or partitioned) and quantile_error is None)
+
+            # With a quantile error the quantiles are approximated from mergeable quantile sketches (see QuantileSketch), so
+            # streaming and partitioned runs can also compare within cohorts that span several competitions. The sketches
+            # per cohort are saved next to the database, so later runs can compare new players with them.
+            sketches = {}
+
+            # The possession adjustment reports per ratio column how many rows were filled or clamped to PadjMaker.ratio_bounds,
+            # the reports of all chunks or partitions are added up and saved next to the database to tune the bounds with
+            clamp_reports = []
+
+            # Parsing the exports with n_workers in parallel and only reading the columns needed 
+            # for the KPI method unless all columns are kept, the score columns in the dtype of the precision
+            base_creator = CreateWyscoutBase(
+                n_workers=n_workers, executor=executor, kpi_method=kpi_method, keep_all_columns=keep_all_columns,
+                score_dtype=precision.score_dtype
+            )
+
+            # Generate a directory name with the current datetime, the database is stored as a dataset
+            # partitioned per year and competition with an optional CSV export next to it
+            current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            file_name = f"wyscout_data_{current_time}"
+            file_path = os.path.join("storage", "db", file_name)
+            csv_path = file_path + ".csv" if export_csv else None
+
+            # With a metrics sink (e.g. a JsonLinesSink) every stage is measured and its metrics are sent to
+            # the sink, with a profile directory every stage is profiled with cProfile
+            metrics = None
+            if metrics_sink is not None or profile_dir is not None:
+                metrics = StageMetrics(sink=metrics_sink, profile_dir=profile_dir, run_id=current_time)
+
+            source_path = r"storage\wyscout_data\player_season_stats"
+
+            # Streaming keeps the memory use within the budget by processing the data in chunks
+            if streaming:
+                StreamingETL(
+                    memory_budget_mb=memory_budget_mb, demand=demand, team_possession=team_possession, precision=precision, metrics=metrics,
+                    cohorts=cohorts, quantile_error=quantile_error, cohort_sketches=sketches, clamp_reports=clamp_reports
+                ).run(base_creator, source_path, kpi_method, file_path, test=test, csv_path=csv_path)
+                self._save_sketches(sketches, file_path)
+                self._save_clamp_report(clamp_reports, file_path)
+                if metrics is not None:
+                    metrics.close()
+                print("ETL Pipeline finished successfully.")
+                return
+
+            if partitioned:
+                # The base is split by competition and the stages run per partition in a pool of processes,
+                # the statistics over the whole dataset are calculated beforehand
+                df = self._run_partitioned(
+                    base_creator, source_path, kpi_method, test, n_workers=partition_workers or os.cpu_count(), demand=demand,
+                    team_possession=team_possession, precision=precision, metrics=metrics, cohorts=cohorts, quantile_error=quantile_error,
+                    sketches=sketches, clamp_reports=clamp_reports
+                )
+            else:
+                # The stages run as a graph: the possession adjustment and the comparisons of the unadjusted
+                # columns run concurrently, and with incremental=True only stages whose inputs or config
+                # changed since the last run are recomputed
+                stage_sketches = {}
+                stage_graph = self._build_stage_graph(
+                    base_creator, source_path, kpi_method, test, use_cache=incremental, max_workers=stage_workers, demand=demand,
+                    team_possession=team_possession, precision=precision, metrics=metrics, cohorts=cohorts, quantile_error=quantile_error,
+                    sketches=stage_sketches, clamp_reports=clamp_reports
+                )
+                df = stage_graph.run("kpis")
+                sketches = self._merge_sketches(stage_sketches.values())
+        
+            # Saving the data as a partitioned dataset
+            print(f"Saving data to {file_path}")
+            self._measure(metrics, "save", lambda df: WyscoutDatabase().write(df, file_path), [df], written_path=file_path)
+            self._save_sketches(sketches, file_path)
+            self._save_clamp_report(clamp_reports, file_path)
+
+            if float32 and accuracy_report:
+                # The reference run also parses the score columns in float64. It has its own cache directory, the caches only
+                # keep one version per name, so sharing them would evict the base, stages and ingested parts of the float32 run
+                print("Running the float64 reference run for the accuracy report")
+                reference_precision = FloatPrecision("float64", score_dtype="float64")
+                reference_cache_dir = os.path.join("storage", "cache", "float64_reference")
+                reference_creator = CreateWyscoutBase(
+                    n_workers=n_workers, executor=executor, cache_dir=reference_cache_dir, kpi_method=kpi_method,
+                    keep_all_columns=keep_all_columns, score_dtype=reference_precision.score_dtype
+                )
+                reference_graph = self._build_stage_graph(
+                    reference_creator, source_path, kpi_method, test, use_cache=incremental, max_workers=stage_workers, demand=demand,
+                    team_possession=None if team_possession is None else TeamPossession(cache_dir=reference_cache_dir),
+                    precision=reference_precision, cohorts=cohorts, quantile_error=quantile_error, cache_dir=reference_cache_dir
+                )
+                report = precision.get_accuracy_report(df, reference_graph.run("kpis"))
+
+                report_path = file_path + "_accuracy.csv"
+                print(f"Largest deviations of the float32 run, the full report is saved to {report_path}:\n{report.head(10)}")
+                report.to_csv(report_path)
+
+            if export_csv:
+                print(f"Exporting data to {csv_path}")
+                self._measure(metrics, "export_csv", lambda df: df.to_csv(csv_path, index=False), [df], written_path=csv_path)
+
+            if metrics is not None:
+                metrics.close()
+
+            print("ETL Pipeline finished successfully.")
+
+    def _build_stage_graph(self, base_creator, source_path, kpi_method, test, use_cache = False, max_workers = 2, demand = None,
+                           team_possession = None, precision = None, metrics = None, cohorts = None, quantile_error = None,
+                           sketches = None, cache_dir = os.path.join("storage", "cache"), clamp_reports = None):
+
+        # The base has its own cache, its fingerprint covers the exports, the league file and the column config
+        file_paths = [os.path.join(source_path, i) for i in base_creator._get_file_names(source_path)]
+        base_fingerprint = base_creator.cache.fingerprint(config_objects=[base_creator._get_fingerprint(file_paths), test])
+
+        comparison_config = [pos_translation_dict, wyscout_personal_columns, wyscout_team_season_columns]
+        cohorts = cohorts or {}
+        demand_config = [None if demand is None else demand.get_config()]
+
+        # Every stage output is cast to the precision, which is part of the stage fingerprints
+        if precision is None:
+            precision = FloatPrecision()
+        cast = precision.cast
+        precision_config = [precision.dtype]
+
+        # In incremental runs the comparisons keep their statistics per cohort, so new exports only
+        # aggregate the cohorts they change
+        cohort_stores = {name: None for name in ["compare_metrics", "compare_padj"]}
+        if use_cache and quantile_error is None:
+            cohort_stores = {
+                name: CohortStatisticsStore(name, cache_dir=os.path.join(cache_dir, "cohorts"),
+                                            config_objects=[ComparePlayers.compare_group_columns] + comparison_config + precision_config)
+                for name in cohort_stores
+            }
+
+        # In sketch mode the comparisons and the stages after them always run, so every run has the quantile sketches
+        # of both comparison stages (per stage: cohort -> CohortSketches)
+        sketches = {} if sketches is None else sketches
+        sketch_stages_cacheable = quantile_error is None
+
+        stages = [
+            PipelineStage("base", lambda: self._create_base(base_creator, source_path, test, precision), cacheable=False, fingerprint=base_fingerprint),
+            PipelineStage("extra_metrics", lambda df: cast(self._add_extra_metrics(df, demand)), inputs=["base"],
+                          config_objects=[derived_metric_definitions] + demand_config + precision_config),
+            PipelineStage("padj", lambda df: cast(self._make_padj(df, demand, team_possession, precision.dtype, clamp_reports=clamp_reports)), inputs=["extra_metrics"],
+                          config_objects=[in_possession_variables, out_possession_variables, PadjMaker.ratio_bounds, team_possession is not None]
+                          + demand_config + precision_config),
+            PipelineStage("compare_metrics", lambda df: cast(self._compare_metrics(df, demand, cohort_stores["compare_metrics"], cohorts, quantile_error,
+                                                                                     sketches.setdefault("compare_metrics", {}))),
+                          inputs=["extra_metrics"], config_objects=comparison_config + [cohorts] + demand_config + precision_config,
+                          cacheable=sketch_stages_cacheable),
+            PipelineStage("compare_padj", lambda df: cast(self._compare_padj(df, demand, cohort_stores["compare_padj"], cohorts, quantile_error,
+                                                                               sketches.setdefault("compare_padj", {}))),
+                          inputs=["padj"], config_objects=comparison_config + [cohorts] + demand_config + precision_config,
+                          cacheable=sketch_stages_cacheable),
+            PipelineStage("kpis", lambda *dfs: cast(self._calculate_kpis(*dfs, kpi_method=kpi_method, cohorts=cohorts)), inputs=["padj", "compare_metrics", "compare_padj"],
+                          config_objects=[kpi_method, pos_translation_dict] + precision_config,
+                          config_files=[os.path.join("config", "kpi_methods", kpi_method)], cacheable=sketch_stages_cacheable),
+        ]
+
+        return StageGraph(stages, cache_dir=os.path.join(cache_dir, "stages"), use_cache=use_cache, max_workers=max_workers, metrics=metrics)
+
+    def _run_partitioned(self, base_creator, source_path, kpi_method, test, n_workers = 2, demand = None, team_possession = None,
+                         precision = None, metrics = None, cohorts = None, quantile_error = None, sketches = None, clamp_reports = None):
+
+        # Every comparison group lies within one competition and the other stages are row-local, except
+        # for the foul standardisation, the team possession table and the KPI fill values. Those are
+        # calculated over the whole dataset, so the result is the same as that of the stage graph.
+        # In sketch mode the cohorts spanning several competitions are sketched per partition and compared
+        # with the sketches merged over all partitions, the merged sketches of all cohorts are added to sketches.
+        if precision is None:
+            precision = FloatPrecision()
+        cohorts = cohorts or {}
+        pooled_cohorts = {k: v for k, v in cohorts.items() if not set(StreamingETL.competition_columns) <= set(v)}
+
+        df = self._measure(metrics, "base", lambda: self._create_base(base_creator, source_path, test, precision))
+
+        print("Calculating the statistics over all competitions")
+        foul_statistics = {i: (df[i].mean(), df[i].std()) for i in StreamingETL.foul_columns}
+        possession_table = None if team_possession is None else team_possession.get_table(df)
+
+        partitions = self._get_partitions(df, n_workers)
+        print(f"Running the stages on {len(partitions)} partitions with {n_workers} workers")
+
+        # The workers run with copy-on-write like the stage graph, also when they are spawned
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=pd.set_option, initargs=("mode.copy_on_write", True)) as pool:
+            def create_features(df):
+                parts = [df.iloc[i] for i in partitions]
+                return list(pool.map(
+                    _create_partition_features, parts,
+                    *[[i] * len(parts) for i in [demand, team_possession, possession_table, foul_statistics, precision, cohorts, quantile_error]]
+                ))
+
+            parts, partition_sketches, partition_clamp_reports = zip(*self._measure(metrics, "partition_features", create_features, [df]))
+            if clamp_reports is not None:
+                clamp_reports.extend(partition_clamp_reports)
+            run_sketches = self._merge_sketches(partition_sketches)
+            if sketches is not None:
+                sketches.update(run_sketches)
+            pooled_sketches = {i: run_sketches[i] for i in pooled_cohorts if i in run_sketches}
+
+            # The missing comparisons are filled with the minimum over all partitions
+            comparison_columns = [i for i in parts[0].columns if i.startswith(("zscore_", "quantile_"))]
+            fill_values = pd.concat([i[comparison_columns].min() for i in parts], axis=1).min(axis=1).to_dict()
+
+            def calculate_kpis(*parts):
+                return list(pool.map(
+                    _calculate_partition_kpis, parts, *[[i] * len(parts) for i in [kpi_method, fill_values, precision, cohorts, pooled_sketches]]
+                ))
+
+            parts = self._measure(metrics, "partition_kpis", calculate_kpis, parts)
+
+        # The partitions are merged in the order of the rows of the base
+        print("Merging the partitions")
+        positions = np.concatenate(partitions)
+        return pd.concat(parts).iloc[np.argsort(positions, kind="stable")]
+
+    def _get_partitions(self, df, n_partitions):
+
+        # Whole competitions are divided over the partitions, the largest competitions first to the smallest partition
+        competitions = df.groupby(StreamingETL.competition_columns, observed=True, dropna=False, sort=False).ngroup().to_numpy()
+        sizes = np.bincount(competitions)
+
+        partition_sizes = np.zeros(min(n_partitions, len(sizes)), dtype=np.int64)
+        competition_partitions = np.zeros(len(sizes), dtype=np.intp)
+        for competition in np.argsort(-sizes, kind="stable"):
+            partition = int(np.argmin(partition_sizes))
+            competition_partitions[competition] = partition
+            partition_sizes[partition] += sizes[competition]
+
+        row_partitions = competition_partitions[competitions]
+        return [np.flatnonzero(row_partitions == i) for i in range(len(partition_sizes))]
+
+    def _get_cohorts(self, names, within_competition = False):
+
+        # The cohorts by name besides the default cohort, that is always compared
+        names = [i for i in (names or []) if i != default_comparison_cohort]
+        unknown = [i for i in names if i not in comparison_cohorts]
+        if unknown:
+            raise ValueError(f"Unknown comparison cohorts {unknown}, the cohorts in config/comparison_cohorts are {list(comparison_cohorts)}")
+
+        # Streaming and partitioned runs compare the players per competition, so without quantile sketches their cohorts have to lie within a competition
+        if within_competition:
+            pooled = [i for i in names if not set(StreamingETL.competition_columns) <= set(comparison_cohorts[i])]
+            if pooled:
+                raise ValueError(f"The cohorts {pooled} span several competitions, they can only be compared in streaming or partitioned mode with a quantile_error")
+
+        return {i: comparison_cohorts[i] for i in names}
+
+    def _merge_sketches(self, sketch_dicts):
+
+        # The quantile sketches per cohort merged over several dicts (cohort: CohortSketches), e.g. of the partitions or comparison stages
+        merged = {}
+        for sketches in sketch_dicts:
+            for name, cohort_sketches in sketches.items():
+                if name in merged:
+                    merged[name].merge(cohort_sketches)
+                else:
+                    merged[name] = cohort_sketches
+
+        return merged
+
+    def _save_sketches(self, sketches, file_path):
+        if not sketches:
+            return
+
+        # A Parquet file per cohort, they can be loaded with CohortSketches().load and passed to ComparePlayers as cohort_sketches
+        sketch_dir = file_path + "_sketches"
+        print(f"Saving the quantile sketches to {sketch_dir}")
+        for name, cohort_sketches in sketches.items():
+            cohort_sketches.save(os.path.join(sketch_dir, f"{name}.parquet"))
+
+    def _save_clamp_report(self, clamp_reports, file_path):
+
+        # The padj stage doesn't run when it's loaded from the stage cache, the report of that run is saved next to its database
+        if not clamp_reports:
+            print("The possession adjustment was loaded from the stage cache, no clamp report is saved")
+            return
+
+        report = pd.concat(clamp_reports).groupby(level=0, sort=False).sum()
+        report_path = file_path + "_clamp_report.csv"
+        print(f"Possession ratios filled or clamped to {list(PadjMaker.ratio_bounds)}, the report is saved to {report_path}:\n{report}")
+        report.to_csv(report_path, index_label="ratio")
+
+    def _measure(self, metrics, stage, function, inputs = (), written_path = None):
+        if metrics is None:
+            return function(*inputs)
+
+        return metrics.measure(stage, function, inputs, written_path=written_path)
+
+    def _create_base(self, base_creator, source_path, test, precision = None):
+        print("Creating the base data")
+        df = base_creator.get_base(source_path)
 
         if test: 
             df = df[0:500]
-        
-        # Adding extra features
-        print("Step 2: Adding extra metrics")
-        df = GetExtraFeatures()._create_extra_metrics(df)
-        
-        # Making the adjusted data
-        print("Step 3: Adjusting the data by making stats possession adjusted")
-        df = PadjMaker()._make_df_padj(df)
-        
-        # Calculating statistical comparisons between players
-        print("Step 4: Calculating player comparisons")
-        df = ComparePlayers()._calculate_statistical_comparisons(df)
-        
-        # Calculating KPIs and storing them
-        print("Step 5: Calculating and storing KPIs")
-        df = CalculateKPI().store_kpi_and_total(df, "general.py")
-        
-        # Generate a filename with the current datetime
-        current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        file_name = f"wyscout_data_{current_time}.csv"
-        file_path = os.path.join("storage", "db", file_name)
-        
-        # Saving the data to CSV
-        print(f"Step 6: Saving data to {file_path}")
-        df.to_csv(file_path, index=False)
 
-        print("ETL Pipeline finished successfully.")
+        # The score columns are parsed and cached as float32, in float64 mode every stage calculates with their decimal values
+        return (precision or FloatPrecision()).widen(df)
+
+    # The stages add columns to their input frames in place (mutates_input=True), the stage graph gives
+    # them shallow copies of the outputs of other stages
+
+    def _add_extra_metrics(self, df, demand = None, foul_statistics = None):
+        print("Adding extra metrics")
+        metrics = None if demand is None else demand.get_derived_metrics()
+
+        return GetExtraFeatures(metrics=metrics)._create_extra_metrics(df, foul_statistics=foul_statistics)
+
+    def _make_padj(self, df, demand = None, team_possession = None, dtype = "float64", possession_table = None, clamp_reports = None):
+        print("Adjusting the data by making stats possession adjusted")
+        padj_maker = PadjMaker(team_possession=team_possession, possession_table=possession_table, dtype=dtype)
+        if demand is None:
+            df = padj_maker._make_df_padj(df)
+        else:
+            in_possession, out_possession = demand.get_padj_columns()
+            df = padj_maker._make_df_padj(df, in_possession=in_possession, out_possession=out_possession)
+
+        if clamp_reports is not None:
+            clamp_reports.append(padj_maker.clamp_report)
+
+        return df
+
+    def _compare_metrics(self, df, demand = None, cohort_store = None, cohorts = None, quantile_error = None, sketches = None):
+        print("Calculating player comparisons of the unadjusted stats")
+        comparer = ComparePlayers()
+        columns = comparer._get_to_compare_columns(df)
+        if demand is not None:
+            columns = demand.get_compare_columns(columns)
+
+        comparison_df = comparer._calculate_statistical_comparisons(
+            df, to_compare_columns=columns, cohort_store=cohort_store, cohorts=cohorts, quantile_error=quantile_error
+        )
+        if sketches is not None:
+            sketches.update(comparer.cohort_sketches)
+
+        return self._get_comparison_block(comparison_df, columns, cohorts)
+
+    def _compare_padj(self, df, demand = None, cohort_store = None, cohorts = None, quantile_error = None, sketches = None):
+        print("Calculating player comparisons of the possession adjusted stats")
+        comparer = ComparePlayers()
+        columns = [i for i in comparer._get_to_compare_columns(df) if i.endswith("_padj")]
+        if demand is not None:
+            columns = demand.get_compare_columns(columns)
+
+        comparison_df = comparer._calculate_statistical_comparisons(
+            df, to_compare_columns=columns, cohort_store=cohort_store, cohorts=cohorts, quantile_error=quantile_error
+        )
+        if sketches is not None:
+            sketches.update(comparer.cohort_sketches)
+
+        return self._get_comparison_block(comparison_df, columns, cohorts)
+
+    def _get_comparison_block(self, df, columns, cohorts = None):
+
+        # The comparisons within the default cohort, followed by those of the other cohorts
+        prefixes = [""] + [f"{i}_" for i in (cohorts or {})]
+        return df[[f"{prefix}{metric}_{i}" for prefix in prefixes for i in columns for metric in ["zscore", "quantile"]]]
+
+    def _calculate_kpis(self, padj_df, compare_metrics_df, compare_padj_df, kpi_method, cohorts = None):
+        df = self._combine_comparisons(padj_df, compare_metrics_df, compare_padj_df, cohorts)
+
+        print("Calculating and storing KPIs")
+        return CalculateKPI().store_kpi_and_total(df, kpi_method)
+
+    def _combine_comparisons(self, padj_df, compare_metrics_df, compare_padj_df, cohorts = None):
+
+        # Combine the comparisons in the order of the compared columns, the same order as comparing all columns at once
+        comparer = ComparePlayers()
+        df = comparer._add_main_position(padj_df)
+        comparison_df = pd.concat([compare_metrics_df, compare_padj_df], axis=1)
+        compared_columns = [i for i in comparer._get_to_compare_columns(df) if f"zscore_{i}" in comparison_df]
+
+        return pd.concat([df, self._get_comparison_block(comparison_df, compared_columns, cohorts)], axis=1)
+
+    def _add_sketch_comparisons(self, df, cohorts, cohort_sketches):
+
+        # The comparisons within the cohorts with merged sketches, added to a combined frame in the order of the stage graph
+        comparer = ComparePlayers()
+        compared_columns = [i for i in comparer._get_to_compare_columns(df) if f"zscore_{i}" in df]
+
+        comparison_dfs = []
+        for name, sketches in cohort_sketches.items():
+            zscores, quantiles = comparer._compare_with_sketches(df, compared_columns, sketches, GroupStatistics(df, sketches.group_columns))
+            comparison_dfs.append(pd.DataFrame(
+                {f"{name}_{metric}_{i}": values[i] for i in compared_columns for metric, values in [("zscore", zscores), ("quantile", quantiles)]},
+                index=df.index
+            ))
+
+        df = pd.concat([df] + comparison_dfs, axis=1)
+        comparison_columns = list(self._get_comparison_block(df, compared_columns, cohorts).columns)
+
+        return df[[i for i in df.columns if i not in set(comparison_columns)] + comparison_columns]
+
+
+# The stages of a partition run in a worker process, so they are module level functions
+
+def _create_partition_features(df, demand, team_possession, possession_table, foul_statistics, precision, cohorts, quantile_error = None):
+
+    # The stages of the graph up to the comparisons, the inputs that are modified in place are shallow copies.
+    # The cohorts spanning several competitions (only in sketch mode) are only sketched, they are compared in
+    # _calculate_partition_kpis with the sketches of all partitions.
+    pipelines = ETLPipelines()
+    cast = precision.cast
+    pooled_cohorts = {k: v for k, v in cohorts.items() if not set(StreamingETL.competition_columns) <= set(v)}
+    partition_cohorts = {k: v for k, v in cohorts.items() if k not in pooled_cohorts}
+    metrics_sketches, padj_sketches, clamp_reports = {}, {}, []
+
+    extra_df = cast(pipelines._add_extra_metrics(df, demand, foul_statistics))
+    padj_df = cast(pipelines._make_padj(extra_df.copy(deep=False), demand, team_possession, precision.dtype, possession_table, clamp_reports))
+    compare_metrics_df = cast(pipelines._compare_metrics(extra_df.copy(deep=False), demand, None, partition_cohorts, quantile_error, metrics_sketches))
+    compare_padj_df = cast(pipelines._compare_padj(padj_df.copy(deep=False), demand, None, partition_cohorts, quantile_error, padj_sketches))
+    df = pipelines._combine_comparisons(padj_df, compare_metrics_df, compare_padj_df, partition_cohorts)
+
+    sketches = pipelines._merge_sketches([metrics_sketches, padj_sketches])
+    if pooled_cohorts:
+        compared_columns = [i for i in ComparePlayers()._get_to_compare_columns(df) if f"zscore_{i}" in df]
+        sketches.update({k: CohortSketches(v, quantile_error).update(df, compared_columns) for k, v in pooled_cohorts.items()})
+
+    return df, sketches, clamp_reports[0]
+
+def _calculate_partition_kpis(df, kpi_method, fill_values, precision, cohorts = None, cohort_sketches = None):
+    if cohort_sketches:
+        df = ETLPipelines()._add_sketch_comparisons(df, cohorts, cohort_sketches)
+
+    return precision.cast(CalculateKPI().store_kpi_and_total(df, kpi_method, fill_values=fill_values))
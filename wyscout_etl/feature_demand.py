@@ -0,0 +1,127 @@
+from config.extra_variable_column_info import derived_metric_definitions, in_possession_variables, out_possession_variables
+from wyscout_etl.calculate_totals import CalculateKPI
+
+
+class FeatureDemand:
+    """
+    A class for determining the columns a run of the pipeline actually needs.
+
+    By default the pipeline calculates every derived metric, possession adjusts every column in the
+    possession lists and compares players on every stat column. Only the variables of the KPI method
+    and the columns of the reports are used afterwards. Walking back from those columns gives the
+    minimal set of comparisons, possession adjusted columns and derived metrics:
+    - A KPI variable is compared, and its possession adjusted version when it has one, because the
+      KPIs use both.
+    - A report column `zscore_x` or `quantile_x` needs the comparison of `x`, other report columns
+      are needed as values.
+    - A possession adjusted column is needed when it is compared or reported.
+    - A derived metric is needed when it is compared, reported or possession adjusted. The derived
+      metrics it is calculated from are added by the DerivedMetricEngine.
+
+    Attributes:
+        kpi_method (str): The KPI method in config/kpi_methods.
+        report_columns (list[str]): The columns of the output that are used besides the KPIs.
+        value_columns (list[str]): The stat columns whose values are needed, including the compared columns.
+        compare_columns (list[str]): The columns whose comparisons are needed.
+
+    Methods:
+        __init__(kpi_method, report_columns): Initializes the FeatureDemand class.
+        get_derived_metrics(): Determines the derived metrics that are needed.
+        get_padj_columns(): Determines the in and out of possession columns that need to be adjusted.
+        get_compare_columns(columns): Selects the columns whose comparisons are needed.
+        get_config(): Creates a summary of the demand for the stage fingerprints.
+        _add_value_column(column): Adds a needed column and the possession adjusted source it needs.
+    """
+
+    def __init__(self, kpi_method: str = "general.py", report_columns: list[str] = None) -> None:
+        """
+        Initialize the FeatureDemand class.
+
+        Args:
+            kpi_method (str): The KPI method in config/kpi_methods. Defaults to 'general.py'.
+            report_columns (list[str]): The columns of the output that are used besides the KPIs. Defaults to None.
+        """
+        self.kpi_method = kpi_method
+        self.report_columns = list(report_columns or [])
+
+        self.value_columns = []
+        self.compare_columns = []
+
+        kpi_scoring_values = CalculateKPI()._import_variables_from_script(kpi_method)[1]
+        padj_sources = in_possession_variables + out_possession_variables
+
+        for variables in kpi_scoring_values.values():
+            for variable in variables:
+                self.compare_columns.append(variable)
+                if variable in padj_sources:
+                    self.compare_columns.append(f"{variable}_padj")
+
+        for column in self.report_columns:
+            for prefix in ["zscore_", "quantile_"]:
+                if column.startswith(prefix):
+                    column = column[len(prefix):]
+                    self.compare_columns.append(column)
+                    break
+
+            self._add_value_column(column)
+
+        self.compare_columns = list(dict.fromkeys(self.compare_columns))
+        for column in self.compare_columns:
+            self._add_value_column(column)
+
+    def get_derived_metrics(self) -> list[str]:
+        """
+        Determine the derived metrics that are needed, in the order of the definitions.
+
+        Returns:
+            list[str]: The needed derived metrics, without the metrics they are calculated from.
+        """
+        return [i for i in derived_metric_definitions if i in self.value_columns]
+
+    def get_padj_columns(self) -> tuple[list[str], list[str]]:
+        """
+        Determine the columns that need to be possession adjusted, in the order of the possession lists.
+
+        Returns:
+            tuple[list[str], list[str]]: The in possession and the out of possession columns.
+        """
+        in_possession = [i for i in in_possession_variables if f"{i}_padj" in self.value_columns]
+        out_possession = [i for i in out_possession_variables if f"{i}_padj" in self.value_columns]
+
+        return in_possession, out_possession
+
+    def get_compare_columns(self, columns: list[str]) -> list[str]:
+        """
+        Select the columns whose comparisons are needed, keeping the order of `columns`.
+
+        Args:
+            columns (list[str]): The columns that can be compared.
+
+        Returns:
+            list[str]: The columns that need to be compared.
+        """
+        return [i for i in columns if i in self.compare_columns]
+
+    def get_config(self) -> list:
+        """
+        Create a summary of the demand, so the fingerprints of the stages change when the demand changes.
+
+        Returns:
+            list: The needed derived metrics, possession adjusted columns and comparisons.
+        """
+        return [self.get_derived_metrics(), *self.get_padj_columns(), self.compare_columns]
+
+    def _add_value_column(self, column: str) -> None:
+        """
+        Add a needed column, and for a possession adjusted column the column it's adjusted from.
+
+        Args:
+            column (str): The needed column.
+        """
+        if column in self.value_columns:
+            return
+
+        self.value_columns.append(column)
+
+        if column.endswith("_padj") and column[: -len("_padj")] in in_possession_variables + out_possession_variables:
+            self._add_value_column(column[: -len("_padj")])
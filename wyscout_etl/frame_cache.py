@@ -0,0 +1,135 @@
+import pandas as pd
+import hashlib
+import json
+import os
+import re
+
+
+class FrameCache:
+    """
+    A class for persisting intermediate DataFrames of the ETL as Parquet files.
+
+    Every cached frame is stored under a name and a fingerprint. The fingerprint is a hash
+    of everything the frame was created from (input files and configuration), so a cached
+    frame is only reused when none of its inputs changed. Storing a new version of a frame
+    removes the older versions with the same name.
+
+    Attributes:
+        cache_dir (str): The directory in which the cached frames are stored.
+
+    Methods:
+        __init__(cache_dir): Initializes the FrameCache class.
+        fingerprint(file_paths, config_objects): Creates a fingerprint of files and configuration objects.
+        exists(name, fingerprint): Checks whether a frame is cached, without loading it.
+        load(name, fingerprint): Loads a cached frame, or returns None if it does not exist.
+        store(name, fingerprint, df): Stores a frame in the cache.
+        get_path(name, fingerprint): Gets the location of a cached frame.
+    """
+
+    def __init__(self, cache_dir: str = os.path.join("storage", "cache")) -> None:
+        """
+        Initialize the FrameCache class.
+
+        Args:
+            cache_dir (str): The directory in which the cached frames are stored.
+                             Defaults to 'storage/cache'.
+        """
+        self.cache_dir = cache_dir
+
+    def fingerprint(self, file_paths: list[str] = (), config_objects: list = ()) -> str:
+        """
+        Create a fingerprint from the path, size and modification time of files and the
+        contents of JSON serialisable configuration objects.
+
+        Args:
+            file_paths (list[str]): The files the cached frame depends on.
+            config_objects (list): Configuration objects (lists, dicts, strings) the cached frame depends on.
+
+        Returns:
+            str: A hexadecimal fingerprint.
+        """
+        file_info = []
+        for path in file_paths:
+            stat = os.stat(path)
+            file_info.append([os.path.normpath(path), stat.st_size, stat.st_mtime_ns])
+
+        payload = json.dumps([file_info, list(config_objects)], sort_keys=True, default=str)
+
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+    def exists(self, name: str, fingerprint: str) -> bool:
+        """
+        Check whether a frame is cached, without loading it.
+
+        Args:
+            name (str): The name of the cached frame.
+            fingerprint (str): The fingerprint the frame was stored with.
+
+        Returns:
+            bool: Whether there is a frame for this fingerprint.
+        """
+        return os.path.exists(self.get_path(name, fingerprint))
+
+    def load(self, name: str, fingerprint: str) -> pd.DataFrame | None:
+        """
+        Load a cached frame.
+
+        Args:
+            name (str): The name of the cached frame.
+            fingerprint (str): The fingerprint the frame was stored with.
+
+        Returns:
+            pd.DataFrame | None: The cached frame, or None if there is no frame for this fingerprint.
+        """
+        path = self.get_path(name, fingerprint)
+        if not os.path.exists(path):
+            return None
+
+        return pd.read_parquet(path)
+
+    def store(self, name: str, fingerprint: str, df: pd.DataFrame) -> None:
+        """
+        Store a frame in the cache and remove older versions of it.
+
+        Frames that can't be written to Parquet (e.g. columns with mixed types) are not
+        cached; the ETL keeps working without the cache.
+
+        Args:
+            name (str): The name of the cached frame.
+            fingerprint (str): The fingerprint to store the frame with.
+            df (pd.DataFrame): The frame to cache.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        path = self.get_path(name, fingerprint)
+        temp_path = path + ".tmp"
+
+        try:
+            df.to_parquet(temp_path)
+        except (TypeError, ValueError, OverflowError, NotImplementedError) as error:
+            print(f"Could not cache {name}: {error}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        # Only replace the cached file once it is completely written
+        os.replace(temp_path, path)
+
+        old_version = re.compile(rf"{re.escape(name)}_[0-9a-f]+\.parquet")
+        for file_name in os.listdir(self.cache_dir):
+            old_path = os.path.join(self.cache_dir, file_name)
+            if old_version.fullmatch(file_name) and old_path != path:
+                os.remove(old_path)
+
+    def get_path(self, name: str, fingerprint: str) -> str:
+        """
+        Get the location of a cached frame.
+
+        Args:
+            name (str): The name of the cached frame.
+            fingerprint (str): The fingerprint of the cached frame.
+
+        Returns:
+            str: The path of the Parquet file.
+        """
+        return os.path.join(self.cache_dir, f"{name}_{fingerprint}.parquet")
@@ -0,0 +1,230 @@
+import pandas as pd
+import numpy as np
+
+
+class GroupStatistics:
+    """
+    A class for calculating the z-scores and percentile ranks of many columns within groups of rows.
+
+    The group columns are factorized once, after which the rows are sorted by group (keeping their
+    order within a group). The moments (count, sum, sum of squares, mean and standard deviation) are
+    then calculated with a loop over the groups, each group in one vectorised pass over the 2-D block of
+    all its columns of one dtype, and the z-scores of all rows follow from the moments of their group.
+    This replaces a groupby transform with a Python function per column and group. The groups are not
+    summed with one np.add.reduceat over all rows: reduceat adds the rows one after the other, while
+    pandas sums a column pairwise, so the moments would differ in the last bits and a z-score on a
+    rounding boundary could round the other way.
+
+    The percentile ranks start from the rows of every column sorted by value (get_sorted_rows). A
+    stable sort of those rows by group, a counting sort of small integers, keeps every group sorted by
+    value, after which the ranks follow from the positions within the group. The rows sorted by value
+    don't depend on the groups, so several groupings of the same rows (e.g. the cohorts of
+    ComparePlayers) share them and the values are only sorted once.
+
+    The results are the same as those of ComparePlayers._standardize_func and _quantile_func per
+    group: the mean and the standard deviation (ddof=1) skip missing values and are calculated with
+    the same two-pass arithmetic as pandas, in the precision of the column, and rounded to two
+    decimals. Groups without any value give missing values, rows with a missing group key as well.
+
+    Attributes:
+        group_columns (list[str]): The columns defining the groups.
+        n_groups (int): The number of groups.
+        codes (np.ndarray): The group of every row, -1 for rows with a missing group key.
+        order (np.ndarray): The positions of the grouped rows, sorted by group.
+        moment_names (list[str]): The moments calculated per group and column.
+        bounds (np.ndarray): The start of every group in `order`, followed by the end of the last group.
+
+    Methods:
+        __init__(df, group_columns): Initializes the GroupStatistics class.
+        get_moments(values, groups): Calculates the moments of every column per group.
+        get_zscores(values, moments): Calculates the z-scores of every column within the groups.
+        get_quantiles(values, groups, sorted_rows): Calculates the percentile ranks of every column within the groups.
+        _get_block_moments(values): Calculates the moments of every column of one group.
+    """
+
+    # The moments per group and column
+    moment_names = ["count", "sum", "sum_squares", "mean", "std"]
+
+    def __init__(self, df: pd.DataFrame, group_columns: list[str]) -> None:
+        """
+        Initialize the GroupStatistics class.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the group columns.
+            group_columns (list[str]): The columns defining the groups.
+        """
+        self.group_columns = list(group_columns)
+        group_numbers = df.groupby(self.group_columns, observed=True, sort=False).ngroup()
+
+        self.n_groups = int(group_numbers.max()) + 1 if group_numbers.notna().any() else 0
+        self.codes = group_numbers.fillna(-1).to_numpy(dtype=np.intp)
+
+        # A stable sort keeps the rows of a group in their original order, the order in which they are summed
+        grouped_rows = np.flatnonzero(self.codes >= 0)
+        self.order = grouped_rows[np.argsort(self.codes[grouped_rows], kind="stable")]
+        self.bounds = np.concatenate([[0], np.cumsum(np.bincount(self.codes[grouped_rows], minlength=self.n_groups))])
+
+    def get_moments(self, values: np.ndarray, groups: np.ndarray = None) -> dict:
+        """
+        Calculate the moments of every column per group: the number of values, their sum and sum of
+        squares (in double precision), and the mean and standard deviation (in the dtype of the values).
+        The groups are calculated one at a time, all columns of a group at once.
+
+        Args:
+            values (np.ndarray): The columns as a 2-D float array (rows x columns) of one dtype.
+            groups (np.ndarray): The groups to calculate the moments of. Defaults to None (all groups).
+
+        Returns:
+            dict: Per moment a 2-D array (groups x columns), missing for the groups that are not calculated.
+        """
+        groups = np.arange(self.n_groups) if groups is None else groups
+        moments = {i: np.full((self.n_groups, values.shape[1]), np.nan, dtype=values.dtype) for i in ["mean", "std"]}
+        moments.update({i: np.full((self.n_groups, values.shape[1]), np.nan) for i in ["count", "sum", "sum_squares"]})
+
+        for group in groups:
+            rows = self.order[self.bounds[group]:self.bounds[group + 1]]
+
+            # Every column of the block is contiguous, so it's summed the same way as a single column
+            block_moments = self._get_block_moments(np.asfortranarray(values[rows]))
+            for name, block_moment in block_moments.items():
+                moments[name][group] = block_moment
+
+        return moments
+
+    def get_zscores(self, values: np.ndarray, moments: dict = None) -> np.ndarray:
+        """
+        Calculate the z-scores of every column within the groups, rounded to two decimals.
+
+        Args:
+            values (np.ndarray): The columns as a 2-D float array (rows x columns) of one dtype.
+            moments (dict): The mean and standard deviation per group and column, e.g. from get_moments.
+                            Defaults to None, in which case they are calculated.
+
+        Returns:
+            np.ndarray: The z-scores, in the dtype of the values.
+        """
+        if moments is None:
+            moments = self.get_moments(values)
+
+        grouped = self.codes >= 0
+        codes = self.codes[grouped]
+        zscores = np.full(values.shape, np.nan, dtype=values.dtype)
+
+        with np.errstate(all="ignore"):
+            mean = moments["mean"].astype(values.dtype, copy=False)[codes]
+            std = moments["std"].astype(values.dtype, copy=False)[codes]
+            zscores[grouped] = np.round((values[grouped] - mean) / std, 2)
+
+        return zscores
+
+    def get_quantiles(self, values: np.ndarray, groups: np.ndarray = None, sorted_rows: np.ndarray = None) -> np.ndarray:
+        """
+        Calculate the percentile ranks (average rank of ties divided by the number of values) of every
+        column within the groups, rounded to two decimals.
+
+        Args:
+            values (np.ndarray): The columns as a 2-D array (rows x columns).
+            groups (np.ndarray): The groups to calculate the percentile ranks of. Defaults to None (all groups).
+            sorted_rows (np.ndarray): The rows of every column sorted by value, from get_sorted_rows.
+                                      Defaults to None, in which case they are sorted.
+
+        Returns:
+            np.ndarray: The percentile ranks as float64, missing for the rows of other groups.
+        """
+        if sorted_rows is None:
+            sorted_rows = get_sorted_rows(values)
+
+        # The rows that are not ranked (rows with a missing group key or of other groups) get the key
+        # after the last group. Small keys are sorted with a counting sort.
+        keys = self.codes.copy()
+        keys[keys < 0] = self.n_groups
+        if groups is not None:
+            keys[~np.isin(keys, groups)] = self.n_groups
+        keys = keys.astype(np.int16 if self.n_groups < np.iinfo(np.int16).max else np.intp)
+
+        # Column by column, in column order so the columns are contiguous
+        quantiles = np.full(values.shape, np.nan, order="F")
+
+        for j in range(values.shape[1]):
+            # The missing values are sorted last and have no rank
+            column = values[:, j]
+            rows = sorted_rows[:len(column) - np.count_nonzero(np.isnan(column)), j]
+            column_keys = keys[rows]
+
+            # A stable sort by group keeps the rows of every group sorted by value, the rows that are not ranked come last
+            by_group = np.argsort(column_keys, kind="stable")
+            n_ranked = int(np.count_nonzero(column_keys < self.n_groups))
+            if n_ranked == 0:
+                continue
+            rows = rows[by_group[:n_ranked]]
+            column_values, column_keys = column[rows], keys[rows]
+
+            sizes = np.bincount(column_keys, minlength=self.n_groups)
+            group_starts = (np.cumsum(sizes) - sizes)[column_keys]
+
+            # Runs of equal values within a group share the average of their ranks
+            new_run = np.ones(n_ranked, dtype=bool)
+            new_run[1:] = (column_keys[1:] != column_keys[:-1]) | (column_values[1:] != column_values[:-1])
+            run_starts = np.flatnonzero(new_run)
+            run_ends = np.append(run_starts[1:], n_ranked)
+            runs = np.cumsum(new_run) - 1
+
+            average_ranks = ((run_starts[runs] - group_starts + 1) + (run_ends[runs] - group_starts)) / 2
+            quantiles[rows, j] = average_ranks / sizes[column_keys]
+
+        return np.round(quantiles, 2)
+
+    def _get_block_moments(self, values: np.ndarray) -> dict:
+        """
+        Calculate the moments of every column of one group. The mean and standard deviation are
+        calculated with the arithmetic of pandas' Series.mean and Series.std.
+
+        Args:
+            values (np.ndarray): The values of the group (rows x columns), Fortran ordered.
+
+        Returns:
+            dict: Per moment an array with a value per column.
+        """
+        dtype = values.dtype
+        mask = np.isnan(values)
+
+        filled = values.copy(order="F")
+        np.putmask(filled, mask, 0)
+        count = (len(values) - mask.sum(axis=0)).astype(dtype)
+
+        with np.errstate(all="ignore"):
+            moments = {
+                "count": count.astype("float64"),
+                "sum": filled.sum(axis=0, dtype="float64"),
+                "sum_squares": np.square(filled, dtype="float64").sum(axis=0),
+                "mean": filled.sum(axis=0, dtype=dtype) / count,
+            }
+
+            # Two-pass variance, a column with less than two values has no standard deviation
+            count[count <= 1] = np.nan
+            average = moments["sum"] / count
+            squares = (average - filled) ** 2
+            np.putmask(squares, mask, 0)
+            moments["std"] = np.sqrt((squares.sum(axis=0, dtype="float64") / (count - dtype.type(1))).astype(dtype))
+
+        return moments
+
+
+def get_sorted_rows(values: np.ndarray) -> np.ndarray:
+    """
+    Sort the rows of every column by value, missing values last. The result only depends on the
+    values, so it can be shared by the percentile ranks of several groupings of the rows.
+
+    Args:
+        values (np.ndarray): The columns as a 2-D array (rows x columns).
+
+    Returns:
+        np.ndarray: The rows of every column sorted by value (rows x columns), as 32-bit integers when they fit.
+    """
+    sorted_rows = np.empty(values.shape, dtype=np.int32 if len(values) < np.iinfo(np.int32).max else np.intp)
+
+    # Column by column, so only one column of 64-bit positions exists at a time
+    for j in range(values.shape[1]):
+        sorted_rows[:, j] = np.argsort(values[:, j])
+
+    return sorted_rows
@@ -0,0 +1,192 @@
+import pandas as pd
+import hashlib
+import json
+import os
+
+
+class IngestionManifest:
+    """
+    A class for keeping track of the Wyscout exports that have already been ingested.
+
+    Every parsed export is stored as a separate Parquet part, and the manifest records the
+    name, size, modification time, content hash and row count of the export it came from.
+    On the next run only new or modified exports have to be parsed, the parts of unchanged
+    exports are reused and the parts of deleted exports are evicted.
+
+    The manifest also records the settings the parts were parsed with. When those settings
+    change, all parts are considered outdated.
+
+    Attributes:
+        store_dir (str): The directory containing the manifest and the Parquet parts.
+        parse_settings (str): A fingerprint of the settings used to parse the exports.
+        files (dict): The manifest entries, keyed by export file name.
+
+    Methods:
+        __init__(store_dir, parse_settings): Initializes the class and loads the manifest from disk.
+        split_files(file_names, base_path): Splits the exports into unchanged and to be parsed exports.
+        evict_missing(file_names): Removes the parts of exports that no longer exist.
+        load_part(file_name): Loads the stored part of an unchanged export.
+        store_part(file_name, base_path, df): Stores the part of a parsed export and records it.
+        save(): Writes the manifest to disk.
+    """
+
+    def __init__(self, store_dir: str, parse_settings: str) -> None:
+        """
+        Initialize the IngestionManifest class and load the manifest from disk.
+
+        Args:
+            store_dir (str): The directory containing the manifest and the Parquet parts.
+            parse_settings (str): A fingerprint of the settings used to parse the exports.
+        """
+        self.store_dir = store_dir
+        self.parse_settings = parse_settings
+        self.files = {}
+
+        manifest_path = self._get_manifest_path()
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+
+            # Parts parsed with other settings can't be reused
+            if manifest.get("parse_settings") == parse_settings:
+                self.files = manifest.get("files", {})
+
+    def split_files(self, file_names: list[str], base_path: str) -> tuple[list[str], list[str]]:
+        """
+        Split the exports into exports with a reusable part and exports that need parsing.
+
+        The size and modification time are compared first. Only when those changed, the
+        content hash is calculated to check whether the export really changed.
+
+        Args:
+            file_names (list[str]): The export file names.
+            base_path (str): The directory where the exports are located.
+
+        Returns:
+            tuple[list[str], list[str]]: The unchanged exports and the new or modified exports.
+        """
+        unchanged_files = []
+        to_parse_files = []
+
+        for file_name in file_names:
+            entry = self.files.get(file_name)
+            path = os.path.join(base_path, file_name)
+
+            if entry is None or not os.path.exists(self._get_part_path(file_name)):
+                to_parse_files.append(file_name)
+                continue
+
+            stat = os.stat(path)
+            if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                unchanged_files.append(file_name)
+            elif entry["hash"] == self._hash_file(path):
+                # The file was touched but the content is the same
+                entry["size"] = stat.st_size
+                entry["mtime_ns"] = stat.st_mtime_ns
+                unchanged_files.append(file_name)
+            else:
+                to_parse_files.append(file_name)
+
+        return unchanged_files, to_parse_files
+
+    def evict_missing(self, file_names: list[str]) -> list[str]:
+        """
+        Remove the parts and manifest entries of exports that no longer exist.
+
+        Args:
+            file_names (list[str]): The export file names that currently exist.
+
+        Returns:
+            list[str]: The evicted export file names.
+        """
+        evicted_files = [i for i in self.files if i not in set(file_names)]
+
+        for file_name in evicted_files:
+            print(f"Evicting: {file_name}")
+            part_path = self._get_part_path(file_name)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            del self.files[file_name]
+
+        return evicted_files
+
+    def load_part(self, file_name: str) -> pd.DataFrame:
+        """
+        Load the stored part of an export.
+
+        Args:
+            file_name (str): The export file name.
+
+        Returns:
+            pd.DataFrame: The parsed contents of the export.
+        """
+        return pd.read_parquet(self._get_part_path(file_name))
+
+    def store_part(self, file_name: str, base_path: str, df: pd.DataFrame) -> None:
+        """
+        Store the part of a parsed export and record it in the manifest.
+
+        Exports that can't be written to Parquet are not recorded, so they are parsed
+        again on the next run.
+
+        Args:
+            file_name (str): The export file name.
+            base_path (str): The directory where the export is located.
+            df (pd.DataFrame): The parsed contents of the export.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        part_path = self._get_part_path(file_name)
+
+        try:
+            df.to_parquet(part_path)
+        except (TypeError, ValueError, OverflowError, NotImplementedError) as error:
+            print(f"Could not store the part of {file_name}: {error}")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            self.files.pop(file_name, None)
+            return
+
+        path = os.path.join(base_path, file_name)
+        stat = os.stat(path)
+
+        self.files[file_name] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": self._hash_file(path),
+            "rows": len(df),
+        }
+
+    def save(self) -> None:
+        """
+        Write the manifest to disk.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        manifest_path = self._get_manifest_path()
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as manifest_file:
+            json.dump({"parse_settings": self.parse_settings, "files": self.files}, manifest_file, indent=2)
+
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def _hash_file(self, path: str) -> str:
+        """
+        Calculate the SHA-256 hash of a file's content.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            str: The hexadecimal hash.
+        """
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                file_hash.update(block)
+
+        return file_hash.hexdigest()
+
+    def _get_manifest_path(self) -> str:
+        return os.path.join(self.store_dir, "manifest.json")
+
+    def _get_part_path(self, file_name: str) -> str:
+        return os.path.join(self.store_dir, os.path.splitext(file_name)[0] + ".parquet")
@@ -2,13 +2,21 @@
 import pandas as pd 
 import numpy as np 
 
+from config.comparison_cohorts import comparison_cohorts, default_comparison_cohort
 from config.pos_translation import pos_translation_dict
 from config.wyscout_column_info import wyscout_personal_columns, wyscout_team_season_columns
+from wyscout_etl.cohort_store import CohortStatisticsStore
+from wyscout_etl.group_statistics import GroupStatistics, get_sorted_rows
+from wyscout_etl.quantile_sketch import CohortSketches
 
 class ComparePlayers:
 
+    # The players are compared within the default cohort, by default their competition and main position
+    compare_group_columns = comparison_cohorts[default_comparison_cohort]
+
     def __init__(self):
-        pass
+        # The quantile sketches per cohort built by the last comparisons in sketch mode
+        self.cohort_sketches = {}
 
     def _calculate_statistical_comparisons(
         self,
@@ -16,59 +24,158 @@ class ComparePlayers:
         pos_translation_list: dict = pos_translation_dict,
         standardize: bool = True,
         quantalize: bool = True,
+        to_compare_columns: list = None,
+        cohort_store: CohortStatisticsStore = None,
+        cohorts: dict = None,
+        quantile_error: float = None,
+        cohort_sketches: dict = None,
     ):
 
+        # Contract: main_position is added to df in place, the comparisons are returned in a new frame
+
         # Translate player positions based on the pos_translation_list
-        df["main_position"] = (
-            df["primary_position"].map(pos_translation_list).fillna("UNKNOWN")
+        df = self._add_main_position(df, pos_translation_list)
+
+        # Only the given columns are compared, by default all stat columns
+        if to_compare_columns is None:
+            to_compare_columns = self._get_to_compare_columns(df)
+
+        # The default cohort gives the zscore_ and quantile_ columns, the other cohorts (name: group columns)
+        # give columns prefixed with their name
+        cohorts = {default_comparison_cohort: self.compare_group_columns, **{k: v for k, v in (cohorts or {}).items() if k != default_comparison_cohort}}
+
+        print("Comparing players on {} columns within {} cohorts".format(len(to_compare_columns), len(cohorts)))
+
+        # The groups of every cohort are determined once, the float columns are compared per dtype in one pass over all columns.
+        # With a cohort store only the groups of the default cohort whose values changed since the last run are aggregated again.
+        statistics = {name: GroupStatistics(df, group_columns) for name, group_columns in cohorts.items()}
+        float_columns = [i for i in to_compare_columns if df[i].dtype in ("float64", "float32")]
+
+        # With a quantile error the quantiles are approximated from a quantile sketch per group and column, the sketches are
+        # kept in self.cohort_sketches. Cohorts with given sketches (e.g. merged over all chunks of a streaming run) are
+        # compared with those sketches, the z-scores with the moments merged in the sketches.
+        comparisons = {}
+        if cohort_store is not None and float_columns:
+            comparisons[default_comparison_cohort] = cohort_store.compare(df, float_columns, statistics[default_comparison_cohort])
+        for name, sketches in (cohort_sketches or {}).items():
+            if name in statistics and name not in comparisons:
+                comparisons[name] = self._compare_with_sketches(df, float_columns, sketches, statistics[name])
+        comparisons.update(
+            self._compare_float_columns(df, float_columns, {k: v for k, v in statistics.items() if k not in comparisons}, quantile_error)
         )
 
-        # special columns is list containing all variables that are made inbetween but dont contain stats 
-        special_columns = ["main_position", "possession_ratio", "no_possession_ratio"]
+        comparison_dfs = []
+        for name, cohort_statistics in statistics.items():
+            prefix = "" if name == default_comparison_cohort else f"{name}_"
+            zscores, quantiles = comparisons[name]
+
+            zscore_columns = {f"zscore_{i}": zscores[i] for i in float_columns}
+            quantile_columns = {}
+            for i in float_columns:
+                # A column without any value in the groups keeps its dtype, like the unchanged groups of a transform
+                all_missing = df[i].isna().to_numpy()[cohort_statistics.order].all()
+                quantile_columns[f"quantile_{i}"] = quantiles[i].astype(df[i].dtype) if all_missing else quantiles[i]
+
+            # Other columns (e.g. nullable integers) are compared per column
+            other_columns = [i for i in to_compare_columns if i not in float_columns]
+            if other_columns:
+                grouped = df.groupby(cohort_statistics.group_columns, observed=True)
+                for i in other_columns:
+                    comparison = self._recalculate_column(grouped, to_altered_column=i)
+                    zscore_columns[f"zscore_{i}"] = comparison[f"zscore_{i}"]
+                    quantile_columns[f"quantile_{i}"] = comparison[f"quantile_{i}"]
+
+            # The comparisons of a cohort are added as one block, the z-score and quantile of every compared column next to each other
+            comparison_dfs.append(pd.DataFrame(
+                {f"{prefix}{metric}_{i}": columns[f"{metric}_{i}"] for i in to_compare_columns
+                 for metric, columns in [("zscore", zscore_columns), ("quantile", quantile_columns)]},
+                index=df.index
+            ))
+
+        comparison_columns = [i for comparison_df in comparison_dfs for i in comparison_df.columns]
+        df = pd.concat([df.drop(columns=[i for i in comparison_columns if i in df])] + comparison_dfs, axis=1)
 
-        to_compare_columns = [col for col in df.columns if col not in wyscout_personal_columns and col not in wyscout_team_season_columns and col not in special_columns]
+        print("Finished comparing players")
+
+        return df
 
-        # Perform statistical comparisons for each specified column
-        for i in to_compare_columns:
-            print("start comparing players on the following criteria {}".format(i))
-            df = self._recalculate_column(
-                df,
-                to_altered_column=i,
-            )
+    def _compare_float_columns(self, df: pd.DataFrame, columns: list, statistics: dict, quantile_error: float = None) -> dict:
 
-        print("Finished comparing players")
+        # The z-scores and quantiles of the float columns within the groups of every cohort, per dtype on a 2-D block
+        comparisons = {name: ({}, {}) for name in statistics}
+
+        # In sketch mode the quantiles of every cohort follow from a quantile sketch per group and column
+        if quantile_error is not None and columns:
+            for name, cohort_statistics in statistics.items():
+                self.cohort_sketches[name] = CohortSketches(cohort_statistics.group_columns, quantile_error).update(df, columns)
+                comparisons[name][1].update(self.cohort_sketches[name].get_quantiles(df, columns, cohort_statistics))
+
+        for dtype in ["float64", "float32"]:
+            dtype_columns = [i for i in columns if df[i].dtype == dtype]
+            if not dtype_columns:
+                continue
+
+            # The values are sorted once, the exact quantiles of all cohorts start from the same sorted rows
+            values = df[dtype_columns].to_numpy(dtype=dtype)
+            sorted_rows = get_sorted_rows(values) if quantile_error is None else None
+
+            for name, cohort_statistics in statistics.items():
+                zscores, quantiles = comparisons[name]
+                block_zscores = cohort_statistics.get_zscores(values)
+                block_quantiles = None if sorted_rows is None else cohort_statistics.get_quantiles(values, sorted_rows=sorted_rows)
+
+                for j, column in enumerate(dtype_columns):
+                    zscores[column] = block_zscores[:, j]
+                    if block_quantiles is not None:
+                        quantiles[column] = block_quantiles[:, j]
+
+        return comparisons
+
+    def _compare_with_sketches(self, df: pd.DataFrame, columns: list, sketches: CohortSketches, statistics: GroupStatistics = None) -> tuple:
+
+        # The z-scores (in the precision of the column, like the exact z-scores) and quantiles of the columns from the sketches of the groups
+        zscores = sketches.get_zscores(df, columns, statistics)
+        quantiles = sketches.get_quantiles(df, columns, statistics)
+
+        return {i: zscores[i].astype(df[i].dtype) for i in columns}, quantiles
+
+    def _add_main_position(self, df: pd.DataFrame, pos_translation_list: dict = pos_translation_dict) -> pd.DataFrame:
+
+        # Adds the column in place
+        df["main_position"] = (
+            df["primary_position"].astype(object).map(pos_translation_list).fillna("UNKNOWN")
+        )
 
         return df
 
+    def _get_to_compare_columns(self, df: pd.DataFrame) -> list:
+
+        # special columns is list containing all variables that are made inbetween but dont contain stats 
+        special_columns = ["main_position", "possession_ratio", "no_possession_ratio"]
+
+        return [col for col in df.columns if col not in wyscout_personal_columns and col not in wyscout_team_season_columns and col not in special_columns]
+
 
     def _recalculate_column(
         self,
-        df: pd.DataFrame,
+        grouped,
         to_altered_column: str,
-        compare_group_columns: list = ['division', 'league_country', 'league_competition', 'main_position'],
         fill_na: bool = False,  # New argument to allow conditional filling of NaNs
-    ) -> pd.DataFrame:
+    ) -> dict:
 
-        # Make a copy of the DataFrame to avoid modifying the original
-        new_df = df.copy()
+        # The column of the groups, the DataFrame itself is not modified
+        values = grouped[to_altered_column]
 
         # Optional: Fill missing values in the specified column with 0 if fill_na is True
         if fill_na:
-            new_df[to_altered_column] = new_df[to_altered_column].fillna(0)
-
-        # Group the DataFrame by specified columns
-        grouped = new_df.groupby(compare_group_columns)
-
-        # Calculate and update the columns for each group
-        new_df[f"zscore_{to_altered_column}"] = grouped[to_altered_column].transform(
-            lambda x: self._standardize_func(x)
-        )
-
-        new_df[f"quantile_{to_altered_column}"] = grouped[to_altered_column].transform(
-            lambda x: self._quantile_func(x)
-        )
-
-        return new_df
+            df = grouped.obj
+            values = df[to_altered_column].fillna(0).groupby([df[i] for i in grouped.keys], observed=True)
+
+        # Calculate the columns for each group
+        return {
+            f"zscore_{to_altered_column}": values.transform(lambda x: self._standardize_func(x)),
+            f"quantile_{to_altered_column}": values.transform(lambda x: self._quantile_func(x)),
+        }
 
     # Function to standardize a group
     def _standardize_func(self, x):
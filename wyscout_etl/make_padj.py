@@ -1,14 +1,35 @@
 import pandas as pd
 import numpy as np
 from config.extra_variable_column_info import in_possession_variables, out_possession_variables
+from wyscout_etl.column_placement import ColumnPlacementPlan
+from wyscout_etl.team_possession import TeamPossession
+from wyscout_etl.precision import FloatPrecision
 
 class PadjMaker:
-    
-    def __init__(self) -> None:
+
+    # The bounds of the possession ratios, to avoid extreme adjustments
+    ratio_bounds = (0.3, 0.7)
+
+    def __init__(self, team_possession: TeamPossession = None, possession_table: pd.DataFrame = None, dtype: str = "float64") -> None:
         """
         Initializes the PadjMaker class.
+
+        The clamp_report attribute holds, after _calculate_possession, the number of rows per ratio
+        column that were filled with 0.5 or clamped to the lower or upper bound. The ETL adds up the
+        reports of a run and saves them next to the database, to tune ratio_bounds with.
+
+        Parameters:
+        - team_possession (TeamPossession): When given, the players are adjusted by the possession of
+          their team-season instead of their own estimate. Defaults to None.
+        - possession_table (pd.DataFrame): A team possession table created beforehand, e.g. over the
+          whole dataset when the DataFrame is only a part of it. Defaults to None, in which case it's
+          created from the DataFrame.
+        - dtype (str): The dtype the columns are adjusted in, "float64" or "float32". Defaults to "float64".
         """
-        pass
+        self.team_possession = team_possession
+        self.possession_table = possession_table
+        self.dtype = dtype
+        self.clamp_report = None
 
     def _make_df_padj(
         self,
@@ -21,6 +42,9 @@ class PadjMaker:
         and non-possession scenarios. The function computes new possession-adjusted columns for
         both in-possession and out-of-possession periods.
 
+        Every block of columns is adjusted with one broadcasted divide by its ratio and one
+        rounding pass, and all new columns are added with one concat.
+
         Parameters:
         - df (pd.DataFrame): Input DataFrame containing game data.
         - in_possession (list): List of column names that should be adjusted based on player possession.
@@ -28,48 +52,66 @@ class PadjMaker:
 
         Returns:
         - pd.DataFrame: A new DataFrame with additional possession-adjusted columns.
+
+        Contract: the ratio columns are added to `df` in place, the possession-adjusted columns are
+        added with one concat, so the returned DataFrame is a new frame.
         """
         print('Testing if specific settings are correct:')
-        
+
         # Ensure possession ratios are correctly calculated and available
         df = self._calculate_possession(df)
 
-        # Adjust columns related to player possession (in-possession scenario)
-        for column in in_possession:
-            print(f"Adjusting possession for in-possession column: {column}")
-            new_column_name = f'{column}_padj'
-            
-            # Calculate possession-adjusted value
-            df[new_column_name] = df[column].div(df['possession_ratio'])
-            df[new_column_name] = np.round(df[new_column_name], 2)
-
-            # Insert the new possession-adjusted column next to the original column
-            index = df.columns.get_loc(column)
-            df = df.iloc[:, :index + 1].join(df.pop(new_column_name)).join(df.iloc[:, index + 1:])
-
-        # Adjust columns related to non-possession (out-of-possession scenario)
-        for column in out_possession:
-            print(f"Adjusting possession for out-of-possession column: {column}")
-            new_column_name = f'{column}_padj'
-            
-            # Calculate non-possession-adjusted value
-            df[new_column_name] = df[column].div(df['no_possession_ratio'])
-            df[new_column_name] = np.round(df[new_column_name], 2)
-
-            # Insert the new possession-adjusted column next to the original column
-            index = df.columns.get_loc(column)
-            df = df.iloc[:, :index + 1].join(df.pop(new_column_name)).join(df.iloc[:, index + 1:])
-        
+        # Adjust the in-possession block by the possession ratio and the out-of-possession block by the non-possession ratio
+        print(f"Adjusting possession for {len(in_possession)} in-possession and {len(out_possession)} out-of-possession columns")
+        in_possession_block = self._adjust_block(df, in_possession, df['possession_ratio'].to_numpy())
+        out_possession_block = self._adjust_block(df, out_possession, df['no_possession_ratio'].to_numpy())
+
+        # Round both blocks in one pass
+        padj_values = np.round(np.hstack([in_possession_block, out_possession_block]), 2)
+        padj_columns = [f'{column}_padj' for column in list(in_possession) + list(out_possession)]
+        padj_df = pd.DataFrame(padj_values, columns=padj_columns, index=df.index)
+
+        # A column in both lists is adjusted by the last list, like a column that is assigned twice
+        padj_df = padj_df.loc[:, ~padj_df.columns.duplicated(keep='last')]
+
+        # Insert the possession-adjusted columns next to the original columns
+        column_plan = ColumnPlacementPlan()
+        for column in list(in_possession) + list(out_possession):
+            column_plan.add(brother_column=column, new_column=f'{column}_padj')
+
+        df = pd.concat([df.drop(columns=[i for i in padj_df.columns if i in df]), padj_df], axis=1)
+        df = column_plan.apply(df)
+
         # Return the DataFrame with possession-adjusted columns
         return df
 
+    def _adjust_block(self, df: pd.DataFrame, columns: list, ratio: np.ndarray) -> np.ndarray:
+        """
+        Divides a block of columns by a ratio per row with one broadcasted divide, in the dtype of the PadjMaker.
+
+        Parameters:
+        - df (pd.DataFrame): Input DataFrame containing the columns.
+        - columns (list): The columns of the block.
+        - ratio (np.ndarray): The ratio per row.
+
+        Returns:
+        - np.ndarray: The adjusted values, one column per column of the block.
+        """
+        values = df[columns].to_numpy(dtype=self.dtype, na_value=np.nan)
+
+        return values / ratio.astype(self.dtype)[:, np.newaxis]
+
     def _calculate_possession(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Calculates the possession and non-possession ratios based on interceptions.
         These ratios will be used to adjust columns for possession and non-possession
         periods in the game.
 
-        The possession ratio is capped between 0.3 and 0.7 to avoid extreme values.
+        With team_possession the ratios of the team-season are looked up in the team possession
+        table; players of teams without an estimate keep their own ratios.
+
+        The possession ratio is capped between 0.3 and 0.7 to avoid extreme values. The number
+        of rows that were filled or clamped per ratio column is stored in clamp_report.
 
         Parameters:
         - df (pd.DataFrame): Input DataFrame containing columns for possession-related calculations.
@@ -77,12 +119,45 @@ class PadjMaker:
         Returns:
         - pd.DataFrame: The DataFrame with added 'possession_ratio' and 'no_possession_ratio' columns.
         """
-        # Calculate possession and no possession ratios based on average interceptions
-        df['possession_ratio'] = np.round(1 - (df['interceptions_avg'] * 1.5) / (df['possession_adjusted_interceptions'] * 2), 2).fillna(0.5)
-        df['no_possession_ratio'] = np.round((df['interceptions_avg'] * 1.5) / (df['possession_adjusted_interceptions'] * 2), 2).fillna(0.5)
+        # Calculate possession and no possession ratios based on average interceptions. The ratios are calculated and
+        # rounded in double precision from the decimal values of the interceptions, also of float32 columns, so float32
+        # runs round them the same way and they are stored as two-decimal values.
+        if self.team_possession is None:
+            precision = FloatPrecision()
+            interceptions = pd.Series(precision.get_decimal_values(df['interceptions_avg']), index=df.index)
+            adjusted_interceptions = pd.Series(precision.get_decimal_values(df['possession_adjusted_interceptions']), index=df.index)
+            no_possession_ratio = np.round((interceptions * 1.5) / (adjusted_interceptions * 2), 2)
+            possession_ratio = np.round(1 - (interceptions * 1.5) / (adjusted_interceptions * 2), 2)
+        else:
+            table = self.possession_table
+            if table is None:
+                table = self.team_possession.get_table(df)
+
+            team_ratio = self.team_possession.join(df, table).fillna(self.team_possession.get_player_ratios(df)).astype('float64')
+            no_possession_ratio = np.round(team_ratio, 2)
+            possession_ratio = np.round(1 - team_ratio, 2)
+
+        lower, upper = self.ratio_bounds
+        report = {}
+
+        for column, ratio in [('possession_ratio', possession_ratio), ('no_possession_ratio', no_possession_ratio)]:
+            ratio = ratio.to_numpy(dtype='float64', na_value=np.nan)
+            filled = np.isnan(ratio)
+            ratio = np.where(filled, 0.5, ratio)
+
+            # Safeguard: Ensure ratios stay within the range [0.3, 0.7]
+            clamped_low = ratio < lower
+            clamped_high = ratio > upper
+            df[column] = np.where(clamped_low, lower, np.where(clamped_high, upper, ratio))
+
+            report[column] = {
+                'filled': int(filled.sum()),
+                'clamped_low': int(clamped_low.sum()),
+                'clamped_high': int(clamped_high.sum()),
+                'rows': len(ratio),
+            }
 
-        # Safeguard: Ensure ratios stay within the range [0.3, 0.7]
-        df['possession_ratio'] = [0.3 if i < 0.30 else (0.7 if i > 0.7 else i) for i in df['possession_ratio']]
-        df['no_possession_ratio'] = [0.3 if i < 0.30 else (0.7 if i > 0.7 else i) for i in df['no_possession_ratio']]
+        self.clamp_report = pd.DataFrame(report).T
+        print(f"Possession ratios filled or clamped to [{lower}, {upper}]:\n{self.clamp_report}")
 
         return df
@@ -0,0 +1,176 @@
+import pandas as pd
+import numpy as np
+
+
+class FloatPrecision:
+    """
+    A class for keeping the calculated columns of the ETL in one floating point precision.
+
+    The stats are exported with two decimals and most calculated columns are rounded to two decimals,
+    so single precision (float32) is accurate enough for them while halving the memory and bandwidth
+    of the wide blocks of possession adjusted, z-score and quantile columns. In float32 mode every
+    stage casts its double precision output columns to float32, so the data stays in single precision
+    between the stages. In float64 mode nothing is cast and the results are exactly those of the
+    regular pipeline.
+
+    The score columns are parsed in score_dtype, by default float32 to halve the memory of the base
+    (see CreateWyscoutBase). In float64 mode they are widened before any calculation, to the float64
+    values their decimal text parses to (0.38 instead of 0.3799999952), so the results are the same as
+    those of a float64 parse.
+
+    The accuracy of float32 mode can be checked with an accuracy report against a float64 run, that
+    parses the score columns in float64 as well.
+
+    Attributes:
+        dtype (str): The dtype of the calculated columns, "float64" or "float32".
+        score_dtype (str): The dtype the score columns are parsed in, "float64" or "float32".
+
+    Methods:
+        __init__(dtype, score_dtype): Initializes the FloatPrecision class.
+        cast(df): Casts the double precision columns of a DataFrame to the dtype.
+        widen(df): Widens the single precision columns of a DataFrame to their decimal float64 values in float64 mode.
+        get_decimal_values(series): Gets the values of a column as float64, single precision values widened in every mode.
+        get_accuracy_report(df, reference_df): Compares the numeric columns of a run with a float64 reference run.
+    """
+
+    def __init__(self, dtype: str = "float64", score_dtype: str = "float32") -> None:
+        """
+        Initialize the FloatPrecision class.
+
+        Args:
+            dtype (str): The dtype of the calculated columns, "float64" or "float32". Defaults to "float64".
+            score_dtype (str): The dtype the score columns are parsed in, "float64" or "float32". Defaults to "float32".
+        """
+        for name, value in [("dtype", dtype), ("score_dtype", score_dtype)]:
+            if value not in ("float64", "float32"):
+                raise ValueError(f"{name} should be 'float64' or 'float32', got '{value}'")
+
+        self.dtype = dtype
+        self.score_dtype = score_dtype
+
+    def cast(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Cast the double precision columns of a DataFrame to the dtype in one pass. Other columns
+        (integers, categories, strings) are kept as they are. The cast columns are added with one
+        concat, so they form one block instead of a block per column.
+
+        Args:
+            df (pd.DataFrame): The DataFrame to cast.
+
+        Returns:
+            pd.DataFrame: The DataFrame with the float columns in the dtype.
+        """
+        if self.dtype == "float64":
+            return df
+
+        to_cast_columns = [i for i, dtype in df.dtypes.items() if dtype == "float64"]
+        if not to_cast_columns:
+            return df
+
+        # The cast columns are added with one concat, in their original place
+        cast_df = df[to_cast_columns].astype(self.dtype)
+
+        return pd.concat([df.drop(columns=to_cast_columns), cast_df], axis=1)[df.columns]
+
+    def widen(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Widen the single precision columns of a DataFrame, the parsed score columns, to the float64
+        values of their decimal text. In float32 mode nothing is widened.
+
+        Args:
+            df (pd.DataFrame): The DataFrame to widen.
+
+        Returns:
+            pd.DataFrame: The DataFrame with the float32 columns as float64.
+        """
+        if self.dtype == "float32":
+            return df
+
+        to_widen_columns = [i for i, dtype in df.dtypes.items() if dtype == "float32"]
+        if not to_widen_columns:
+            return df
+
+        # The widened columns are added with one concat, in their original place
+        widened_df = pd.DataFrame({i: self._widen_values(df[i].to_numpy()) for i in to_widen_columns}, index=df.index)
+
+        return pd.concat([df.drop(columns=to_widen_columns), widened_df], axis=1)[df.columns]
+
+    def get_decimal_values(self, series: pd.Series) -> np.ndarray:
+        """
+        Get the values of a column as float64, single precision values widened to the float64 values of
+        their decimal text in every mode. Calculations that are rounded to two decimals, like the possession
+        ratios, use them so a float32 error doesn't round a value the other way.
+
+        Args:
+            series (pd.Series): The column.
+
+        Returns:
+            np.ndarray: The float64 values.
+        """
+        if series.dtype == "float32":
+            return self._widen_values(series.to_numpy())
+
+        return series.to_numpy(dtype="float64", na_value=np.nan)
+
+    def _widen_values(self, values: np.ndarray) -> np.ndarray:
+        """
+        Widen float32 values parsed from decimal text to the float64 values the same text parses to.
+        The values are rounded to the fewest decimals that give back every float32 value, a rounded
+        value k / 10**decimals is the float64 value closest to the decimal text.
+
+        Args:
+            values (np.ndarray): The float32 values of one column.
+
+        Returns:
+            np.ndarray: The float64 values, plainly cast when the decimals can't be recovered from float32.
+        """
+        wide_values = values.astype("float64")
+        finite = np.isfinite(values)
+
+        for decimals in range(8):
+            rounded = np.round(wide_values[finite], decimals)
+            if np.array_equal(rounded.astype("float32"), values[finite]):
+                wide_values[finite] = rounded
+                break
+
+        return wide_values
+
+    def get_accuracy_report(self, df: pd.DataFrame, reference_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Compare the numeric columns of a run with a float64 reference run of the same data. The rows
+        of both runs are matched on their position.
+
+        Args:
+            df (pd.DataFrame): The output of the run to check.
+            reference_df (pd.DataFrame): The output of the float64 reference run.
+
+        Returns:
+            pd.DataFrame: Per numeric column the maximum absolute deviation and the number of rows
+                          that are missing in only one of the runs, sorted by the deviation.
+        """
+        if len(df) != len(reference_df):
+            raise ValueError(f"The runs have a different number of rows: {len(df)} and {len(reference_df)}")
+
+        report = {}
+
+        for column in reference_df.columns:
+            if column not in df or not pd.api.types.is_numeric_dtype(reference_df[column]) or pd.api.types.is_bool_dtype(reference_df[column]):
+                continue
+
+            values = df[column].to_numpy(dtype="float64", na_value=np.nan)
+            reference_values = reference_df[column].to_numpy(dtype="float64", na_value=np.nan)
+
+            # Infinite values in both runs give no deviation
+            with np.errstate(invalid="ignore"):
+                deviations = np.abs(values - reference_values)
+            deviations = deviations[~np.isnan(deviations)]
+
+            report[column] = {
+                "max_abs_deviation": deviations.max() if len(deviations) else 0.0,
+                "mismatched_missing": int((np.isnan(values) != np.isnan(reference_values)).sum()),
+            }
+
+        report = pd.DataFrame.from_dict(report, orient="index", columns=["max_abs_deviation", "mismatched_missing"])
+        report.index.name = "column"
+
+        return report.sort_values(["max_abs_deviation", "mismatched_missing"], ascending=False)
@@ -0,0 +1,415 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from wyscout_etl.group_statistics import GroupStatistics
+
+
+class QuantileSketch:
+    """
+    A mergeable quantile sketch of the values of one column, after the KLL sketch of Karnin, Lang and Liberty.
+
+    The sketch keeps a stack of compactors: every value kept at level h stands for 2**h values. When a
+    level holds more values than its capacity, it's sorted and every other value (from a random offset)
+    moves up a level with twice the weight, an odd value stays. The capacity is k at the top level and
+    shrinks by a factor 2/3 per level below it, so the sketch keeps O(k) values however many values it
+    summarises. The percentile rank of a value follows from the weights of the kept values below and
+    equal to it. As long as no level is compacted, e.g. for groups smaller than k, the ranks are exact.
+
+    k follows from the rank error with the error bound of the KLL sketch of Apache DataSketches
+    (2.296 / k^0.9723 at 99% confidence), e.g. k=268 for an error of 0.01.
+
+    Sketches of different chunks or processes are merged by joining their levels and compacting again.
+    The count, mean and sum of squared deviations of the values are merged as well (Chan's parallel
+    algorithm), so the z-scores follow from a merged sketch too.
+
+    Attributes:
+        error (float): The rank error the sketch is sized for, as a fraction of the number of values.
+        k (int): The capacity of the top level.
+        count (int): The number of values summarised.
+        mean (float): The mean of the values.
+        m2 (float): The sum of squared deviations from the mean.
+        levels (list[np.ndarray]): The values kept per level.
+
+    Methods:
+        __init__(error, seed): Initializes the QuantileSketch class.
+        update(values): Adds values to the sketch.
+        merge(other): Adds the values summarised by another sketch.
+        get_ranks(values): Calculates the approximate percentile ranks of values.
+        get_zscores(values): Calculates the z-scores of values.
+        _merge_moments(count, mean, m2): Merges the moments of other values.
+        _compress(): Compacts the levels that hold more values than their capacity.
+        _get_capacity(level): Gets the capacity of a level.
+    """
+
+    def __init__(self, error: float = 0.01, seed: int = 0) -> None:
+        """
+        Initialize the QuantileSketch class.
+
+        Args:
+            error (float): The rank error the sketch is sized for. Defaults to 0.01.
+            seed (int): The seed of the random compactions. Defaults to 0.
+        """
+        self.error = error
+        self.k = max(8, int(np.ceil((2.296 / error) ** (1 / 0.9723))))
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+        self._ranks = None
+
+    def update(self, values: np.ndarray) -> "QuantileSketch":
+        """
+        Add values to the sketch, missing values are skipped.
+
+        Args:
+            values (np.ndarray): The values.
+
+        Returns:
+            QuantileSketch: The sketch itself.
+        """
+        values = np.asarray(values, dtype="float64")
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+
+        mean = values.mean()
+        self._merge_moments(len(values), mean, np.square(values - mean).sum())
+
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """
+        Add the values summarised by another sketch.
+
+        Args:
+            other (QuantileSketch): The other sketch.
+
+        Returns:
+            QuantileSketch: The sketch itself.
+        """
+        self._merge_moments(other.count, other.mean, other.m2)
+
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compress()
+
+        return self
+
+    def get_ranks(self, values: np.ndarray) -> np.ndarray:
+        """
+        Calculate the approximate percentile ranks of values: the average rank of the values equal to
+        it divided by the number of values, like a percentile rank over the summarised values.
+
+        Args:
+            values (np.ndarray): The values to rank.
+
+        Returns:
+            np.ndarray: The percentile ranks, missing for missing values.
+        """
+        # The kept values sorted, with the cumulative weight before every value
+        if self._ranks is None:
+            items = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(len(items), 2.0**level) for level, items in enumerate(self.levels)])
+            order = np.argsort(items, kind="stable")
+            self._ranks = items[order], np.concatenate([[0], np.cumsum(weights[order])])
+
+        items, cumulative = self._ranks
+        values = np.asarray(values, dtype="float64")
+        less = cumulative[np.searchsorted(items, values, side="left")]
+        less_equal = cumulative[np.searchsorted(items, values, side="right")]
+
+        with np.errstate(all="ignore"):
+            ranks = np.minimum((less + less_equal + 1) / 2 / self.count, 1)
+        ranks[np.isnan(values)] = np.nan
+
+        return ranks
+
+    def get_zscores(self, values: np.ndarray) -> np.ndarray:
+        """
+        Calculate the z-scores of values with the mean and standard deviation (ddof=1) of the summarised
+        values, rounded to two decimals.
+
+        Args:
+            values (np.ndarray): The values.
+
+        Returns:
+            np.ndarray: The z-scores, missing when fewer than two values are summarised.
+        """
+        std = np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+        with np.errstate(all="ignore"):
+            return np.round((np.asarray(values, dtype="float64") - self.mean) / std, 2)
+
+    def _merge_moments(self, count: int, mean: float, m2: float) -> None:
+        """
+        Merge the moments of other values into the moments of the sketch.
+
+        Args:
+            count (int): The number of other values.
+            mean (float): Their mean.
+            m2 (float): Their sum of squared deviations from their mean.
+        """
+        if count == 0:
+            return
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    def _compress(self) -> None:
+        """
+        Compact the lowest level that holds more values than its capacity, until every level fits.
+        Adding a level lowers the capacities of the levels below it.
+        """
+        while True:
+            full_levels = [level for level, items in enumerate(self.levels) if len(items) > self._get_capacity(level)]
+            if not full_levels:
+                break
+
+            level = full_levels[0]
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+
+            # Every other value of the even part moves up with twice the weight, the odd value stays
+            items = np.sort(self.levels[level])
+            odd = len(items) % 2
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[odd + self._rng.integers(2)::2]])
+            self.levels[level] = items[:odd]
+
+        self._ranks = None
+
+    def _get_capacity(self, level: int) -> int:
+        """
+        Get the capacity of a level.
+
+        Args:
+            level (int): The level.
+
+        Returns:
+            int: The number of values the level can hold.
+        """
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - level))))
+
+
+class CohortSketches:
+    """
+    A class for the quantile sketches of a comparison cohort: a QuantileSketch per group and column.
+
+    The sketches are built chunk by chunk (update), merged over the chunks of a streaming run or the
+    partitions of a partitioned run (merge), and saved to and loaded from a Parquet file (save, load),
+    so a later run can compare new players with the cohorts without the data the sketches were built
+    from. The groups are identified by the values of their group columns, so the rows of a group may
+    be spread over several chunks. The memory of the sketches only depends on the number of groups,
+    columns and the rank error, not on the number of rows.
+
+    Attributes:
+        group_columns (list[str]): The columns defining the groups of the cohort.
+        error (float): The rank error of the sketches.
+        seed (int): The seed of the random compactions.
+        chunk_rows (int): The number of rows added to the sketches at a time.
+        sketches (dict): The sketch per group key and column.
+
+    Methods:
+        __init__(group_columns, error, seed, chunk_rows): Initializes the CohortSketches class.
+        update(df, columns): Adds the values of the rows to the sketches of their groups.
+        merge(other): Merges the sketches of other rows of the same cohort.
+        get_quantiles(df, columns, statistics): Calculates the approximate percentile ranks of the rows within their groups.
+        get_zscores(df, columns, statistics): Calculates the z-scores of the rows within their groups.
+        save(path): Saves the sketches to a Parquet file.
+        load(path): Loads the sketches from a Parquet file.
+        _get_groups(df, statistics): Gets the key and rows of every group.
+    """
+
+    def __init__(self, group_columns: list[str], error: float = 0.01, seed: int = 0, chunk_rows: int = 100_000) -> None:
+        """
+        Initialize the CohortSketches class.
+
+        Args:
+            group_columns (list[str]): The columns defining the groups of the cohort.
+            error (float): The rank error of the sketches. Defaults to 0.01.
+            seed (int): The seed of the random compactions. Defaults to 0.
+            chunk_rows (int): The number of rows added to the sketches at a time. Defaults to 100000.
+        """
+        self.group_columns = list(group_columns)
+        self.error = error
+        self.seed = seed
+        self.chunk_rows = chunk_rows
+        self.sketches = {}
+
+    def update(self, df: pd.DataFrame, columns: list[str]) -> "CohortSketches":
+        """
+        Add the values of the rows to the sketches of their groups, chunk by chunk.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the group columns and the columns.
+            columns (list[str]): The columns to sketch.
+
+        Returns:
+            CohortSketches: The sketches themselves.
+        """
+        for start in range(0, len(df), self.chunk_rows):
+            chunk = df.iloc[start:start + self.chunk_rows]
+            values = chunk[columns].to_numpy(dtype="float64", na_value=np.nan)
+
+            for key, rows in self._get_groups(chunk, GroupStatistics(chunk, self.group_columns)):
+                group_values = values[rows]
+                for j, column in enumerate(columns):
+                    if (key, column) not in self.sketches:
+                        self.sketches[(key, column)] = QuantileSketch(self.error, self.seed)
+                    self.sketches[(key, column)].update(group_values[:, j])
+
+        return self
+
+    def merge(self, other: "CohortSketches") -> "CohortSketches":
+        """
+        Merge the sketches of other rows of the same cohort, e.g. of another partition.
+
+        Args:
+            other (CohortSketches): The other sketches.
+
+        Returns:
+            CohortSketches: The sketches themselves.
+        """
+        for sketch_key, sketch in other.sketches.items():
+            if sketch_key in self.sketches:
+                self.sketches[sketch_key].merge(sketch)
+            else:
+                self.sketches[sketch_key] = QuantileSketch(self.error, self.seed).merge(sketch)
+
+        return self
+
+    def get_quantiles(self, df: pd.DataFrame, columns: list[str], statistics: GroupStatistics = None) -> dict:
+        """
+        Calculate the approximate percentile ranks of the rows within their groups, rounded to two decimals.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the group columns and the columns.
+            columns (list[str]): The columns to rank.
+            statistics (GroupStatistics): The groups of the rows of df. Defaults to None, in which case they are determined.
+
+        Returns:
+            dict: The percentile ranks per column, missing for rows of groups without a sketch.
+        """
+        groups = self._get_groups(df, statistics or GroupStatistics(df, self.group_columns))
+        quantiles = {}
+
+        for column in columns:
+            values = df[column].to_numpy(dtype="float64", na_value=np.nan)
+            quantiles[column] = np.full(len(df), np.nan)
+
+            for key, rows in groups:
+                if (key, column) in self.sketches:
+                    quantiles[column][rows] = np.round(self.sketches[(key, column)].get_ranks(values[rows]), 2)
+
+        return quantiles
+
+    def get_zscores(self, df: pd.DataFrame, columns: list[str], statistics: GroupStatistics = None) -> dict:
+        """
+        Calculate the z-scores of the rows with the mean and standard deviation of their group in the sketches.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the group columns and the columns.
+            columns (list[str]): The columns to standardise.
+            statistics (GroupStatistics): The groups of the rows of df. Defaults to None, in which case they are determined.
+
+        Returns:
+            dict: The z-scores per column, missing for rows of groups without a sketch.
+        """
+        groups = self._get_groups(df, statistics or GroupStatistics(df, self.group_columns))
+        zscores = {}
+
+        for column in columns:
+            values = df[column].to_numpy(dtype="float64", na_value=np.nan)
+            zscores[column] = np.full(len(df), np.nan)
+
+            for key, rows in groups:
+                if (key, column) in self.sketches:
+                    zscores[column][rows] = self.sketches[(key, column)].get_zscores(values[rows])
+
+        return zscores
+
+    def save(self, path: str) -> None:
+        """
+        Save the sketches to a Parquet file, with a row per group and column.
+
+        Args:
+            path (str): The Parquet file.
+        """
+        sketch_keys = list(self.sketches)
+        sketches = [self.sketches[i] for i in sketch_keys]
+
+        table = pa.table({
+            "group": pa.array([i[0] for i in sketch_keys], type=pa.string()),
+            "column": pa.array([i[1] for i in sketch_keys], type=pa.string()),
+            "count": pa.array([i.count for i in sketches], type=pa.int64()),
+            "mean": pa.array([i.mean for i in sketches], type=pa.float64()),
+            "m2": pa.array([i.m2 for i in sketches], type=pa.float64()),
+            "items": pa.array([np.concatenate(i.levels) for i in sketches], type=pa.list_(pa.float64())),
+            "levels": pa.array(
+                [np.repeat(np.arange(len(i.levels)), [len(j) for j in i.levels]) for i in sketches], type=pa.list_(pa.int8())
+            ),
+        })
+        metadata = {"group_columns": self.group_columns, "error": self.error, "seed": self.seed}
+        table = table.replace_schema_metadata({"cohort_sketches": json.dumps(metadata)})
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # The file is only replaced once it is completely written
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def load(self, path: str) -> "CohortSketches":
+        """
+        Load the sketches from a Parquet file written by save, replacing the group columns, error and
+        seed with those the sketches were built with.
+
+        Args:
+            path (str): The Parquet file.
+
+        Returns:
+            CohortSketches: The sketches themselves.
+        """
+        table = pq.read_table(path)
+        metadata = json.loads(table.schema.metadata[b"cohort_sketches"])
+        self.group_columns, self.error, self.seed = metadata["group_columns"], metadata["error"], metadata["seed"]
+
+        self.sketches = {}
+        for row in table.to_pylist():
+            sketch = QuantileSketch(self.error, self.seed)
+            sketch.count, sketch.mean, sketch.m2 = row["count"], row["mean"], row["m2"]
+
+            items, levels = np.array(row["items"], dtype="float64"), np.array(row["levels"], dtype=np.intp)
+            sketch.levels = [items[levels == i] for i in range(levels.max() + 1 if len(levels) else 1)]
+            self.sketches[(row["group"], row["column"])] = sketch
+
+        return self
+
+    def _get_groups(self, df: pd.DataFrame, statistics: GroupStatistics) -> list[tuple[str, np.ndarray]]:
+        """
+        Get the key (the values of the group columns) and the rows of every group.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing the group columns.
+            statistics (GroupStatistics): The groups of the rows of df.
+
+        Returns:
+            list[tuple[str, np.ndarray]]: The key and the positions of the rows per group.
+        """
+        first_rows = df[self.group_columns].iloc[statistics.order[statistics.bounds[:-1]]].astype(object)
+        keys = ["|".join(str(i) for i in key) for key in first_rows.itertuples(index=False)]
+
+        return [(key, statistics.order[statistics.bounds[i]:statistics.bounds[i + 1]]) for i, key in enumerate(keys)]
@@ -0,0 +1,293 @@
+import pandas as pd
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from wyscout_etl.frame_cache import FrameCache
+from wyscout_etl.stage_metrics import StageMetrics
+
+
+class PipelineStage:
+    """
+    A class describing one stage (a group of features) of the ETL graph.
+
+    A stage is a function of the outputs of its input stages. Its fingerprint is built from the
+    fingerprints of its input stages and from the configuration objects and files it depends on,
+    so the cached output of a stage is reused as long as nothing it depends on changed.
+
+    Attributes:
+        name (str): The name of the stage.
+        function (callable): Called with the outputs of the input stages (in the order of `inputs`), returns a DataFrame.
+        inputs (list[str]): The names of the stages whose outputs are needed.
+        config_objects (list): The configuration objects (lists, dicts, strings) the stage depends on.
+        config_files (list[str]): The configuration files the stage depends on.
+        cacheable (bool): Whether the output of the stage is cached. Stages that are cheap to run
+                          or that have their own cache are not cached.
+        fingerprint (str): A fixed fingerprint of the stage, e.g. of its input files. Defaults to None,
+                           in which case it's created from the inputs and configuration.
+        mutates_input (bool): The contract of the function: True when it adds or replaces columns of its
+                              input frames in place, False when it leaves them untouched and returns new frames.
+
+    Methods:
+        __init__(name, function, inputs, config_objects, config_files, cacheable, fingerprint, mutates_input): Initializes the PipelineStage class.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function,
+        inputs: list[str] = (),
+        config_objects: list = (),
+        config_files: list[str] = (),
+        cacheable: bool = True,
+        fingerprint: str = None,
+        mutates_input: bool = True,
+    ) -> None:
+        """
+        Initialize the PipelineStage class.
+
+        Args:
+            name (str): The name of the stage.
+            function (callable): Called with the outputs of the input stages, returns a DataFrame.
+            inputs (list[str]): The names of the input stages. Defaults to no inputs.
+            config_objects (list): The configuration objects the stage depends on. Defaults to none.
+            config_files (list[str]): The configuration files the stage depends on. Defaults to none.
+            cacheable (bool): Whether the output of the stage is cached. Defaults to True.
+            fingerprint (str): A fixed fingerprint of the stage. Defaults to None.
+            mutates_input (bool): Whether the function modifies its input frames in place. Defaults to True.
+        """
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.config_objects = list(config_objects)
+        self.config_files = list(config_files)
+        self.cacheable = cacheable
+        self.fingerprint = fingerprint
+        self.mutates_input = mutates_input
+
+
+class StageGraph:
+    """
+    A class for running the stages of the ETL as a dependency graph.
+
+    Every cacheable stage output is stored in a FrameCache under the fingerprint of the stage. When
+    a stage runs, the stages it needs are loaded from the cache when their fingerprint didn't change
+    and only run otherwise; stages whose output is cached don't need their own inputs at all. So
+    after changing a KPI weight only the KPI stage runs again. Stages whose inputs are available run
+    concurrently in a pool of threads.
+
+    The output of a stage can be the input of several stages running at the same time, so it's never
+    modified: stages that modify their inputs in place get shallow copies. With pandas copy-on-write
+    enabled a shallow copy shares the data until a column is written, so this doesn't copy any data.
+
+    Code changes are not part of the fingerprints, clear the cache (or run without it) after
+    changing the implementation of a stage.
+
+    With a StageMetrics recorder every stage that runs or is loaded from the cache is measured, the
+    bytes written of a stage are the size of its cache file.
+
+    Attributes:
+        stages (dict[str, PipelineStage]): The stages by name, in dependency order.
+        cache (FrameCache): The cache of the stage outputs.
+        use_cache (bool): Whether stage outputs are loaded from and stored in the cache.
+        max_workers (int): The maximum number of stages running at the same time.
+        metrics (StageMetrics): The recorder measuring the stages, None to not measure them.
+
+    Methods:
+        __init__(stages, cache_dir, use_cache, max_workers, metrics): Initializes the StageGraph class.
+        run(target): Runs the stages needed for the target stage and returns its output.
+        get_fingerprints(): Creates the fingerprint of every stage.
+        _get_plan(target, fingerprints): Determines which stages need to run and which can be loaded.
+        _run_stage(stage, inputs, fingerprint): Runs one stage and caches its output.
+        _load_stage(stage, fingerprint): Loads the cached output of a stage.
+    """
+
+    def __init__(
+        self,
+        stages: list[PipelineStage],
+        cache_dir: str = os.path.join("storage", "cache", "stages"),
+        use_cache: bool = True,
+        max_workers: int = 2,
+        metrics: StageMetrics = None,
+    ) -> None:
+        """
+        Initialize the StageGraph class.
+
+        Args:
+            stages (list[PipelineStage]): The stages, every stage after its input stages.
+            cache_dir (str): The directory of the stage cache. Defaults to 'storage/cache/stages'.
+            use_cache (bool): Whether stage outputs are loaded from and stored in the cache. Defaults to True.
+            max_workers (int): The maximum number of stages running at the same time. Defaults to 2.
+            metrics (StageMetrics): The recorder measuring the stages. Defaults to None.
+        """
+        self.stages = {}
+        for stage in stages:
+            unknown_inputs = [i for i in stage.inputs if i not in self.stages]
+            if unknown_inputs:
+                raise ValueError(f"The inputs {unknown_inputs} of stage '{stage.name}' should be defined before it")
+            self.stages[stage.name] = stage
+
+        self.cache = FrameCache(cache_dir)
+        self.use_cache = use_cache
+        self.max_workers = max(1, max_workers)
+        self.metrics = metrics
+
+    def run(self, target: str) -> pd.DataFrame:
+        """
+        Run the stages needed for the target stage and return its output.
+
+        Args:
+            target (str): The name of the stage whose output is needed.
+
+        Returns:
+            pd.DataFrame: The output of the target stage.
+        """
+        fingerprints = self.get_fingerprints()
+        to_load, to_run = self._get_plan(target, fingerprints)
+
+        # The number of pending stages that still need an output, so outputs can be released early
+        consumers = {name: 0 for name in to_load + to_run}
+        for name in to_run:
+            for input_name in self.stages[name].inputs:
+                consumers[input_name] += 1
+        consumers[target] += 1
+
+        outputs = {}
+        pending = list(to_load) + list(to_run)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            running = {}
+
+            while pending or running:
+                # Start every stage whose inputs are available
+                for name in list(pending):
+                    stage = self.stages[name]
+
+                    if name in to_load:
+                        running[pool.submit(self._load_stage, stage, fingerprints[name])] = name
+                    elif all(i in outputs for i in stage.inputs):
+                        inputs = [outputs[i] for i in stage.inputs]
+                        running[pool.submit(self._run_stage, stage, inputs, fingerprints[name])] = name
+                    else:
+                        continue
+
+                    pending.remove(name)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    outputs[name] = future.result()
+
+                    # Release the outputs that no pending stage needs anymore
+                    if name in to_run:
+                        for input_name in self.stages[name].inputs:
+                            consumers[input_name] -= 1
+                            if consumers[input_name] == 0:
+                                del outputs[input_name]
+
+        return outputs[target]
+
+    def get_fingerprints(self) -> dict:
+        """
+        Create the fingerprint of every stage from the fingerprints of its inputs and its configuration.
+
+        Returns:
+            dict: The fingerprint per stage.
+        """
+        fingerprints = {}
+
+        for name, stage in self.stages.items():
+            if stage.fingerprint is not None:
+                fingerprints[name] = stage.fingerprint
+                continue
+
+            fingerprints[name] = self.cache.fingerprint(
+                file_paths=stage.config_files,
+                config_objects=[name, [fingerprints[i] for i in stage.inputs]] + stage.config_objects,
+            )
+
+        return fingerprints
+
+    def _get_plan(self, target: str, fingerprints: dict) -> tuple[list[str], list[str]]:
+        """
+        Determine which stages need to run and which can be loaded from the cache. Walking back from
+        the target, the inputs of a stage are only needed when the stage itself isn't cached.
+
+        Args:
+            target (str): The name of the stage whose output is needed.
+            fingerprints (dict): The fingerprint per stage.
+
+        Returns:
+            tuple[list[str], list[str]]: The stages to load and the stages to run, in dependency order.
+        """
+        needed = set()
+        to_load = set()
+
+        def visit(name):
+            if name in needed:
+                return
+            needed.add(name)
+
+            stage = self.stages[name]
+            if self.use_cache and stage.cacheable and self.cache.exists(f"stage_{name}", fingerprints[name]):
+                to_load.add(name)
+                return
+
+            for input_name in stage.inputs:
+                visit(input_name)
+
+        visit(target)
+
+        to_load = [i for i in self.stages if i in to_load]
+        to_run = [i for i in self.stages if i in needed and i not in to_load]
+
+        return to_load, to_run
+
+    def _run_stage(self, stage: PipelineStage, inputs: list[pd.DataFrame], fingerprint: str) -> pd.DataFrame:
+        """
+        Run one stage and cache its output.
+
+        Args:
+            stage (PipelineStage): The stage to run.
+            inputs (list[pd.DataFrame]): The outputs of the input stages.
+            fingerprint (str): The fingerprint of the stage.
+
+        Returns:
+            pd.DataFrame: The output of the stage.
+        """
+        print(f"Running stage: {stage.name}")
+
+        # Stages that modify their inputs get shallow copies, the outputs of other stages stay untouched
+        if stage.mutates_input:
+            inputs = [i.copy(deep=False) for i in inputs]
+
+        cached = self.use_cache and stage.cacheable
+
+        def run(*inputs):
+            df = stage.function(*inputs)
+            if cached:
+                self.cache.store(f"stage_{stage.name}", fingerprint, df)
+            return df
+
+        if self.metrics is None:
+            return run(*inputs)
+
+        written_path = self.cache.get_path(f"stage_{stage.name}", fingerprint) if cached else None
+        return self.metrics.measure(stage.name, run, inputs, written_path=written_path)
+
+    def _load_stage(self, stage: PipelineStage, fingerprint: str) -> pd.DataFrame:
+        """
+        Load the cached output of a stage.
+
+        Args:
+            stage (PipelineStage): The stage to load.
+            fingerprint (str): The fingerprint of the stage.
+
+        Returns:
+            pd.DataFrame: The output of the stage.
+        """
+        print(f"Loaded stage from the cache: {stage.name}")
+
+        if self.metrics is None:
+            return self.cache.load(f"stage_{stage.name}", fingerprint)
+
+        return self.metrics.measure(stage.name, lambda: self.cache.load(f"stage_{stage.name}", fingerprint), status="cached")
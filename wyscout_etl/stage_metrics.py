@@ -0,0 +1,276 @@
+import pandas as pd
+import cProfile
+import contextlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+# The resource module only exists on Unix, elsewhere the peak RSS is not measured
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class MetricsSink(ABC):
+    """
+    The base class of the sinks that receive the metrics of the stages.
+
+    A sink receives one record (a dict) per stage. New sinks must implement emit and, when they hold
+    resources, close.
+
+    Methods:
+        emit(record): Receives the metrics of one stage.
+        close(): Releases the resources of the sink.
+    """
+
+    @abstractmethod
+    def emit(self, record: dict) -> None:
+        """
+        Receive the metrics of one stage.
+
+        Args:
+            record (dict): The metrics of the stage.
+        """
+
+    def close(self) -> None:
+        """
+        Release the resources of the sink.
+        """
+        pass
+
+
+class JsonLinesSink(MetricsSink):
+    """
+    A sink that appends every record as one JSON line to a file, so the metrics of all runs end up in
+    one file that can be compared over time, e.g. with pd.read_json(path, lines=True).
+
+    Attributes:
+        path (str): The JSON-lines file.
+
+    Methods:
+        __init__(path): Initializes the JsonLinesSink class.
+        emit(record): Appends the record to the file.
+    """
+
+    def __init__(self, path: str = os.path.join("storage", "metrics", "stage_metrics.jsonl")) -> None:
+        """
+        Initialize the JsonLinesSink class.
+
+        Args:
+            path (str): The JSON-lines file. Defaults to 'storage/metrics/stage_metrics.jsonl'.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, record: dict) -> None:
+        """
+        Append the record to the file.
+
+        Args:
+            record (dict): The metrics of the stage.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Stages running concurrently emit from different threads
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+
+
+class MemoryMetricsSink(MetricsSink):
+    """
+    A sink that keeps the records in memory, e.g. to inspect the metrics of a run in a notebook.
+
+    Attributes:
+        records (list[dict]): The received records, in order.
+
+    Methods:
+        __init__(): Initializes the MemoryMetricsSink class.
+        emit(record): Stores the record.
+        to_frame(): Returns the records as a DataFrame.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize the MemoryMetricsSink class.
+        """
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, record: dict) -> None:
+        """
+        Store the record.
+
+        Args:
+            record (dict): The metrics of the stage.
+        """
+        with self._lock:
+            self.records.append(record)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Return the records as a DataFrame.
+
+        Returns:
+            pd.DataFrame: One row per record.
+        """
+        return pd.DataFrame(self.records)
+
+
+class StageMetrics:
+    """
+    A class for measuring the stages of the ETL and sending the metrics to a sink.
+
+    Per stage the following metrics are recorded:
+    - wall_seconds: the elapsed time.
+    - cpu_seconds: the CPU time of the process. Stages that run at the same time share the process,
+      so their CPU times overlap.
+    - peak_rss_delta_mb: how much the peak resident memory of the process grew during the stage.
+      The peak only grows, so a stage that stays below an earlier peak reports 0. None on Windows.
+    - rows_in, rows_out: the rows of the input and output frames.
+    - columns_added: the columns of the output that are in none of the inputs.
+    - bytes_written: the size of the files the stage wrote, e.g. the stage cache or the database.
+
+    With a profile directory every stage runs under cProfile and the profile is dumped to
+    '<profile_dir>/<run_id>_<stage>.prof', which can be inspected with pstats or snakeviz. Only one
+    profiler can be active in a process, so profiled stages run one at a time.
+
+    Attributes:
+        sink (MetricsSink): The sink receiving the records, None to only profile.
+        profile_dir (str): The directory of the cProfile dumps, None to not profile.
+        run_id (str): The identifier of the run, shared by the records of one run.
+
+    Methods:
+        __init__(sink, profile_dir, run_id): Initializes the StageMetrics class.
+        measure(stage, function, inputs, written_path, status): Runs a stage, measures it and emits the record.
+        close(): Closes the sink.
+        _get_peak_rss(): Gets the peak resident memory of the process in megabytes.
+        _get_size(path): Gets the size of a file or directory in bytes.
+    """
+
+    # Held while a stage is profiled
+    _profile_lock = threading.Lock()
+
+    def __init__(self, sink: MetricsSink = None, profile_dir: str = None, run_id: str = None) -> None:
+        """
+        Initialize the StageMetrics class.
+
+        Args:
+            sink (MetricsSink): The sink receiving the records. Defaults to None.
+            profile_dir (str): The directory of the cProfile dumps. Defaults to None (no profiling).
+            run_id (str): The identifier of the run. Defaults to the current time.
+        """
+        self.sink = sink
+        self.profile_dir = profile_dir
+        self.run_id = run_id or datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    def measure(self, stage: str, function, inputs: list = (), written_path: str = None, status: str = "run"):
+        """
+        Run a stage on its inputs, measure it and emit the record to the sink.
+
+        Args:
+            stage (str): The name of the stage.
+            function (callable): The stage, called with the inputs.
+            inputs (list): The inputs of the stage, DataFrames are counted. Defaults to no inputs.
+            written_path (str): The file or directory the stage writes to, its size is recorded afterwards. Defaults to None.
+            status (str): How the output was obtained, e.g. "run" or "cached". Defaults to "run".
+
+        Returns:
+            The output of the stage.
+        """
+        input_frames = [i for i in inputs if isinstance(i, pd.DataFrame)]
+
+        profiler = cProfile.Profile() if self.profile_dir is not None else None
+
+        with self._profile_lock if profiler is not None else contextlib.nullcontext():
+            started_at = datetime.now().isoformat(timespec="seconds")
+            peak_rss = self._get_peak_rss()
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+
+            if profiler is not None:
+                profiler.enable()
+            try:
+                output = function(*inputs)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+
+        profile_path = None
+        if profiler is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile_path = os.path.join(self.profile_dir, f"{self.run_id}_{stage}.prof")
+            profiler.dump_stats(profile_path)
+
+        input_columns = set()
+        for df in input_frames:
+            input_columns.update(df.columns)
+
+        record = {
+            "run_id": self.run_id,
+            "stage": stage,
+            "status": status,
+            "started_at": started_at,
+            "wall_seconds": round(wall_seconds, 4),
+            "cpu_seconds": round(cpu_seconds, 4),
+            "peak_rss_delta_mb": None if peak_rss is None else round(self._get_peak_rss() - peak_rss, 2),
+            "rows_in": sum(len(i) for i in input_frames) if input_frames else None,
+            "rows_out": len(output) if isinstance(output, pd.DataFrame) else None,
+            "columns_added": len([i for i in output.columns if i not in input_columns]) if isinstance(output, pd.DataFrame) else None,
+            "bytes_written": self._get_size(written_path) if written_path is not None else 0,
+            "profile_path": profile_path,
+        }
+
+        if self.sink is not None:
+            self.sink.emit(record)
+
+        return output
+
+    def close(self) -> None:
+        """
+        Close the sink.
+        """
+        if self.sink is not None:
+            self.sink.close()
+
+    def _get_peak_rss(self) -> float | None:
+        """
+        Get the peak resident memory of the process.
+
+        Returns:
+            float | None: The peak in megabytes, None when it can't be measured.
+        """
+        if resource is None:
+            return None
+
+        # Linux reports kilobytes, macOS bytes
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if os.uname().sysname == "Darwin" else peak / 1024
+
+    def _get_size(self, path: str) -> int:
+        """
+        Get the size of a file or of all files in a directory.
+
+        Args:
+            path (str): The file or directory.
+
+        Returns:
+            int: The size in bytes, 0 when the path doesn't exist.
+        """
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+
+        size = 0
+        for directory, _, file_names in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(directory, i)) for i in file_names)
+
+        return size
@@ -0,0 +1,429 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+import shutil
+import tempfile
+
+from wyscout_etl.create_base import CreateWyscoutBase
+from wyscout_etl.create_extra_variables import GetExtraFeatures
+from wyscout_etl.make_padj import PadjMaker
+from wyscout_etl.make_comparison_stats import ComparePlayers
+from wyscout_etl.calculate_totals import CalculateKPI
+from wyscout_etl.wyscout_db import WyscoutDatabase
+from wyscout_etl.feature_demand import FeatureDemand
+from wyscout_etl.team_possession import TeamPossession
+from wyscout_etl.precision import FloatPrecision
+from wyscout_etl.stage_metrics import StageMetrics
+from wyscout_etl.quantile_sketch import CohortSketches
+
+
+class StreamingETL:
+    """
+    A class for running the ETL with bounded memory, for archives that don't fit in memory at once.
+
+    The pipeline is split in passes that spill their results to Parquet files on disk:
+    1. The base is created in chunks of exports. The chunks are spilled and the mean and standard
+       deviation of the card and foul columns are gathered, because the foul metric is standardised
+       over the whole dataset.
+       With team possession, the team possession table is created over all spilled chunks.
+    2. The row-local stages (GetExtraFeatures and PadjMaker) run per base chunk. The results are
+       spilled per competition (division, league_country and league_competition), because those are
+       part of every comparison group.
+    3. The player comparisons run per competition, so only one competition is gathered in memory at
+       a time. The minimum of every comparison column is gathered for the KPI calculation. Extra
+       comparison cohorts have to lie within a competition, e.g. the competition season, except
+       in sketch mode. In sketch mode (a quantile error) the quantiles are approximated from quantile sketches, and
+       cohorts spanning several competitions are sketched per chunk in pass 2 and compared here with
+       the sketches merged over all chunks.
+    4. The KPIs are calculated per competition and written to the partitions of the competition
+       in the output database.
+
+    The chunk size follows from the memory budget. Peak memory is set by the budget and by the size
+    of the largest competition (all its seasons), not by the size of the whole archive.
+
+    With a StageMetrics recorder every pass is measured, the bytes written of a pass are the size of
+    its spilled parts (of the output database for pass 4). The passes exchange files, not frames, so
+    their rows and columns are not recorded.
+
+    Attributes:
+        memory_budget_mb (int): The memory budget in megabytes.
+        spill_dir (str): The directory in which the spilled parts are stored during a run.
+        demand (FeatureDemand): The columns needed for the KPIs and reports, None to calculate all columns.
+        team_possession (TeamPossession): Adjusts the players by the possession of their team-season, None
+                                          to adjust them by their own estimate.
+        precision (FloatPrecision): The precision the calculated columns are kept in between the passes.
+        metrics (StageMetrics): The recorder measuring the passes, None to not measure them.
+        cohorts (dict): The extra comparison cohorts (name: group columns), None to only compare within the default cohort.
+        quantile_error (float): The rank error of the approximated quantiles, None to calculate them exactly.
+        cohort_sketches (dict): The quantile sketches per cohort of the last run in sketch mode.
+        clamp_reports (list[pd.DataFrame]): The clamp reports of the possession adjustment (PadjMaker.clamp_report) per chunk.
+
+    Methods:
+        __init__(memory_budget_mb, spill_dir, demand, team_possession, precision, metrics, cohorts, quantile_error, cohort_sketches, clamp_reports): Initializes the StreamingETL class.
+        run(base_creator, source_path, kpi_method, file_path, test, csv_path): Runs the streaming ETL and writes the output database.
+        _spill_base(base_creator, source_path, base_dir, test): Pass 1, spills the base chunks and gathers foul statistics.
+        _get_possession_table(base_dir): Creates the team possession table over the spilled base chunks.
+        _spill_features(base_dir, features_dir, foul_statistics, possession_table): Pass 2, spills the row-local features per competition.
+        _spill_comparisons(competition_dirs, compare_dir): Pass 3, spills the comparisons per competition.
+        _write_output(compare_paths, kpi_method, fill_values, file_path, csv_path): Pass 4, calculates KPIs and writes the output.
+        _measure(stage, function, written_path): Runs a pass, measured when there is a metrics recorder.
+    """
+
+    # The columns defining a competition, every comparison group lies within one competition
+    competition_columns = ["division", "league_country", "league_competition"]
+
+    # The columns that _foul_maker standardises over the whole dataset
+    foul_columns = ["red_cards_avg", "fouls_avg", "yellow_cards_avg"]
+
+    # Rough ratio between the peak memory of the row-local stages and the CSV size of a chunk
+    memory_per_csv_byte = 8
+
+    def __init__(self, memory_budget_mb: int = 2048, spill_dir: str = os.path.join("storage", "tmp"), demand: FeatureDemand = None,
+                 team_possession: TeamPossession = None, precision: FloatPrecision = None, metrics: StageMetrics = None,
+                 cohorts: dict = None, quantile_error: float = None, cohort_sketches: dict = None, clamp_reports: list = None) -> None:
+        """
+        Initialize the StreamingETL class.
+
+        Args:
+            memory_budget_mb (int): The memory budget in megabytes. Defaults to 2048.
+            spill_dir (str): The directory in which the spilled parts are stored during a run. Defaults to 'storage/tmp'.
+            demand (FeatureDemand): The columns needed for the KPIs and reports. Defaults to None (all columns).
+            team_possession (TeamPossession): Adjusts the players by the possession of their team-season. Defaults to None.
+            precision (FloatPrecision): The precision of the calculated columns. Defaults to None (float64).
+            metrics (StageMetrics): The recorder measuring the passes. Defaults to None.
+            cohorts (dict): The extra comparison cohorts (name: group columns). Defaults to None.
+            quantile_error (float): The rank error of the approximated quantiles. Defaults to None (exact quantiles).
+            cohort_sketches (dict): The dict the quantile sketches per cohort are added to. Defaults to None (a new dict).
+            clamp_reports (list): The list the clamp report of every chunk is added to. Defaults to None (a new list).
+        """
+        self.memory_budget_mb = memory_budget_mb
+        self.spill_dir = spill_dir
+        self.demand = demand
+        self.team_possession = team_possession
+        self.precision = precision if precision is not None else FloatPrecision()
+        self.metrics = metrics
+        self.cohorts = cohorts
+        self.quantile_error = quantile_error
+        self.cohort_sketches = cohort_sketches if cohort_sketches is not None else {}
+        self.clamp_reports = clamp_reports if clamp_reports is not None else []
+
+    def run(
+        self,
+        base_creator: CreateWyscoutBase,
+        source_path: str,
+        kpi_method: str,
+        file_path: str,
+        test: bool = False,
+        csv_path: str = None,
+    ) -> None:
+        """
+        Run the streaming ETL and write the result to the output database. The rows are ordered per competition.
+
+        Args:
+            base_creator (CreateWyscoutBase): The configured creator of the base data.
+            source_path (str): The path to the directory containing Wyscout player season stats files.
+            kpi_method (str): The KPI method in config/kpi_methods.
+            file_path (str): The directory of the output database.
+            test (bool): Whether to only process the first 500 rows. Defaults to False.
+            csv_path (str): The path of an optional CSV export of the output. Defaults to None.
+        """
+        os.makedirs(self.spill_dir, exist_ok=True)
+        run_dir = tempfile.mkdtemp(prefix="spill_", dir=self.spill_dir)
+
+        try:
+            base_dir = os.path.join(run_dir, "base")
+            features_dir = os.path.join(run_dir, "features")
+            compare_dir = os.path.join(run_dir, "compare")
+
+            print("Streaming pass 1: Creating the base data in chunks")
+            foul_statistics = self._measure(
+                "streaming_base", lambda: self._spill_base(base_creator, source_path, base_dir, test), base_dir
+            )
+
+            possession_table = None
+            if self.team_possession is not None:
+                possession_table = self._measure("streaming_team_possession", lambda: self._get_possession_table(base_dir))
+
+            print("Streaming pass 2: Adding extra metrics and possession adjusting per chunk")
+            competition_dirs = self._measure(
+                "streaming_features", lambda: self._spill_features(base_dir, features_dir, foul_statistics, possession_table), features_dir
+            )
+
+            print("Streaming pass 3: Calculating player comparisons per competition")
+            compare_paths, fill_values = self._measure(
+                "streaming_comparisons", lambda: self._spill_comparisons(competition_dirs, compare_dir), compare_dir
+            )
+
+            print(f"Streaming pass 4: Calculating KPIs and saving data to {file_path}")
+            self._measure(
+                "streaming_output", lambda: self._write_output(compare_paths, kpi_method, fill_values, file_path, csv_path), file_path
+            )
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    def _spill_base(self, base_creator: CreateWyscoutBase, source_path: str, base_dir: str, test: bool) -> dict:
+        """
+        Create the base data in chunks and spill every chunk to disk, while gathering the mean and
+        standard deviation of the foul columns over all chunks.
+
+        Args:
+            base_creator (CreateWyscoutBase): The configured creator of the base data.
+            source_path (str): The path to the directory containing Wyscout player season stats files.
+            base_dir (str): The directory to spill the base chunks to.
+            test (bool): Whether to only process the first 500 rows.
+
+        Returns:
+            dict: The (mean, standard deviation) per foul column.
+        """
+        os.makedirs(base_dir, exist_ok=True)
+
+        chunk_bytes = int(self.memory_budget_mb * 1024**2 / self.memory_per_csv_byte)
+
+        # Count, mean and sum of squared deviations per column, merged over the chunks
+        moments = {column: (0, 0.0, 0.0) for column in self.foul_columns}
+
+        for i, df in enumerate(base_creator.iter_base_chunks(source_path, chunk_bytes=chunk_bytes)):
+            if test:
+                df = df[0:500]
+
+            # The chunks are spilled with the float32 score columns, they are widened when they are read
+            widened_df = self.precision.widen(df[self.foul_columns])
+            for column in self.foul_columns:
+                moments[column] = self._merge_moments(moments[column], widened_df[column])
+
+            df.to_parquet(os.path.join(base_dir, f"part-{i:05d}.parquet"))
+
+            if test:
+                break
+
+        foul_statistics = {}
+        for column, (count, mean, squared_deviations) in moments.items():
+            std = np.sqrt(squared_deviations / (count - 1)) if count > 1 else np.nan
+            foul_statistics[column] = (mean if count else np.nan, std)
+
+        return foul_statistics
+
+    def _merge_moments(self, moments: tuple, values: pd.Series) -> tuple:
+        """
+        Merge the count, mean and sum of squared deviations of new values into running moments.
+
+        Args:
+            moments (tuple): The running (count, mean, sum of squared deviations).
+            values (pd.Series): The new values, missing values are skipped.
+
+        Returns:
+            tuple: The merged (count, mean, sum of squared deviations).
+        """
+        values = values.dropna().astype("float64")
+        if values.empty:
+            return moments
+
+        count_a, mean_a, squared_deviations_a = moments
+        count_b = len(values)
+        mean_b = values.mean()
+        squared_deviations_b = ((values - mean_b) ** 2).sum()
+
+        count = count_a + count_b
+        delta = mean_b - mean_a
+
+        return (
+            count,
+            mean_a + delta * count_b / count,
+            squared_deviations_a + squared_deviations_b + delta**2 * count_a * count_b / count,
+        )
+
+    def _get_possession_table(self, base_dir: str) -> pd.DataFrame:
+        """
+        Create the team possession table over all spilled base chunks. Only the key and input columns
+        of the table are read, the players of a team can be spread over several chunks.
+
+        Args:
+            base_dir (str): The directory containing the spilled base chunks.
+
+        Returns:
+            pd.DataFrame: The team possession table.
+        """
+        columns = self.team_possession.key_columns + self.team_possession.input_columns
+        parts = [self.precision.widen(pd.read_parquet(os.path.join(base_dir, i), columns=columns)) for i in sorted(os.listdir(base_dir))]
+
+        return self.team_possession.get_table(pd.concat(parts, ignore_index=True))
+
+    def _spill_features(self, base_dir: str, features_dir: str, foul_statistics: dict, possession_table: pd.DataFrame = None) -> list[str]:
+        """
+        Run the row-local stages per base chunk and spill the result per competition.
+
+        Args:
+            base_dir (str): The directory containing the spilled base chunks.
+            features_dir (str): The directory to spill the results to.
+            foul_statistics (dict): The (mean, standard deviation) per foul column over all chunks.
+            possession_table (pd.DataFrame): The team possession table over all chunks. Defaults to None.
+
+        Returns:
+            list[str]: The directory per competition, in order of first appearance.
+        """
+        competition_dirs = []
+
+        for i, part_name in enumerate(sorted(os.listdir(base_dir))):
+            df = self.precision.widen(pd.read_parquet(os.path.join(base_dir, part_name)))
+
+            padj_maker = PadjMaker(team_possession=self.team_possession, possession_table=possession_table, dtype=self.precision.dtype)
+
+            if self.demand is None:
+                df = GetExtraFeatures()._create_extra_metrics(df, foul_statistics=foul_statistics)
+                df = padj_maker._make_df_padj(df)
+            else:
+                in_possession, out_possession = self.demand.get_padj_columns()
+                df = GetExtraFeatures(metrics=self.demand.get_derived_metrics())._create_extra_metrics(df, foul_statistics=foul_statistics)
+                df = padj_maker._make_df_padj(df, in_possession=in_possession, out_possession=out_possession)
+
+            self.clamp_reports.append(padj_maker.clamp_report)
+            df = self.precision.cast(df)
+
+            if self.quantile_error is not None:
+                self._update_sketches(df)
+
+            grouped = df.groupby(self.competition_columns, observed=True, dropna=False, sort=False)
+            for competition, competition_df in grouped:
+                competition_dir = os.path.join(features_dir, self._get_competition_key(competition))
+
+                if competition_dir not in competition_dirs:
+                    os.makedirs(competition_dir, exist_ok=True)
+                    competition_dirs.append(competition_dir)
+
+                competition_df.to_parquet(os.path.join(competition_dir, f"part-{i:05d}.parquet"))
+
+        return competition_dirs
+
+    def _update_sketches(self, df: pd.DataFrame) -> None:
+        """
+        Add a chunk to the quantile sketches of the cohorts spanning several competitions, the other
+        cohorts are sketched per competition in pass 3.
+
+        Args:
+            df (pd.DataFrame): The chunk with the row-local features.
+        """
+        pooled_cohorts = self._get_pooled_cohorts()
+        if not pooled_cohorts:
+            return
+
+        # The columns compared in pass 3, the main position is added to a shallow copy so the spilled chunk doesn't change
+        comparer = ComparePlayers()
+        columns = comparer._get_to_compare_columns(df)
+        if self.demand is not None:
+            columns = self.demand.get_compare_columns(columns)
+        columns = [i for i in columns if df[i].dtype in ("float64", "float32")]
+        df = comparer._add_main_position(df.copy(deep=False))
+
+        for name, group_columns in pooled_cohorts.items():
+            if name not in self.cohort_sketches:
+                self.cohort_sketches[name] = CohortSketches(group_columns, self.quantile_error)
+            self.cohort_sketches[name].update(df, columns)
+
+    def _spill_comparisons(self, competition_dirs: list[str], compare_dir: str) -> tuple[list[str], dict]:
+        """
+        Calculate the player comparisons per competition and spill the results, while gathering the
+        minimum of every comparison column over all competitions.
+
+        Args:
+            competition_dirs (list[str]): The directory per competition with the spilled features.
+            compare_dir (str): The directory to spill the results to.
+
+        Returns:
+            tuple[list[str], dict]: The spilled file per competition and the minimum per comparison column.
+        """
+        os.makedirs(compare_dir, exist_ok=True)
+
+        compare_paths = []
+        fill_values = {}
+
+        for competition_dir in competition_dirs:
+            parts = [pd.read_parquet(os.path.join(competition_dir, i)) for i in sorted(os.listdir(competition_dir))]
+            df = pd.concat(parts)
+
+            comparer = ComparePlayers()
+            to_compare_columns = None
+            if self.demand is not None:
+                to_compare_columns = self.demand.get_compare_columns(comparer._get_to_compare_columns(df))
+
+            pooled_sketches = {i: self.cohort_sketches[i] for i in self._get_pooled_cohorts() if i in self.cohort_sketches}
+            df = self.precision.cast(comparer._calculate_statistical_comparisons(
+                df, to_compare_columns=to_compare_columns, cohorts=self.cohorts, quantile_error=self.quantile_error, cohort_sketches=pooled_sketches
+            ))
+
+            # The sketches of the other cohorts are merged over the competitions
+            for name, sketches in comparer.cohort_sketches.items():
+                if name in self.cohort_sketches:
+                    self.cohort_sketches[name].merge(sketches)
+                else:
+                    self.cohort_sketches[name] = sketches
+
+            for column in df.columns:
+                if column.startswith(("zscore_", "quantile_")):
+                    fill_values[column] = np.fmin(fill_values.get(column, np.nan), df[column].min())
+
+            compare_path = os.path.join(compare_dir, os.path.basename(competition_dir) + ".parquet")
+            df.to_parquet(compare_path)
+            compare_paths.append(compare_path)
+
+        return compare_paths, fill_values
+
+    def _write_output(self, compare_paths: list[str], kpi_method: str, fill_values: dict, file_path: str, csv_path: str = None) -> None:
+        """
+        Calculate the KPIs per competition and write the results to the output database.
+
+        Args:
+            compare_paths (list[str]): The spilled comparisons per competition.
+            kpi_method (str): The KPI method in config/kpi_methods.
+            fill_values (dict): The minimum per comparison column over all competitions.
+            file_path (str): The directory of the output database.
+            csv_path (str): The path of an optional CSV export of the output. Defaults to None.
+        """
+        database = WyscoutDatabase()
+
+        for i, compare_path in enumerate(compare_paths):
+            df = pd.read_parquet(compare_path)
+            df = self.precision.cast(CalculateKPI().store_kpi_and_total(df, kpi_method, fill_values=fill_values))
+
+            database.write(df, file_path, part_name=f"part-{i:05d}")
+
+            if csv_path is not None:
+                df.to_csv(csv_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+
+    def _get_pooled_cohorts(self) -> dict:
+        """
+        Get the extra cohorts that span several competitions, only allowed in sketch mode.
+
+        Returns:
+            dict: The group columns per cohort.
+        """
+        return {k: v for k, v in (self.cohorts or {}).items() if not set(self.competition_columns) <= set(v)}
+
+    def _get_competition_key(self, competition: tuple) -> str:
+        """
+        Create a file system safe name for a competition.
+
+        Args:
+            competition (tuple): The values of the competition columns.
+
+        Returns:
+            str: The name of the competition directory.
+        """
+        return hashlib.sha1("|".join(str(i) for i in competition).encode("utf-8")).hexdigest()[:16]
+
+    def _measure(self, stage: str, function, written_path: str = None):
+        """
+        Run a pass, measured by the metrics recorder when there is one.
+
+        Args:
+            stage (str): The name of the pass in the metrics.
+            function (callable): The pass, called without arguments.
+            written_path (str): The directory the pass writes to. Defaults to None.
+
+        Returns:
+            The output of the pass.
+        """
+        if self.metrics is None:
+            return function()
+
+        return self.metrics.measure(stage, function, written_path=written_path)
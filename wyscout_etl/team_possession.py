@@ -0,0 +1,159 @@
+import pandas as pd
+import numpy as np
+import os
+
+from wyscout_etl.frame_cache import FrameCache
+from wyscout_etl.precision import FloatPrecision
+
+
+class TeamPossession:
+    """
+    A class for determining the possession of every team-season, to possession adjust its players with.
+
+    Wyscout doesn't export the possession of the team, it's derived from the interceptions of a player
+    and the possession adjusted interceptions. Every player of a team gives an estimate of the same
+    team possession; players with few minutes give noisy estimates. So the estimates are combined per
+    team-season (current_team_name, league_id and year) into a table with one row per team, using the
+    median weighted by the minutes played. The table is cached between runs under a fingerprint of its
+    input columns, and joined back to the players on the team-season key.
+
+    Attributes:
+        key_columns (list[str]): The columns identifying a team-season.
+        cache (FrameCache): The cache of the team possession table.
+        use_cache (bool): Whether the table is loaded from and stored in the cache.
+
+    Methods:
+        __init__(cache_dir, use_cache): Initializes the TeamPossession class.
+        get_table(df): Creates the team possession table, or loads it from the cache.
+        join(df, table): Looks up the possession of the team of every player.
+        get_player_ratios(df): Calculates the possession estimate of every player.
+        _create_table(df): Creates the team possession table.
+        _weighted_median(df): Calculates the weighted median of the estimates per team-season.
+    """
+
+    key_columns = ["current_team_name", "league_id", "year"]
+
+    # The columns the table is created from
+    input_columns = ["interceptions_avg", "possession_adjusted_interceptions", "minutes_on_field"]
+
+    def __init__(self, cache_dir: str = os.path.join("storage", "cache"), use_cache: bool = True) -> None:
+        """
+        Initialize the TeamPossession class.
+
+        Args:
+            cache_dir (str): The directory in which the table is cached. Defaults to 'storage/cache'.
+            use_cache (bool): Whether the table is loaded from and stored in the cache. Defaults to True.
+        """
+        self.cache = FrameCache(cache_dir)
+        self.use_cache = use_cache
+
+    def get_table(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Create the team possession table, or load it from the cache when the input columns didn't change.
+
+        Args:
+            df (pd.DataFrame): The players, containing the key and input columns.
+
+        Returns:
+            pd.DataFrame: The unrounded no possession ratio, the number of players and the minutes per
+                          team-season, indexed on the key columns.
+        """
+        if not self.use_cache:
+            return self._create_table(df)
+
+        data_hash = pd.util.hash_pandas_object(df[self.key_columns + self.input_columns], index=False)
+        fingerprint = self.cache.fingerprint(config_objects=[len(df), int(data_hash.sum())])
+
+        table = self.cache.load("team_possession", fingerprint)
+        if table is None:
+            table = self._create_table(df)
+            self.cache.store("team_possession", fingerprint, table.reset_index())
+        else:
+            table = table.set_index(self.key_columns)
+
+        return table
+
+    def join(self, df: pd.DataFrame, table: pd.DataFrame) -> pd.Series:
+        """
+        Look up the possession of the team of every player with an indexed join on the key columns.
+
+        Args:
+            df (pd.DataFrame): The players, containing the key columns.
+            table (pd.DataFrame): The team possession table.
+
+        Returns:
+            pd.Series: The unrounded no possession ratio of the team of every player, NaN for players
+                       of unknown teams.
+        """
+        # The key columns are categorical in the base, the table index holds plain values
+        keys = df[self.key_columns].astype(object)
+
+        return keys.join(table["no_possession_ratio"], on=self.key_columns)["no_possession_ratio"]
+
+    def get_player_ratios(self, df: pd.DataFrame) -> pd.Series:
+        """
+        Calculate the unrounded no possession ratio estimated from the interceptions of every player, in
+        double precision from the decimal values of the interceptions (also of float32 columns).
+
+        Args:
+            df (pd.DataFrame): The players, containing the interception columns.
+
+        Returns:
+            pd.Series: The no possession ratio per player.
+        """
+        precision = FloatPrecision()
+        interceptions = precision.get_decimal_values(df['interceptions_avg'])
+        adjusted_interceptions = precision.get_decimal_values(df['possession_adjusted_interceptions'])
+
+        return pd.Series((interceptions * 1.5) / (adjusted_interceptions * 2), index=df.index)
+
+    def _create_table(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Create the team possession table from the estimates of the players.
+
+        Args:
+            df (pd.DataFrame): The players, containing the key and input columns.
+
+        Returns:
+            pd.DataFrame: The team possession table, indexed on the key columns.
+        """
+        print("Creating the team possession table")
+
+        estimates = df[self.key_columns].astype(object)
+        estimates["ratio"] = self.get_player_ratios(df).astype("float64").replace([np.inf, -np.inf], np.nan)
+        estimates["minutes"] = pd.to_numeric(df["minutes_on_field"], errors="coerce").astype("float64").fillna(0).clip(lower=0)
+
+        # Only the players with an estimate count, players without a team are looked up by their own estimate
+        estimates = estimates.dropna(subset=self.key_columns + ["ratio"])
+
+        grouped = estimates.groupby(self.key_columns, sort=False)
+        table = pd.DataFrame({
+            "no_possession_ratio": self._weighted_median(estimates),
+            "players": grouped["ratio"].size(),
+            "minutes": grouped["minutes"].sum(),
+        })
+
+        return table
+
+    def _weighted_median(self, estimates: pd.DataFrame) -> pd.Series:
+        """
+        Calculate the median of the estimates per team-season, weighted by the minutes played. When no
+        player of a team has played minutes, every player counts the same.
+
+        Args:
+            estimates (pd.DataFrame): The key columns, the estimate ('ratio') and the weight ('minutes') per player.
+
+        Returns:
+            pd.Series: The weighted median per team-season, indexed on the key columns.
+        """
+        estimates = estimates.sort_values(self.key_columns + ["ratio"])
+        grouped = estimates.groupby(self.key_columns, sort=False)
+
+        estimates["weight"] = estimates["minutes"].where(grouped["minutes"].transform("sum") > 0, 1)
+        grouped = estimates.groupby(self.key_columns, sort=False)["weight"]
+
+        # The median is the first estimate at which the cumulative weight reaches half of the total weight
+        cumulative_weights = grouped.cumsum()
+        half_weights = grouped.transform("sum") / 2
+
+        return estimates[cumulative_weights >= half_weights].groupby(self.key_columns, sort=False)["ratio"].first()
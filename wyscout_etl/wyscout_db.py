@@ -0,0 +1,205 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+
+from config.wyscout_column_info import wyscout_team_season_columns
+
+
+class WyscoutDatabase:
+    """
+    A class for writing and loading the output database of the ETL.
+
+    The database is stored as a partitioned Arrow IPC dataset: a directory per year, league
+    country and league competition (hive layout, e.g. year=2024/league_country=Spain/...)
+    containing compressed Arrow files with dictionary encoded strings. Loading with filters on
+    the partition columns only opens the matching directories, and loading a handful of
+    columns only reads those columns. Old single file (Feather) and CSV databases can still
+    be loaded.
+
+    Attributes:
+        compression (str): The compression of the Arrow files: "zstd", "lz4" or "uncompressed".
+                           Uncompressed files can be memory mapped without copying.
+        partition_columns (list[str]): The columns the dataset is partitioned on.
+
+    Methods:
+        __init__(compression): Initializes the WyscoutDatabase class.
+        write(df, path, part_name): Writes a DataFrame to the partitioned dataset.
+        load(path, columns, filters): Loads (a selection of columns and rows of) the database.
+        get_columns(path): Reads the column names of the database without loading any data.
+        _get_dataset(path): Opens the partitioned dataset.
+        _get_partitioning(): Creates the hive partitioning of the dataset.
+        _get_filter_expression(filters): Turns filters into a dataset expression.
+        _encode_strings(df): Dictionary encodes the string columns of a DataFrame.
+    """
+
+    # The columns of wyscout_team_season_columns the dataset is partitioned on, from coarse to fine
+    partition_columns = [i for i in ["year", "league_country", "league_competition"] if i in wyscout_team_season_columns]
+
+    def __init__(self, compression: str = "zstd") -> None:
+        """
+        Initialize the WyscoutDatabase class.
+
+        Args:
+            compression (str): The compression of the Arrow files. Defaults to "zstd".
+        """
+        self.compression = compression
+
+    def write(self, df: pd.DataFrame, path: str, part_name: str = "part-00000") -> None:
+        """
+        Write a DataFrame to the partitioned dataset. Writing several parts with a different
+        `part_name` to the same path adds them to the dataset, so the parts never have to be
+        in memory at once.
+
+        Args:
+            df (pd.DataFrame): The DataFrame to write, containing the partition columns.
+            path (str): The directory of the dataset.
+            part_name (str): The name of the files of this part. Defaults to 'part-00000'.
+        """
+        table = pa.Table.from_pandas(self._encode_strings(df), preserve_index=False)
+
+        # The partition values become directory names, so they are stored as plain strings
+        for column in self.partition_columns:
+            index = table.schema.get_field_index(column)
+            table = table.set_column(index, column, pc.cast(table[column], pa.string()))
+
+        file_format = ds.IpcFileFormat()
+        compression = None if self.compression == "uncompressed" else self.compression
+
+        ds.write_dataset(
+            table,
+            path,
+            format=file_format,
+            partitioning=self._get_partitioning(),
+            basename_template=f"{part_name}-{{i}}.arrow",
+            existing_data_behavior="overwrite_or_ignore",
+            file_options=file_format.make_write_options(compression=compression),
+        )
+
+    def load(self, path: str, columns: list[str] = None, filters: dict = None) -> pd.DataFrame:
+        """
+        Load (a selection of columns and rows of) the database.
+
+        Filters on the partition columns are applied to the directory names, so only the
+        matching partitions are read. Filters on other columns are applied while scanning.
+
+        Args:
+            path (str): The path of the dataset directory, or of an Arrow or CSV database.
+            columns (list[str]): The columns to load. Defaults to None (all columns).
+            filters (dict): The allowed value, or list of allowed values, per column,
+                            e.g. {"league_country": ["Spain", "Italy"], "main_position": "CB"}.
+                            Defaults to None (all rows).
+
+        Returns:
+            pd.DataFrame: The loaded database.
+        """
+        if os.path.isdir(path):
+            dataset = self._get_dataset(path)
+            table = dataset.to_table(columns=columns, filter=self._get_filter_expression(filters))
+
+            # The partition columns are stored in the directory names, restore the written column order
+            if columns is None and table.schema.pandas_metadata is not None:
+                written_columns = [i["name"] for i in table.schema.pandas_metadata["columns"] if i["name"] in table.column_names]
+                table = table.select(written_columns)
+
+            return table.to_pandas()
+
+        # The old databases are not partitioned, so they are filtered after loading
+        read_columns = None if columns is None else list(dict.fromkeys(columns + list(filters or {})))
+
+        if path.endswith(".csv"):
+            df = pd.read_csv(path, usecols=read_columns)
+        else:
+            df = feather.read_table(path, columns=read_columns, memory_map=True).to_pandas()
+
+        for column, values in (filters or {}).items():
+            df = df[df[column].isin(values if isinstance(values, list) else [values])]
+
+        return df.reset_index(drop=True) if columns is None else df[columns].reset_index(drop=True)
+
+    def get_columns(self, path: str) -> list[str]:
+        """
+        Read the column names of the database without loading any data.
+
+        Args:
+            path (str): The path of the dataset directory, or of an Arrow or CSV database.
+
+        Returns:
+            list[str]: The column names.
+        """
+        if os.path.isdir(path):
+            return self._get_dataset(path).schema.names
+
+        if path.endswith(".csv"):
+            return pd.read_csv(path, nrows=0).columns.tolist()
+
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).schema.names
+
+    def _get_dataset(self, path: str) -> ds.Dataset:
+        """
+        Open the partitioned dataset. Opening only lists the files, no data is read.
+
+        Args:
+            path (str): The directory of the dataset.
+
+        Returns:
+            ds.Dataset: The dataset.
+        """
+        return ds.dataset(path, format="ipc", partitioning=self._get_partitioning())
+
+    def _get_partitioning(self) -> ds.Partitioning:
+        """
+        Create the hive partitioning of the dataset, e.g. year=2024/league_country=Spain/league_competition=La Liga.
+
+        Returns:
+            ds.Partitioning: The partitioning on the partition columns.
+        """
+        schema = pa.schema([(column, pa.string()) for column in self.partition_columns])
+
+        return ds.partitioning(schema, flavor="hive")
+
+    def _get_filter_expression(self, filters: dict = None) -> pc.Expression | None:
+        """
+        Turn filters into a dataset expression.
+
+        Args:
+            filters (dict): The allowed value, or list of allowed values, per column. Defaults to None.
+
+        Returns:
+            pc.Expression | None: The expression of all filters combined, or None without filters.
+        """
+        expression = None
+
+        for column, values in (filters or {}).items():
+            values = values if isinstance(values, list) else [values]
+
+            # The partition values are strings, e.g. the year 2024 is stored as '2024'
+            if column in self.partition_columns:
+                values = [str(i) for i in values]
+
+            column_expression = pc.field(column).isin(values)
+            expression = column_expression if expression is None else expression & column_expression
+
+        return expression
+
+    def _encode_strings(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Dictionary encode the string columns of a DataFrame by converting them to categoricals.
+
+        Args:
+            df (pd.DataFrame): The DataFrame to encode.
+
+        Returns:
+            pd.DataFrame: The DataFrame with categorical string columns.
+        """
+        df = df.copy(deep=False)
+
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = df[column].astype("category")
+
+        return df